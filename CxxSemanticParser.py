@@ -32,6 +32,7 @@ from CxxTypeParser import TokensReader
 from CxxTypeParser import CxxType
 from CxxTypeParser import CxxUnitType
 from CxxTypeParser import CxxParseType
+from CxxTypeParser import CxxParseTypeCached
 from CxxTypeParser import CxxParseTemplateList
 
 class ComplScope(object):
@@ -759,7 +760,7 @@ def ResolveFirstVariable(tagmgr, scope_stack, search_scopes, variable_name):
     # 在作用域栈中搜索
     tag = GetFirstMatchTag(tagmgr, search_scopes, variable_name)
     # TODO: 从 tag 中获取变量声明, 然后解析出 CxxType
-    cxx_type = CxxParseType(tag.get('text', ''))
+    cxx_type = CxxParseTypeCached(tag.get('text', ''))
     if tag.has_key('class'):
         # 变量是类中的成员, 需要解析模版
         # TODO
@@ -864,7 +865,7 @@ def ResolveComplInfo(scope_stack, compl_info, tagmgr = None):
             code = temp_name
             if compl_scope.tmpl:
                 code += '< %s >' % ', '.join(compl_scope.tmpl)
-            cxx_type = CxxParseType(code)
+            cxx_type = CxxParseTypeCached(code)
             # 更新
             compl_scope.type = cxx_type
     elif compl_scope.kind == compl_scope.KIND_VARIABLE and not compl_scope.cast:
@@ -908,7 +909,7 @@ def ResolveComplInfo(scope_stack, compl_info, tagmgr = None):
         tag = GetFirstMatchTag(tagmgr, search_scopes, compl_scope.text)
         if not tag:
             return []
-        cxx_type = CxxParseType(tag.get('text', ''))
+        cxx_type = CxxParseTypeCached(tag.get('text', ''))
         if not cxx_type.IsValid():
             return []
         # 更新
@@ -964,7 +965,7 @@ def ResolveComplInfo(scope_stack, compl_info, tagmgr = None):
             if compl_scope.cast:
                 cxx_type = compl_scope.cast
             else:
-                cxx_type = CxxParseType(tag.get('text', ''))
+                cxx_type = CxxParseTypeCached(tag.get('text', ''))
             if not cxx_type.IsValid():
                 search_scopes = []
                 break
@@ -979,7 +980,7 @@ def ResolveComplInfo(scope_stack, compl_info, tagmgr = None):
             if compl_scope.cast:
                 cxx_type = compl_scope.cast
             else:
-                cxx_type = CxxParseType(tag.get('text', ''))
+                cxx_type = CxxParseTypeCached(tag.get('text', ''))
             if not cxx_type.IsValid():
                 search_scopes = []
                 break
@@ -1098,34 +1099,17 @@ def GetFirstMatchTag(tagmgr, search_scopes, name, kinds = set()):
     '''
     @kinds: kind缩写的集合, 非空的时候, 只有tag的kind在此集合中才会不被忽略
     '''
-    result = {}
-
+    paths = []
+    seen = set()
     for scope in search_scopes:
         path = GenPath(scope, name)
-        tags = tagmgr.GetTagsByPath(path)
-        if not tags:
+        if path in seen:
             continue
+        seen.add(path)
+        paths.append(path)
 
-        if kinds:
-            found = False
-            for tag in tags:
-                if tag.kind in kinds:
-                    result = tag
-                    found = True
-                    break
-            if found:
-                break
-        else:
-            tag = tags[0]
-            if TagIsCtor(tag) or TagIsDtor(tag):
-                # 跳过构造和析构函数的 tag, 因为构造函数是不能继续补全的
-                # eg. A::A, A::~A
-                continue
-            else:
-                result = tag
-                break
-
-    return result
+    # 所有候选的 path 一次性查询, 按 search_scopes 的顺序取第一个匹配的
+    return tagmgr.GetFirstMatchTagByPaths(paths, list(kinds))
 
 def main(argv):
     unit_test_GetComplInfo()
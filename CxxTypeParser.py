@@ -6,6 +6,7 @@ import os
 import os.path
 import re
 import json
+from collections import OrderedDict
 
 ########## 硬编码设置, 用于快速测试 ##########
 path = [os.path.expanduser('~/.videm/core'),
@@ -17,6 +18,19 @@ sys.path.extend(path)
 from CppTokenizer import CxxToken
 from ListReader import ListReader
 from CppTokenizer import CxxTokenize
+from TokenCache import TokenCache
+
+# 标签的 text 等声明会被反复解析, 分词结果按字符串缓存
+TOKEN_CACHE = TokenCache(CxxTokenize)
+
+# CxxParseType() 跳过的类型前的关键词
+SKIP_WORDS = ['friend', 'typedef', 'constexpr', 'const', 'volatile',
+              'auto', 'register', 'static', 'thread_local', 'extern', 'mutable',
+              'inline', 'virtual', 'explicit']
+SKIP_WORDS_RE = re.compile('(^%s$)' % '$)|(^'.join(SKIP_WORDS))
+
+# CxxParseTypeCached() 的缓存大小, 满了之后淘汰最久没有使用的
+MAX_TYPE_CACHE = 10000
 
 class TokensReader(ListReader):
     def __init__(self, tokens, null = CxxToken()):
@@ -55,6 +69,32 @@ class CxxUnitType(object):
     def __repr__(self):
         return self.ToEvalStr()
 
+    def Freeze(self):
+        return FrozenCxxUnitType((self.text, tuple(self.tmpl)))
+
+class FrozenCxxUnitType(tuple):
+    '''不可修改的 CxxUnitType, 可以共享和作为字典的键
+    内容为 (text, tmpl 元组)'''
+    __slots__ = ()
+
+    text = property(lambda self: tuple.__getitem__(self, 0))
+    tmpl = property(lambda self: tuple.__getitem__(self, 1))
+
+    def IsValid(self):
+        return bool(self.text)
+
+    def IsInvalid(self):
+        return not self.IsValid()
+
+    def IsError(self):
+        return not self.IsValid()
+
+    def ToEvalStr(self):
+        return '{"text": "%s", "tmpl": %s}' % (self.text, list(self.tmpl))
+
+    def __repr__(self):
+        return self.ToEvalStr()
+
 class CxxType(object):
     '''代表一个C++类型，保存足够的信息'''
     def __init__(self):
@@ -90,6 +130,39 @@ class CxxType(object):
         self.typelist = []
         self._global = False
 
+    def Freeze(self):
+        return FrozenCxxType((tuple(i.Freeze() for i in self.typelist),
+                              self._global))
+
+class FrozenCxxType(tuple):
+    '''不可修改的 CxxType, 由 CxxParseTypeCached() 返回, 多个调用者共享
+    内容为 (typelist 元组, _global)'''
+    __slots__ = ()
+
+    typelist = property(lambda self: tuple.__getitem__(self, 0))
+    _global = property(lambda self: tuple.__getitem__(self, 1))
+
+    @property
+    def fullname(self):
+        names = [i.text for i in self.typelist]
+        if self._global:
+            return '::' + '::'.join(names)
+        else:
+            return '::'.join(names)
+
+    def IsValid(self):
+        return bool(self.typelist)
+
+    def IsInvalid(self):
+        return not self.IsValid()
+
+    def ToEvalStr(self):
+        return '{"global": %s, "typelist": %s}' % (self._global,
+                                                   list(self.typelist))
+
+    def __repr__(self):
+        return self.ToEvalStr()
+
 def SkipToToken(tokrdr, text, collector = None):
     '''跳到指定的token, 成功时, tokrdr.curr 即为指定的 token'''
     while tokrdr.curr.IsValid():
@@ -437,7 +510,7 @@ def CxxParseType(arg):
     if isinstance(arg, TokensReader):
         tokrdr = arg
     elif isinstance(arg, str):
-        tokrdr = TokensReader(CxxTokenize(arg))
+        tokrdr = TokensReader(TOKEN_CACHE.Tokenize(arg))
     elif isinstance(arg, list):
         tokrdr = TokensReader(arg)
     else:
@@ -473,14 +546,9 @@ def CxxParseType(arg):
         explicit
     */
     '''
-    words = ['friend', 'typedef', 'constexpr', 'const', 'volatile',
-             'auto', 'register', 'static', 'thread_local', 'extern', 'mutable',
-             'inline', 'virtual', 'explicit']
-    words_re = re.compile('(^%s$)' % '$)|(^'.join(words))
-
-    # 跳过上面那些关键词
+    # 跳过 SKIP_WORDS 中的关键词
     while True:
-        if words_re.match(tokrdr.curr.text):
+        if SKIP_WORDS_RE.match(tokrdr.curr.text):
             tokrdr.Pop()
         break
 
@@ -542,6 +610,32 @@ def CxxParseType(arg):
 
     return cxx_type
 
+# {字符串: FrozenCxxType}
+_type_cache = OrderedDict()
+_type_cache_stats = {'hits': 0, 'misses': 0}
+
+def CxxParseTypeCached(text):
+    '''与 CxxParseType(text) 相同, 但是返回共享的 FrozenCxxType, 按字符串缓存
+    用于反复解析的声明, 例如标签的 text'''
+    cxx_type = _type_cache.pop(text, None)
+    if cxx_type is None:
+        _type_cache_stats['misses'] += 1
+        cxx_type = CxxParseType(text).Freeze()
+        if len(_type_cache) >= MAX_TYPE_CACHE:
+            _type_cache.popitem(last = False)
+    else:
+        _type_cache_stats['hits'] += 1
+    # 重新放到最后, 表示最近使用过
+    _type_cache[text] = cxx_type
+    return cxx_type
+
+def GetTypeCacheStats():
+    stats = dict(_type_cache_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hitRate'] = stats['hits'] * 1.0 / total if total else 0.0
+    stats['types'] = len(_type_cache)
+    return stats
+
 def unit_test_int():
     cases = [
         ["short",               "signed short int"],
@@ -732,6 +826,56 @@ def main(argv):
     cxx_type = CxxParseType('A<X, Y>::B::C')
     assert cxx_type.fullname == 'A::B::C'
 
+    unit_test_cached()
+    if '-b' in argv[1:]:
+        bench_cached()
+
+def unit_test_cached():
+    global MAX_TYPE_CACHE
+    for origin in ['const std::map<int, A<B> >&', '::MyNs::MyClass *p',
+                   'unsigned long', '']:
+        cxx_type = CxxParseTypeCached(origin)
+        assert cxx_type is CxxParseTypeCached(origin)
+        assert repr(cxx_type) == repr(CxxParseType(origin))
+        assert cxx_type.fullname == CxxParseType(origin).fullname
+    frozen = CxxParseTypeCached('std::vector<int>')
+    assert frozen.typelist[1].tmpl == ('int',)
+    assert hash(frozen) == hash(CxxParseType('std::vector<int>').Freeze())
+    try:
+        frozen.typelist[0].text = 'x'
+        assert False
+    except AttributeError:
+        pass
+
+    # 满了之后只淘汰最久没有使用的
+    _type_cache.clear()
+    saved, MAX_TYPE_CACHE = MAX_TYPE_CACHE, 2
+    try:
+        a = CxxParseTypeCached('A')
+        CxxParseTypeCached('B')
+        CxxParseTypeCached('A')
+        CxxParseTypeCached('C')
+        assert _type_cache.keys() == ['A', 'C']
+        assert CxxParseTypeCached('A') is a
+    finally:
+        MAX_TYPE_CACHE = saved
+        _type_cache.clear()
+
+def bench_cached():
+    '''性能: 重复解析相同的声明, python CxxTypeParser.py -b'''
+    import time
+    decls = ['const std::vector<std::string> &v%d;' % (i % 200)
+             for i in range(5000)]
+    t0 = time.time()
+    for decl in decls:
+        CxxParseType(decl)
+    t1 = time.time()
+    for decl in decls:
+        CxxParseTypeCached(decl)
+    t2 = time.time()
+    print 'parse %.1f ms, cached %.1f ms, %s' % (
+        (t1 - t0) * 1000, (t2 - t1) * 1000, GetTypeCacheStats())
+
 if __name__ == '__main__':
     import sys
     ret = main(sys.argv)
@@ -0,0 +1,650 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+补全候选的模糊(子序列)匹配
+
+* 查询串的字符按顺序出现在候选中即为匹配, 不区分 ASCII 大小写,
+  例如 "gtbp" 匹配 "GetTagsByPath", "gtp" 匹配 "get_tags_path"
+* 单词的开头指驼峰的大写字母, 下划线之后的字符和数字的开始.
+  查询串的第一个字符必须匹配单词的开头, 其他字符优先匹配单词的开头, 分数更高
+* 候选集合建立一次索引(字符 -> 候选集合), 查询时先用集合交集排除不可能的
+  候选, 只对剩下的候选计算分数, 然后用堆取前 K 个
+* 查询串是上一次查询串的扩展时(逐字输入), 只在上一次的结果中查找
+* 候选集合的少量修改用 Update() 增量更新, 不需要重新建立索引
+'''
+
+import heapq
+import gc
+import time
+import bisect
+import threading
+from collections import OrderedDict
+
+# 分数
+SCORE_CHAR          = 1     # 每个匹配的字符
+SCORE_BOUNDARY      = 8     # 匹配到单词的开头
+SCORE_CONSECUTIVE   = 4     # 与上一个匹配的字符相邻
+SCORE_CASE          = 1     # 大小写也相同
+SCORE_PREFIX        = 64    # 查询串是候选的前缀(不区分大小写)
+
+# 一次查询最多计算分数的候选数, 超过的话只计算最可能排在前面的候选
+MAX_SCORED = 300
+# 候选太多时的缓存, 满了之后淘汰最久没有使用的
+MAX_TIER_CACHE = 256
+# 增量更新的修改超过候选数的这个比例的话, 重新建立
+REBUILD_RATIO = 0.25
+
+def WordBoundaries(word):
+    '''返回单词开头的位置列表
+    单词开头: 第一个字符, 下划线之后的字符, 小写字母之后的大写字母,
+    非数字之后的数字, 以及 "HTTPServer" 中的 "S"'''
+    result = []
+    prev = ''
+    for i, c in enumerate(word):
+        if c == '_':
+            pass
+        elif not prev or prev == '_':
+            result.append(i)
+        elif c.isupper():
+            if prev.islower() or prev.isdigit() or \
+                    (i + 1 < len(word) and word[i+1].islower()):
+                result.append(i)
+        elif c.isdigit():
+            if not prev.isdigit():
+                result.append(i)
+        prev = c
+    return result
+
+def _Positions(lword, query, bounds, bchars):
+    '''返回 query 在 lword 中匹配的位置列表, 不匹配返回 None
+    第一个字符必须匹配单词的开头, 之后优先匹配相邻的字符, 其次是单词的开头,
+    都失败的话退回为最左匹配'''
+    j = bchars.find(query[0])
+    if j < 0:
+        return None
+    start = bounds[j]
+    positions = [start]
+    pos = start + 1
+    bi = j + 1
+    nbounds = len(bounds)
+    for c in query[1:]:
+        if lword[pos:pos+1] == c:
+            p = pos
+        else:
+            while bi < nbounds and bounds[bi] < pos:
+                bi += 1
+            j = bchars.find(c, bi)
+            if j >= 0:
+                p = bounds[j]
+                bi = j + 1
+            else:
+                p = lword.find(c, pos)
+                if p < 0:
+                    break
+        positions.append(p)
+        pos = p + 1
+    else:
+        return positions
+
+    # 优先单词开头的贪婪匹配可能会越过后面需要的字符, 使用最左匹配重试
+    positions = [start]
+    pos = start + 1
+    for c in query[1:]:
+        p = lword.find(c, pos)
+        if p < 0:
+            return None
+        positions.append(p)
+        pos = p + 1
+    return positions
+
+def _Score(word, lword, query, positions, boundset):
+    score = 0
+    prev = -2
+    for qc, p in zip(query, positions):
+        score += SCORE_CHAR
+        if p in boundset:
+            score += SCORE_BOUNDARY
+        if p == prev + 1:
+            score += SCORE_CONSECUTIVE
+        if word[p] == qc:
+            score += SCORE_CASE
+        prev = p
+    if lword.startswith(query.lower()):
+        score += SCORE_PREFIX
+    return score
+
+def FuzzyScore(query, word, icase = True):
+    '''计算单个候选的分数, 不匹配返回 None, 空查询串匹配全部且分数为 0'''
+    if not query:
+        return 0
+    lword = word.lower()
+    lquery = query.lower()
+    bounds = WordBoundaries(word)
+    bchars = ''.join([lword[i] for i in bounds])
+    positions = _Positions(lword, lquery, bounds, bchars)
+    if positions is None:
+        return None
+    if not icase and [word[p] for p in positions] != list(query):
+        return None
+    return _Score(word, lword, query, positions, set(bounds))
+
+class FuzzyMatcher(object):
+    '''对固定的候选集合做模糊匹配, 索引在构造时建立'''
+    def __init__(self, words):
+        self.words = list(words)
+        self.lwords = [w.lower() for w in self.words]
+        # 单词开头的位置和字符
+        self.bounds = [WordBoundaries(w) for w in self.words]
+        self.bchars = [''.join([lw[i] for i in b])
+                       for lw, b in zip(self.lwords, self.bounds)]
+        # {小写字符: 包含这个字符的候选下标集合}
+        self.charIndex = {}
+        for i, lw in enumerate(self.lwords):
+            for c in set(lw):
+                self.charIndex.setdefault(c, set()).add(i)
+        self.lengths = [len(w) for w in self.words]
+        # 按小写名字和单词开头字符排序的下标, 用于二分查找前缀
+        self.wordOrder = sorted(xrange(len(self.words)),
+                                key = self.lwords.__getitem__)
+        self.sortedWords = [self.lwords[i] for i in self.wordOrder]
+        self.bcharsOrder = sorted(xrange(len(self.words)),
+                                  key = self.bchars.__getitem__)
+        self.sortedBChars = [self.bchars[i] for i in self.bcharsOrder]
+        # {小写字符: 有以这个字符开头的单词的候选下标集合}
+        self.boundIndex = {}
+        for i, bc in enumerate(self.bchars):
+            for c in set(bc):
+                self.boundIndex.setdefault(c, set()).add(i)
+        # {候选: 下标}, 删除的候选不在其中, 下标不再使用
+        self.wordIds = dict((w, i) for i, w in enumerate(self.words))
+        self.dead = set()
+
+        # {小写查询串: 候选太多时计算分数的候选}
+        self.tierCache = OrderedDict()
+
+        # 上一次查询, 用于逐字输入时缩小范围
+        self.lastQuery = None
+        self.lastMatches = None
+
+        self.stats = {
+            'queries': 0,
+            'narrowed': 0,
+            'tiered': 0,
+            'scored': 0,
+        }
+
+    def __len__(self):
+        return len(self.words) - len(self.dead)
+
+    def GetWords(self):
+        '''当前的候选集合'''
+        return set(self.wordIds)
+
+    def GetDeadCount(self):
+        '''已删除的候选数, 太多的话应该重新建立'''
+        return len(self.dead)
+
+    def Update(self, added = (), removed = ()):
+        '''增量修改候选集合, 已经存在的 added 和不存在的 removed 会被忽略
+        删除的候选只是从索引中移除, 下标不再使用'''
+        for word in removed:
+            i = self.wordIds.pop(word, None)
+            if i is None:
+                continue
+            self.dead.add(i)
+            lw = self.lwords[i]
+            for c in set(lw):
+                self.charIndex[c].discard(i)
+            for c in set(self.bchars[i]):
+                self.boundIndex[c].discard(i)
+            self._SortedRemove(self.sortedWords, self.wordOrder, lw, i)
+            self._SortedRemove(self.sortedBChars, self.bcharsOrder,
+                               self.bchars[i], i)
+
+        for word in added:
+            if word in self.wordIds:
+                continue
+            i = len(self.words)
+            lw = word.lower()
+            bounds = WordBoundaries(word)
+            bc = ''.join([lw[j] for j in bounds])
+            self.words.append(word)
+            self.lwords.append(lw)
+            self.bounds.append(bounds)
+            self.bchars.append(bc)
+            self.lengths.append(len(word))
+            self.wordIds[word] = i
+            for c in set(lw):
+                self.charIndex.setdefault(c, set()).add(i)
+            for c in set(bc):
+                self.boundIndex.setdefault(c, set()).add(i)
+            # 相同的键插入到最后, 与构造时的稳定排序一致
+            pos = bisect.bisect_right(self.sortedWords, lw)
+            self.sortedWords.insert(pos, lw)
+            self.wordOrder.insert(pos, i)
+            pos = bisect.bisect_right(self.sortedBChars, bc)
+            self.sortedBChars.insert(pos, bc)
+            self.bcharsOrder.insert(pos, i)
+
+        # 缓存的候选和上一次的结果都可能已经过时
+        self.tierCache.clear()
+        self.lastQuery = None
+        self.lastMatches = None
+
+    def _SortedRemove(self, keys, order, key, i):
+        lo = bisect.bisect_left(keys, key)
+        hi = bisect.bisect_right(keys, key, lo)
+        pos = order.index(i, lo, hi)
+        del keys[pos]
+        del order[pos]
+
+    def GetStats(self):
+        return dict(self.stats)
+
+    def Candidates(self, lquery):
+        '''返回可能匹配 lquery 的候选下标集合(包含全部查询字符)'''
+        if self.lastQuery is not None and lquery.startswith(self.lastQuery):
+            # 扩展了上一次的查询串, 匹配的候选一定在上一次的结果中
+            self.stats['narrowed'] += 1
+            result = self.lastMatches
+        else:
+            result = None
+        sets = [self.boundIndex.get(lquery[0])]
+        for c in set(lquery[1:]):
+            sets.append(self.charIndex.get(c))
+        if not all(sets):
+            return set()
+        # 从最小的集合开始求交集
+        sets.sort(key = len)
+        if result is None:
+            result = sets.pop(0)
+        for s in sets:
+            result = result.intersection(s)
+            if not result:
+                break
+        return result
+
+    def _PrefixRange(self, keys, order, prefix):
+        lo = bisect.bisect_left(keys, prefix)
+        hi = bisect.bisect_left(keys, prefix + '\xff')
+        return order[lo:hi]
+
+    def _TierIds(self, lquery):
+        '''前缀匹配和缩写前缀匹配中最短的 MAX_SCORED 个候选, 结果会缓存'''
+        ids = self.tierCache.pop(lquery, None)
+        if ids is None:
+            ids = set(self._PrefixRange(self.sortedWords, self.wordOrder,
+                                        lquery))
+            ids.update(self._PrefixRange(self.sortedBChars, self.bcharsOrder,
+                                         lquery))
+            if len(ids) > MAX_SCORED:
+                ids = heapq.nsmallest(MAX_SCORED, ids,
+                                      key = self.lengths.__getitem__)
+            if len(self.tierCache) >= MAX_TIER_CACHE:
+                self.tierCache.popitem(last = False)
+        self.tierCache[lquery] = ids
+        return ids
+
+    def _Shortest(self, ids):
+        '''候选太多时只计算最短的 MAX_SCORED 个的分数, 分数相同时短的优先'''
+        if len(ids) <= MAX_SCORED:
+            return ids
+        return heapq.nsmallest(MAX_SCORED, ids, key = self.lengths.__getitem__)
+
+    def _ScoreIds(self, ids, query, lquery, icase):
+        '''返回 ([(分数, 下标), ...], 匹配的下标集合)'''
+        words = self.words
+        lwords = self.lwords
+        bounds = self.bounds
+        bchars = self.bchars
+        matches = set()
+        scored = []
+        n = len(lquery)
+        # 前缀匹配的分数只与单词开头的数量和大小写有关
+        prefixScore = SCORE_PREFIX + n * SCORE_CHAR + \
+                (n - 1) * SCORE_CONSECUTIVE
+        for i in ids:
+            lword = lwords[i]
+            word = words[i]
+            if lword.startswith(lquery) and (icase or word.startswith(query)):
+                if word.startswith(query):
+                    score = prefixScore + n * SCORE_CASE
+                else:
+                    score = prefixScore + SCORE_CASE * \
+                            sum([a == b for a, b in zip(word, query)])
+                score += SCORE_BOUNDARY * bisect.bisect_left(bounds[i], n)
+                matches.add(i)
+                scored.append((score, i))
+                continue
+
+            positions = _Positions(lword, lquery, bounds[i], bchars[i])
+            if positions is None:
+                continue
+            matches.add(i)
+            if not icase:
+                if [word[p] for p in positions] != list(query):
+                    continue
+            scored.append((_Score(word, lword, query, positions,
+                                  bounds[i]), i))
+        self.stats['scored'] += len(ids)
+        return scored, matches
+
+    def Match(self, query, limit = 100, icase = True):
+        '''返回 [(分数, 下标), ...], 按分数降序, 分数相同时短的和字典序小的优先
+        icase 为假时查询串的字符大小写必须与候选相同'''
+        self.stats['queries'] += 1
+        words = self.words
+        if not query:
+            return [(0, i) for i in heapq.nsmallest(
+                limit, self.wordIds.itervalues(),
+                key = lambda i: (len(words[i]), words[i]))]
+
+        lquery = query.lower()
+        candidates = self.Candidates(lquery)
+
+        if len(candidates) > MAX_SCORED:
+            # 候选太多, 分层计算分数, 足够 limit 个之后不再计算后面的层:
+            # 1. 前缀匹配和缩写前缀匹配中最短的候选
+            # 2. 每个查询字符都是某个单词开头的候选
+            # 3. 其他的候选
+            self.stats['tiered'] += 1
+            ids = self._TierIds(lquery)
+            scored, matches = self._ScoreIds(ids, query, lquery, icase)
+            rest = candidates.difference(ids)
+            if len(scored) < limit:
+                ids = rest
+                for c in set(lquery[1:]):
+                    ids = ids.intersection(self.boundIndex.get(c, ()))
+                rest.difference_update(ids)
+                result, matches = self._ScoreIds(self._Shortest(ids), query,
+                                                 lquery, icase)
+                scored.extend(result)
+            if len(scored) < limit:
+                result, matches = self._ScoreIds(self._Shortest(rest), query,
+                                                 lquery, icase)
+                scored.extend(result)
+            # 全部候选一定包含扩展查询串的匹配
+            matches = candidates
+        else:
+            scored, matches = self._ScoreIds(candidates, query, lquery, icase)
+
+        self.lastQuery = lquery
+        self.lastMatches = matches
+
+        return heapq.nsmallest(limit, scored,
+                               key = lambda x: (-x[0], len(words[x[1]]),
+                                                words[x[1]]))
+
+    def MatchWords(self, query, limit = 100, icase = True):
+        '''同 Match(), 但是直接返回候选字符串'''
+        return [self.words[i] for score, i in self.Match(query, limit, icase)]
+
+def FuzzyFilter(query, items, key = None, limit = None, icase = True):
+    '''对任意序列做一次模糊匹配, 返回按分数排序的元素, 分数相同时保持原顺序
+    key 为获取元素名字的函数, 为 None 时元素本身就是名字
+    不建立索引, 适用于每次都不同的较小的候选集合'''
+    scored = []
+    for i, item in enumerate(items):
+        if key is None:
+            name = item
+        else:
+            name = key(item)
+        score = FuzzyScore(query, name, icase)
+        if score is not None:
+            scored.append((-score, i))
+    if limit is None:
+        scored.sort()
+    else:
+        scored = heapq.nsmallest(limit, scored)
+    return [items[i] for score, i in scored]
+
+class FuzzyMatcherCache(object):
+    '''按键保存 FuzzyMatcher, 在后台线程建立和更新, 查询时不等待
+
+    loader(key) 在后台线程中调用, 返回 key 对应的全部候选.
+    stamp 为候选集合的版本, 查询时的 stamp 与建立时的不同的话, 在后台重新
+    载入候选并增量更新, 更新完成之前依然使用旧的 FuzzyMatcher'''
+    def __init__(self, loader, maxMatchers = 8):
+        self.loader = loader
+        self.maxMatchers = maxMatchers
+        # 保护下面的全部成员, 查询和修改 FuzzyMatcher 时也要持有
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # {键: (stamp, FuzzyMatcher)}, 最近使用的在最后
+        self.matchers = OrderedDict()
+        # {键: 最后一次请求载入的 stamp}, 避免重复请求
+        self.requested = {}
+        # 等待载入的 {键: stamp}
+        self.pending = OrderedDict()
+        self.busy = False
+        self.thread = None
+
+        self.stats = {
+            'builds': 0,
+            'updates': 0,
+            'misses': 0,
+            'stale': 0,
+            'errors': 0,
+        }
+
+    def GetStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['matchers'] = len(self.matchers)
+            stats['pending'] = len(self.pending)
+            return stats
+
+    def MatchWords(self, key, stamp, query, limit = 100, icase = True):
+        '''同 FuzzyMatcher.MatchWords(), 还没有建立的话返回 None'''
+        with self.lock:
+            value = self.matchers.pop(key, None)
+            if value is None:
+                self.stats['misses'] += 1
+            else:
+                self.matchers[key] = value
+                if value[0] != stamp:
+                    self.stats['stale'] += 1
+            if (value is None or value[0] != stamp) and \
+                    self.requested.get(key) != stamp:
+                self._Request(key, stamp)
+            if value is None:
+                return None
+            return value[1].MatchWords(query, limit, icase)
+
+    def Put(self, key, stamp, words):
+        '''在当前线程建立或更新, 用于后台线程无法载入的候选(例如内存数据库)'''
+        with self.lock:
+            value = self.matchers.get(key)
+            self.requested[key] = stamp
+        self._Store(key, stamp, words, value)
+
+    def Wait(self, timeout = None):
+        '''等待全部请求完成, 返回是否已经完成'''
+        with self.cond:
+            if timeout is not None:
+                end = time.time() + timeout
+            while self.pending or self.busy:
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remain = end - time.time()
+                    if remain <= 0:
+                        return False
+                    self.cond.wait(remain)
+            return True
+
+    def _Request(self, key, stamp):
+        '''持有 self.lock 时调用'''
+        self.requested[key] = stamp
+        self.pending.pop(key, None)
+        self.pending[key] = stamp
+        if self.thread is None:
+            self.thread = threading.Thread(target = self._Run,
+                                           name = 'FuzzyMatcherCache')
+            self.thread.daemon = True
+            self.thread.start()
+        self.cond.notify_all()
+
+    def _Run(self):
+        while True:
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+                while not self.pending:
+                    self.cond.wait()
+                key, stamp = self.pending.popitem(last = False)
+                value = self.matchers.get(key)
+                self.busy = True
+            try:
+                words = self.loader(key)
+            except Exception:
+                with self.lock:
+                    self.stats['errors'] += 1
+                continue
+            if self._Store(key, stamp, words, value):
+                # 建立索引产生了大量对象, 在这里完成完整的垃圾回收,
+                # 以免之后在查询的时候触发
+                gc.collect()
+
+    def _Store(self, key, stamp, words, value):
+        '''value 为开始载入时的 (stamp, FuzzyMatcher) 或 None
+        只有载入的线程修改 FuzzyMatcher, 所以比较候选不需要持有锁
+        返回是否重新建立了'''
+        words = set(words)
+        matcher = value and value[1]
+        if matcher is not None:
+            old = matcher.GetWords()
+            added = words - old
+            removed = old - words
+            if len(added) + len(removed) + matcher.GetDeadCount() > \
+                    max(len(words), len(old)) * REBUILD_RATIO:
+                matcher = None
+        if matcher is None:
+            # 建立的时候不持有锁, 查询依然使用旧的
+            matcher = FuzzyMatcher(sorted(words))
+            with self.lock:
+                self.stats['builds'] += 1
+                self._Set(key, stamp, matcher)
+            return True
+        with self.lock:
+            if added or removed:
+                matcher.Update(added, removed)
+            self.stats['updates'] += 1
+            self._Set(key, stamp, matcher)
+        return False
+
+    def _Set(self, key, stamp, matcher):
+        self.matchers.pop(key, None)
+        self.matchers[key] = (stamp, matcher)
+        while len(self.matchers) > self.maxMatchers:
+            oldKey, value = self.matchers.popitem(last = False)
+            self.requested.pop(oldKey, None)
+
+def test():
+    assert WordBoundaries('GetTagsByPath') == [0, 3, 7, 9]
+    assert WordBoundaries('get_tags_path') == [0, 4, 9]
+    assert WordBoundaries('HTTPServer2') == [0, 4, 10]
+    assert WordBoundaries('__init__') == [2]
+
+    assert FuzzyScore('gtbp', 'GetTagsByPath') is not None
+    assert FuzzyScore('gtp', 'get_tags_path') is not None
+    assert FuzzyScore('gtbpx', 'GetTagsByPath') is None
+    assert FuzzyScore('gtb', 'GotbTx') is not None
+    # 第一个字符必须匹配单词的开头
+    assert FuzzyScore('et', 'GetTags') is None
+    # 单词开头的匹配优于中间的匹配
+    assert FuzzyScore('gtbp', 'GetTagsByPath') > \
+            FuzzyScore('gtbp', 'gettabp')
+    # 前缀匹配最优
+    assert FuzzyScore('get', 'GetTagsByPath') > \
+            FuzzyScore('get', 'GoodEnoughTag')
+
+    words = ['GetTagsByPath', 'GetTagsByPaths', 'get_tags_by_path',
+             'GetTags', 'gettabp', 'SetTagsByPath', 'Other']
+    matcher = FuzzyMatcher(words)
+    # 小写的查询串与小写的候选大小写相同, 分数略高
+    assert matcher.MatchWords('gtbp')[:3] == ['get_tags_by_path',
+                                              'GetTagsByPath',
+                                              'GetTagsByPaths']
+    assert 'gettabp' in matcher.MatchWords('gtbp')
+    assert matcher.MatchWords('gtbp', icase = False) == ['get_tags_by_path',
+                                                         'gettabp']
+    assert matcher.MatchWords('gtbps') == ['GetTagsByPaths']
+    assert matcher.stats['narrowed'] == 3
+    assert matcher.MatchWords('oth') == ['Other']
+    # 分数相同时保持原顺序
+    assert FuzzyFilter('GT', words, limit = 1) == ['GetTagsByPath']
+    assert FuzzyFilter('gt', [{'name': 'SetTags'}, {'name': 'GetTags'}],
+                       key = lambda x: x['name']) == [{'name': 'GetTags'}]
+
+    # 增量更新与重新建立的结果相同
+    matcher = FuzzyMatcher(words)
+    matcher.MatchWords('gtb')
+    matcher.Update(added = ['GetTagsBuffer', 'Other'],
+                   removed = ['GetTagsByPaths', 'NotThere'])
+    words = set(words) - set(['GetTagsByPaths'])
+    words.add('GetTagsBuffer')
+    assert matcher.GetWords() == words and len(matcher) == len(words)
+    rebuilt = FuzzyMatcher(sorted(words))
+    for query in ('', 'g', 'gtb', 'gtbp', 'tags', 'oth'):
+        assert matcher.MatchWords(query) == rebuilt.MatchWords(query), query
+    matcher.Update(added = ['GetTagsByPaths'])
+    assert matcher.MatchWords('gtbps') == ['GetTagsByPaths']
+    assert matcher.GetDeadCount() == 1
+
+    # 后台建立和更新, 查询时不等待
+    # 修改不多的话增量更新
+    sources = {'k': ['GetTagsByPath', 'SetTags'] +
+                    ['W%d' % i for i in range(8)]}
+    cache = FuzzyMatcherCache(lambda key: sources[key])
+    assert cache.MatchWords('k', 1, 'gtbp') is None
+    assert cache.Wait(5)
+    assert cache.MatchWords('k', 1, 'gtbp') == ['GetTagsByPath']
+    sources['k'] = sources['k'] + ['GetTagsByPaths']
+    # 版本改变后先返回旧的结果
+    assert cache.MatchWords('k', 2, 'gtbp') == ['GetTagsByPath']
+    assert cache.Wait(5)
+    assert cache.MatchWords('k', 2, 'gtbp') == ['GetTagsByPath',
+                                                'GetTagsByPaths']
+    assert cache.GetStats()['builds'] == 1
+    assert cache.GetStats()['updates'] == 1
+    cache.Put('m', 1, ['abc'])
+    assert cache.MatchWords('m', 1, 'ac') == ['abc']
+
+def bench():
+    '''性能: 5 万个候选'''
+    import time
+    import random
+
+    random.seed(0)
+    parts = ['Get', 'Set', 'Tags', 'By', 'Path', 'Name', 'File', 'Scope',
+             'Kind', 'Type', 'Parse', 'Store', 'Item', 'List', 'Map', 'Node',
+             'Tree', 'Buffer', 'Line', 'Token', 'Cache', 'Index', 'Entry',
+             'Add', 'Remove', 'Find', 'Open', 'Close', 'Read', 'Write', 'Is',
+             'Has', 'Count', 'Size', 'Data', 'Value', 'Key', 'Hash', 'Queue',
+             'Stack', 'Vector', 'String', 'Stream', 'Socket', 'Thread',
+             'Lock', 'Event', 'Handler', 'Manager', 'Config', 'Option',
+             'Result', 'Error', 'State', 'Context', 'Window', 'View', 'Model']
+    words = set()
+    while len(words) < 50000:
+        word = ''.join(random.sample(parts, random.randint(2, 4)))
+        if random.random() < 0.3:
+            word = '_'.join(word.lower() for word in
+                            random.sample(parts, random.randint(2, 4)))
+        words.add(word)
+    t0 = time.time()
+    matcher = FuzzyMatcher(words)
+    t1 = time.time()
+    print 'index %d words: %.1f ms' % (len(matcher), (t1 - t0) * 1000)
+    for query in ('g', 'gt', 'gtb', 'gtbp', 'xyz', 'pfs', 'tokc'):
+        t0 = time.time()
+        result = matcher.MatchWords(query, 20)
+        t1 = time.time()
+        print '%-6s %6.2f ms %s' % (query, (t1 - t0) * 1000, result[:3])
+    print matcher.GetStats()
+
+if __name__ == '__main__':
+    import sys
+    test()
+    if '-b' in sys.argv[1:]:
+        bench()
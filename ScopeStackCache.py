@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+GetScopeStack() 的增量缓存
+
+CppParser.CxxGetScopeStack() 每次都要从文件开头分析到光标, 但是光标之前已经
+结束的块(函数体, 类定义, 循环体等等)不影响光标处的作用域栈. 这里先用一个只
+识别花括号, 注释, 字符串和预处理行的扫描器计算每行开始时的状态, 然后把已经
+结束的块的内容替换为空白(保持行号和列号不变), 只把还没结束的块交给 CppParser
+
+* 每个文件保存上一次的行和每行开始时的扫描状态(检查点), 只从第一个修改的行
+  开始重新扫描, 扫描结果还按 (行的内容, 开始状态) 缓存
+* 顶层(不在任何还没结束的块中)的行的处理结果与光标位置无关, 也按文件缓存,
+  在一个函数内输入时, 只需要处理这个函数, CppParser 需要分析的也只有这个
+  函数和外层的声明
+* 相同的分析输入直接返回上一次的结果
+'''
+
+import re
+import hashlib
+
+# 扫描状态的模式
+MODE_CODE       = 0
+MODE_COMMENT    = 1     # 在 /* */ 注释中
+MODE_PP         = 2     # 在以 '\' 续行的预处理行中
+
+# 一行中的记号, 空白不是记号
+TOKEN_RE = re.compile(r'''/\*|//|"(?:\\.|[^"\\])*"?|'(?:\\.|[^'\\])*'?|[{}]|[^\s{}"'/]+|/''')
+
+# 缓存的大小
+MAX_LINE_CACHE = 100000
+MAX_STRIP_CACHE = 10000
+MAX_RESULT_CACHE = 16
+MAX_FILES = 8
+
+def TokenizeLine(line, depth, mode):
+    '''返回 ([(开始, 结束, 层次), ...], 结束时的深度, 结束时的模式)
+    层次是记号所在的块的深度, '{' 和 '}' 的层次是它们外面的深度'''
+    tokens = []
+    pos = 0
+    if mode == MODE_COMMENT:
+        end = line.find('*/')
+        if end < 0:
+            if line.strip():
+                tokens.append((0, len(line), depth))
+            return tokens, depth, MODE_COMMENT
+        pos = end + 2
+        tokens.append((0, pos, depth))
+        mode = MODE_CODE
+    elif mode == MODE_PP or line.lstrip().startswith('#'):
+        # 预处理行中的花括号不计算
+        if line.strip():
+            tokens.append((0, len(line), depth))
+        if line.rstrip().endswith('\\'):
+            return tokens, depth, MODE_PP
+        return tokens, depth, MODE_CODE
+
+    while True:
+        m = TOKEN_RE.search(line, pos)
+        if not m:
+            break
+        text = m.group()
+        start = m.start()
+        pos = m.end()
+        if text == '{':
+            tokens.append((start, pos, depth))
+            depth += 1
+        elif text == '}':
+            depth -= 1
+            tokens.append((start, pos, depth))
+        elif text == '//':
+            tokens.append((start, len(line), depth))
+            break
+        elif text == '/*':
+            end = line.find('*/', pos)
+            if end < 0:
+                tokens.append((start, len(line), depth))
+                mode = MODE_COMMENT
+                break
+            pos = end + 2
+            tokens.append((start, pos, depth))
+        else:
+            tokens.append((start, pos, depth))
+    return tokens, depth, mode
+
+def StripLine(line, tokens, floor):
+    '''把层次高于之后的最低层次的记号替换为空白, 即删除已经结束的块的内容
+    floor 为这一行之后(到光标为止)的最低层次'''
+    chars = list(line)
+    for start, end, level in reversed(tokens):
+        if level > floor:
+            chars[start:end] = ' ' * (end - start)
+        else:
+            floor = level
+    return ''.join(chars).rstrip()
+
+class ScopeStackCache(object):
+    def __init__(self, parser):
+        '''parser 为 CppParser.CxxGetScopeStack'''
+        self.parser = parser
+        # {(行, 开始状态): (记号, 结束状态, 最低层次, 最高层次)}
+        self.lineCache = {}
+        # {(行, 开始状态, floor): 处理后的行}
+        self.stripCache = {}
+        # {文件: [行列表, 每行开始时的状态列表, 顶层的处理结果]}, 即检查点
+        self.files = {}
+        self.fileOrder = []
+        # {分析输入的摘要: 结果}
+        self.results = {}
+        self.resultOrder = []
+
+        self.stats = {
+            'requests': 0,
+            'scannedLines': 0,
+            'reusedLines': 0,
+            'strippedLines': 0,
+            'resultHits': 0,
+            'fallbacks': 0,
+        }
+
+    def GetStats(self):
+        return dict(self.stats)
+
+    def Clear(self, file = None):
+        if file is None:
+            self.files.clear()
+            del self.fileOrder[:]
+        elif file in self.files:
+            del self.files[file]
+            self.fileOrder.remove(file)
+
+    def LineInfo(self, line, state):
+        key = (line, state)
+        info = self.lineCache.get(key)
+        if info is None:
+            tokens, depth, mode = TokenizeLine(line, state[0], state[1])
+            if tokens:
+                levels = [level for start, end, level in tokens]
+                info = (tokens, (depth, mode), min(levels), max(levels))
+            else:
+                info = (tokens, (depth, mode), None, None)
+            if len(self.lineCache) >= MAX_LINE_CACHE:
+                self.lineCache.clear()
+            self.lineCache[key] = info
+            self.stats['scannedLines'] += 1
+        return info
+
+    def _Entry(self, file, lines):
+        '''返回文件的检查点 [行列表, 每行开始时的状态列表, 顶层的处理结果]
+        状态列表比 lines 多一个, 即结束时的状态, 从上一次的第一个不同的行开始
+        重新计算. 顶层的处理结果是 floor 为 0 时每行的处理结果, 与光标位置
+        无关, 需要时才计算'''
+        first = 0
+        states = [(0, MODE_CODE)]
+        zero = []
+        old = self.files.get(file)
+        if old is not None:
+            oldLines, oldStates, oldZero = old
+            count = min(len(oldLines), len(lines))
+            while first < count and oldLines[first] == lines[first]:
+                first += 1
+            states = oldStates[:first+1]
+            zero = oldZero[:first]
+            self.stats['reusedLines'] += first
+            self.fileOrder.remove(file)
+
+        state = states[-1]
+        for line in lines[first:]:
+            state = self.LineInfo(line, state)[1]
+            states.append(state)
+
+        entry = [lines, states, zero]
+        self.files[file] = entry
+        self.fileOrder.append(file)
+        if len(self.fileOrder) > MAX_FILES:
+            del self.files[self.fileOrder.pop(0)]
+        return entry
+
+    def _Strip(self, line, state, floor):
+        '''处理一行, 返回 (处理后的行, 这一行的最低层次)'''
+        tokens, end, lo, hi = self.LineInfo(line, state)
+        if lo is None:
+            return line, floor
+        if lo > floor:
+            # 整行都在已经结束的块中
+            self.stats['strippedLines'] += 1
+            return '', lo
+        if lo == hi:
+            return line, lo
+        key = (line, state, floor)
+        stripped = self.stripCache.get(key)
+        if stripped is None:
+            stripped = StripLine(line, tokens, floor)
+            if len(self.stripCache) >= MAX_STRIP_CACHE:
+                self.stripCache.clear()
+            self.stripCache[key] = stripped
+        return stripped, lo
+
+    def StripContents(self, file, contents):
+        '''返回删除了已经结束的块的内容的 contents, 行数不变
+        最后一行为光标所在行(光标之前的部分), 保持原样'''
+        lines = contents[:-1]
+        entry = self._Entry(file, lines)
+        states = entry[1]
+        tokens, state, lo, hi = self.LineInfo(contents[-1], states[-1])
+        floor = state[0]
+        if lo is not None:
+            floor = min(floor, lo)
+
+        result = [None] * len(lines) + [contents[-1]]
+        i = len(lines)
+        while i > 0 and floor > 0:
+            i -= 1
+            result[i], lo = self._Strip(lines[i], states[i], floor)
+            floor = min(floor, lo)
+
+        if floor == 0:
+            # 到达顶层, 之前的行使用缓存的顶层的处理结果
+            zero = entry[2]
+            for j in xrange(len(zero), i):
+                stripped, lo = self._Strip(lines[j], states[j], 0)
+                # 层次为负数表示花括号不匹配
+                zero.append(stripped if lo >= 0 else None)
+            result[:i] = zero[:i]
+
+        if floor < 0 or None in result:
+            # 花括号不匹配(例如预处理分支), 不处理
+            self.stats['fallbacks'] += 1
+            return contents
+        return result
+
+    def GetScopeStack(self, file, contents):
+        '''contents 为光标之前的内容的行列表, 与 CppParser.CxxGetScopeStack()
+        的参数相同'''
+        self.stats['requests'] += 1
+        if not contents:
+            return self.parser(contents)
+        stripped = self.StripContents(file, contents)
+
+        key = hashlib.md5('\n'.join(stripped)).digest()
+        result = self.results.get(key)
+        if result is not None:
+            self.stats['resultHits'] += 1
+            return result
+
+        result = self.parser(stripped)
+        self.results[key] = result
+        self.resultOrder.append(key)
+        if len(self.resultOrder) > MAX_RESULT_CACHE:
+            del self.results[self.resultOrder.pop(0)]
+        return result
+
+def test():
+    import time
+    buff = '''\
+#include <stdio.h>
+#define BLOCK { int x; }
+using namespace std;
+/* a { comment
+   spanning } lines */
+struct A {
+    int a;
+    void f() { int inner; }
+} g_a;
+namespace N {
+int Foo(int arg)
+{
+    const char *s = "}";
+    if (arg) {
+        int tmp;
+    }
+    for (;;) { int i; } int after;
+    A a;
+    a.'''.splitlines()
+    cache = ScopeStackCache(lambda contents: contents)
+    result = cache.GetScopeStack('a.cpp', buff)
+    assert len(result) == len(buff)
+    # 预处理行和注释中的花括号不计算
+    assert result[1] == buff[1] and result[3] == buff[3]
+    # 已经结束的块的内容被删除, 花括号保留
+    assert result[6] == '' and result[7] == ''
+    assert result[5] == buff[5] and result[8] == '} g_a;'
+    assert result[14] == ''
+    assert result[16] == '    for (;;) {        } int after;'
+    # 还没结束的块保持原样
+    assert result[9:14] == buff[9:14] and result[17:] == buff[17:]
+
+    # 修改函数内的行, 之前的行不需要重新扫描
+    buff[17] = '    A b;'
+    scanned = cache.stats['scannedLines']
+    result = cache.GetScopeStack('a.cpp', buff)
+    assert result[17] == '    A b;'
+    assert cache.stats['scannedLines'] == scanned + 1
+    assert cache.stats['reusedLines'] == 17
+    assert cache.GetScopeStack('a.cpp', buff) is result
+    assert cache.stats['resultHits'] == 1
+
+    # 不匹配的花括号
+    assert cache.GetScopeStack('b.cpp', ['}', 'a.']) == ['}', 'a.']
+    print cache.GetStats()
+
+    # 性能: 5000 行, 在最后一个函数中输入
+    lines = []
+    for i in range(500):
+        lines.append('int Func%d(int a, int b)' % i)
+        lines.append('{')
+        for j in range(7):
+            lines.append('    if (a > %d) { b += a * %d; /* } */ }' % (j, j))
+        lines.append('}')
+    cache = ScopeStackCache(lambda contents: contents)
+    t0 = time.time()
+    cache.GetScopeStack('c.cpp', lines + ['int Last()', '{', '    a.'])
+    t1 = time.time()
+    result = cache.GetScopeStack('c.cpp', lines + ['int Last()', '{', '    b.'])
+    t2 = time.time()
+    print 'first %.1f ms, incremental %.1f ms, non-empty lines %d/%d' % (
+        (t1 - t0) * 1000, (t2 - t1) * 1000,
+        len(filter(None, result)), len(result))
+
+if __name__ == '__main__':
+    test()
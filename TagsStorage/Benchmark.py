@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+TagsStorageSQLite 的性能测试, 使用生成的大数据库
+
+用法:
+    Benchmark.py [tags数量]
+'''
+
+import sys
+import os
+import os.path
+import time
+import tempfile
+import sqlite3
+import threading
+
+from TagsStorageSQLite import TagsStorageSQLite
+from TagsStorageSQLite import TagLinesToEntries
+from TagsStorageSQLite import CONNECTION_POOL
+from SymbolSnapshot import ExportSnapshot, OpenSnapshot
+from TagsManager import TagEntry2Tag
+from TagsManager import ComplRows2Items
+
+# 每个类的成员数量
+MEMBERS_PER_CLASS = 50
+# 每个名空间的类数量
+CLASSES_PER_NS = 20
+
+def GenScope(idx):
+    '''第 idx 个类的 scope'''
+    return 'ns%d::Class%d' % (idx / CLASSES_PER_NS, idx % CLASSES_PER_NS)
+
+def GenRows(count):
+    '''生成 count 个 tag 的数据库行, 不包括 id 列'''
+    for i in xrange(count):
+        cls = i / MEMBERS_PER_CLASS
+        scope = GenScope(cls)
+        fname = '/src/dir%d/file%d.hpp' % (cls / 100, cls)
+        if i % 2:
+            name, kind, extra = 'Get%s_%d' % ('Value', i), 'p', 'int'
+        else:
+            name, kind, extra = 'm_%s%d' % ('value', i), 'm', 'int'
+        yield (name, fname, 0, i % 1000 + 1, kind, scope, 'c', 'public',
+               '', '()' if kind == 'p' else '', extra, scope + '::' + name)
+
+def GenTagLines(count):
+    '''生成 count 个 tag 的 ctags 输出行'''
+    fullKinds = {'p': 'prototype', 'm': 'member'}
+    for row in GenRows(count):
+        name, fname, fileid, line, kind, scope = row[:6]
+        fields = ['line:%d' % line, 'class:%s' % scope, 'access:public']
+        if kind == 'p':
+            fields.append('signature:()')
+        yield '%s\t%s\t/^    int %s;$/;"\t%s\t%s' \
+                % (name, fname, name, fullKinds[kind], '\t'.join(fields))
+
+def CreateDatabase(fname, count, wal = False):
+    storage = TagsStorageSQLite(wal = wal)
+    storage.OpenDatabase(fname)
+    storage.db.executemany(
+        "INSERT INTO TAGS VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        GenRows(count))
+    storage.Commit()
+    return storage
+
+# ----------------------------------------------------------------------------
+# 原来的拼接 SQL 字符串的查询方式, 用于对比
+# ----------------------------------------------------------------------------
+def LegacyGetOrderedTagsByScopesAndName(storage, scopes, name, partialMatch):
+    tmpName = name.replace('_', '^_')
+    sql = "select * from tags where scope in("
+    for i in scopes:
+        sql += "'" + i + "',"
+    sql = sql[:-1] + ") and "
+    sql += " name like '" + tmpName + "%' ESCAPE '^' "
+    sql += 'order by name ASC'
+    sql += ' LIMIT ' + str(storage.GetSingleSearchLimit())
+    return storage.DoFetchTags(sql)
+
+def LegacyGetTagsByScopeAndName(storage, scope, name):
+    sql = "select * from tags where scope='" + scope + "' and "
+    sql += " name ='" + name + "' "
+    sql += " LIMIT " + str(storage.GetSingleSearchLimit())
+    return storage.DoFetchTags(sql)
+
+def LegacyGetTagsByScopesAndKinds(storage, scopes, kinds):
+    sql = "select * from tags where scope in ("
+    for scope in scopes:
+        sql += "'" + scope + "',"
+    sql = sql[:-1] + ") "
+    return storage.DoFetchTags(sql, kinds)
+
+def LegacyGetTagsByPath(storage, path):
+    # 没有 path 列之前只能按 scope 和 name 查找
+    scope, sep, name = path.rpartition('::')
+    sql = "select * from tags where scope='" + scope + "' and "
+    sql += " name ='" + name + "' "
+    return storage.DoFetchTags(sql)
+
+def LegacyGetTagsByFiles(storage, files):
+    sql = "select * from tags where file in ("
+    for file in files:
+        sql += "'" + file + "',"
+    sql = sql[:-1] + ")"
+    return storage.DoFetchTags(sql)
+
+def _Measure(func, argsList):
+    '''返回每次调用的平均耗时(微秒)和结果总数'''
+    total = 0
+    t0 = time.time()
+    for args in argsList:
+        total += len(func(*args))
+    return (time.time() - t0) * 1e6 / len(argsList), total
+
+def BenchQuery(storage, count, rounds = 2000):
+    '''对比拼接字符串和绑定参数两种查询方式的单次查询耗时'''
+    classes = max(count / MEMBERS_PER_CLASS, 1)
+    cases = []
+
+    # 每轮的参数都不同, 拼接字符串的方式无法命中语句缓存
+    args = []
+    for i in xrange(rounds):
+        cls = (i * 7919) % classes
+        scopes = [GenScope(cls), GenScope(cls / CLASSES_PER_NS),
+                  'ns%d' % (cls / CLASSES_PER_NS), '<global>']
+        args.append((scopes, 'Get', True))
+    cases.append(('GetOrderedTagsByScopesAndName',
+                  LegacyGetOrderedTagsByScopesAndName,
+                  TagsStorageSQLite.GetOrderedTagsByScopesAndName, args))
+
+    args = []
+    for i in xrange(rounds):
+        idx = (i * 7919) % count
+        args.append((GenScope(idx / MEMBERS_PER_CLASS),
+                     'Get%s_%d' % ('Value', idx | 1)))
+    cases.append(('GetTagsByScopeAndName',
+                  LegacyGetTagsByScopeAndName,
+                  TagsStorageSQLite.GetTagsByScopeAndName, args))
+
+    args = []
+    for i in xrange(rounds):
+        cls = (i * 7919) % classes
+        args.append(([GenScope(cls), GenScope((cls + 1) % classes)], ['p']))
+    cases.append(('GetTagsByScopesAndKinds',
+                  LegacyGetTagsByScopesAndKinds,
+                  TagsStorageSQLite.GetTagsByScopesAndKinds, args))
+
+    args = []
+    for i in xrange(rounds):
+        cls = (i * 7919) % classes
+        args.append((['/src/dir%d/file%d.hpp' % (cls / 100, cls)], ))
+    cases.append(('GetTagsByFiles',
+                  LegacyGetTagsByFiles,
+                  TagsStorageSQLite.GetTagsByFiles, args))
+
+    args = []
+    for i in xrange(rounds):
+        idx = (i * 7919) % count
+        args.append(('%s::Get%s_%d' % (GenScope(idx / MEMBERS_PER_CLASS),
+                                       'Value', idx | 1), ))
+    cases.append(('GetTagsByPath',
+                  LegacyGetTagsByPath,
+                  TagsStorageSQLite.GetTagsByPath, args))
+
+    print '%-32s %12s %12s %8s' % ('query', 'legacy(us)', 'bound(us)', 'speedup')
+    for name, legacy, bound, args in cases:
+        argsList = [(storage, ) + a for a in args]
+        legacyTime, legacyCount = _Measure(legacy, argsList)
+        boundTime, boundCount = _Measure(bound, argsList)
+        if legacyCount != boundCount:
+            print '%s: result mismatch %d != %d' \
+                    % (name, legacyCount, boundCount)
+        print '%-32s %12.1f %12.1f %7.2fx' % (name, legacyTime, boundTime,
+                                             legacyTime / boundTime)
+
+def BenchSymbolIndex(storage, count, rounds = 2000):
+    '''对比 SQL 和内存索引的 作用域 + 名字前缀 查询'''
+    classes = max(count / MEMBERS_PER_CLASS, 1)
+    args = []
+    for i in xrange(rounds):
+        cls = (i * 7919) % classes
+        scopes = [GenScope(cls), GenScope(cls / CLASSES_PER_NS),
+                  'ns%d' % (cls / CLASSES_PER_NS), '<global>']
+        args.append((storage, scopes, 'get', True))
+    func = TagsStorageSQLite.GetOrderedTagsByScopesAndName
+
+    sqlTime, sqlCount = _Measure(func, args)
+    index = storage.EnableSymbolIndex()
+    t0 = time.time()
+    index.Sync(storage.db)
+    loadTime = time.time() - t0
+    # 第一轮包括各个作用域的排序
+    firstTime, firstCount = _Measure(func, args)
+    indexTime, indexCount = _Measure(func, args)
+    storage.EnableSymbolIndex(False)
+    if sqlCount != indexCount or firstCount != indexCount:
+        print 'SymbolIndex: result mismatch %d != %d' % (sqlCount, indexCount)
+    print '%-32s %12s %12s %8s' % ('symbol index', 'sql(us)', 'index(us)',
+                                   'speedup')
+    print '%-32s %12.1f %12.1f %7.2fx' % ('GetOrderedTagsByScopesAndName',
+                                         sqlTime, indexTime,
+                                         sqlTime / indexTime)
+    print '%-32s %12.1f' % ('(first round)', firstTime)
+    print '%-32s %12.1f' % ('(load, ms)', loadTime * 1000.0)
+
+def BenchSnapshot(storage, count, rounds = 2000):
+    '''导出快照, 打开快照, 对比 SQL 和快照的查询'''
+    fd, fname = tempfile.mkstemp(suffix = '.snap')
+    os.close(fd)
+    try:
+        t0 = time.time()
+        ExportSnapshot(storage.db, fname)
+        exportTime = time.time() - t0
+        t0 = time.time()
+        snapshot = OpenSnapshot(fname)
+        openTime = time.time() - t0
+
+        classes = max(count / MEMBERS_PER_CLASS, 1)
+        scopeArgs = []
+        pathArgs = []
+        for i in xrange(rounds):
+            cls = (i * 7919) % classes
+            scopes = [GenScope(cls), GenScope(cls / CLASSES_PER_NS),
+                      'ns%d' % (cls / CLASSES_PER_NS), '<global>']
+            scopeArgs.append((scopes, 'get', True))
+            idx = (i * 7919) % count
+            pathArgs.append(('%s::Get%s_%d' % (GenScope(idx / MEMBERS_PER_CLASS),
+                                               'Value', idx | 1), ))
+
+        print '%-32s %12s %12s %8s' % ('snapshot', 'sql(us)', 'mmap(us)',
+                                       'speedup')
+        for name, args in (('GetOrderedTagsByScopesAndName', scopeArgs),
+                           ('GetTagsByPath', pathArgs)):
+            sqlTime, sqlCount = _Measure(getattr(storage, name), args)
+            snapTime, snapCount = _Measure(getattr(snapshot, name), args)
+            if sqlCount != snapCount:
+                print '%s: result mismatch %d != %d' % (name, sqlCount,
+                                                        snapCount)
+            print '%-32s %12.1f %12.1f %7.2fx' % (name, sqlTime, snapTime,
+                                                 sqlTime / snapTime)
+        print '%-32s %12.1f' % ('(export, ms)', exportTime * 1000.0)
+        print '%-32s %12.1f' % ('(open, ms)', openTime * 1000.0)
+        print '%-32s %12d' % ('(size, KB)', os.path.getsize(fname) / 1024)
+        snapshot.Close()
+    finally:
+        os.remove(fname)
+
+class LegacyTagEntry:
+    '''原来的 TagEntry 的存储方式: 实例字典加上每行一个 exts 字典'''
+    pass
+
+def LegacyFromRow(row):
+    entry = LegacyTagEntry()
+    entry.id = row[0]
+    entry.name = row[1]
+    entry.file = row[2]
+    entry.fileid = int(row[3])
+    entry.line = int(row[4])
+    entry.kind = row[5]
+    entry.scope = row[6]
+    entry.extra = row[11]
+    entry.exts = {}
+    for idx, key in ((7, 'parent_kind'), (8, 'access'), (9, 'inherits'),
+                     (10, 'signature')):
+        if row[idx]:
+            entry.exts[key] = row[idx]
+    return entry
+
+def _EntrySize(entry):
+    '''一个标签对象占用的字节数, 不包括共享的字符串'''
+    size = sys.getsizeof(entry)
+    if isinstance(entry, LegacyTagEntry):
+        return size + sys.getsizeof(entry.__dict__) + sys.getsizeof(entry.exts)
+    for value in (entry._exts, entry._extRow):
+        if value is not None:
+            size += sys.getsizeof(value)
+    return size
+
+def BenchTagEntry(storage, fetch = 10000, rounds = 5):
+    '''对比原来的和 __slots__ 的 TagEntry 的创建耗时, 内存和转为补全项目的耗时'''
+    rows = storage.db.execute("SELECT * FROM TAGS LIMIT ?", (fetch, )).fetchall()
+    print '%-32s %12s %12s %8s' % ('tag entry (%d rows)' % len(rows),
+                                   'legacy', 'slots', 'ratio')
+
+    t0 = time.time()
+    for i in xrange(rounds):
+        legacy = [LegacyFromRow(row) for row in rows]
+    t1 = time.time()
+    for i in xrange(rounds):
+        entries = [storage.FromSQLite3ResultSet(row) for row in rows]
+    t2 = time.time()
+    legacyTime = (t1 - t0) * 1000.0 / rounds
+    slotsTime = (t2 - t1) * 1000.0 / rounds
+    print '%-32s %12.1f %12.1f %7.2fx' % ('create (ms)', legacyTime, slotsTime,
+                                         legacyTime / slotsTime)
+
+    legacySize = sum(_EntrySize(entry) for entry in legacy) / 1024
+    slotsSize = sum(_EntrySize(entry) for entry in entries) / 1024
+    print '%-32s %12d %12d %7.2fx' % ('memory (KB)', legacySize, slotsSize,
+                                     legacySize * 1.0 / slotsSize)
+
+    # 原来需要先转为 tag 字典
+    t0 = time.time()
+    for i in xrange(rounds):
+        tags = [TagEntry2Tag(entry) for entry in entries]
+    t1 = time.time()
+    for i in xrange(rounds):
+        items = [entry.ToComplItem() for entry in entries]
+    t2 = time.time()
+    dictTime = (t1 - t0) * 1000.0 / rounds
+    itemTime = (t2 - t1) * 1000.0 / rounds
+    print '%-32s %12.1f %12.1f %7.2fx' % ('to compl item (ms)', dictTime,
+                                         itemTime, dictTime / itemTime)
+
+def LegacyMemberComplItems(storage, scopes, name):
+    '''原来的成员补全: 取出整行, 建立 TagEntry, 转为 tag 字典, 再转为补全项目'''
+    items = []
+    for tag in storage.GetRankedTagsByScopesAndName(scopes, name,
+                                                    excludeKinds = ['t', 's',
+                                                                    'c'],
+                                                    skipCtorDtor = True,
+                                                    shadow = True):
+        tag = TagEntry2Tag(tag)
+        menu = {'public': '+', 'protected': '#',
+                'private': '-'}.get(tag.get('access'), '') + ' ' + tag['parent']
+        word = tag['name']
+        if tag['kind'] in ('f', 'p'):
+            word += '()'
+        items.append({'word': word, 'menu': menu, 'kind': tag['kind'],
+                      'icase': 1, 'dup': 0})
+    return items
+
+def MemberComplItems(storage, scopes, name):
+    return ComplRows2Items(storage.IterRankedComplRows(scopes, name,
+                                                       excludeKinds = ['t', 's',
+                                                                       'c'],
+                                                       skipCtorDtor = True,
+                                                       shadow = True))
+
+def BenchComplItems(storage, count, rounds = 200):
+    '''对比成员补全的两种获取补全项目的方式, 每次取一个类和它的"基类"的全部成员'''
+    classes = max(count / MEMBERS_PER_CLASS, 1)
+    args = []
+    for i in xrange(rounds):
+        cls = (i * 7919) % classes
+        scopes = [GenScope(cls), GenScope((cls + 1) % classes),
+                  GenScope((cls + 2) % classes)]
+        args.append((storage, scopes, ''))
+    storage.SetUseCache(False)
+    legacyTime, legacyCount = _Measure(LegacyMemberComplItems, args)
+    directTime, directCount = _Measure(MemberComplItems, args)
+    storage.SetUseCache(True)
+    if legacyCount != directCount:
+        print 'ComplItems: result mismatch %d != %d' % (legacyCount,
+                                                       directCount)
+    print '%-32s %12s %12s %8s' % ('member compl items', 'tags(us)',
+                                   'direct(us)', 'speedup')
+    print '%-32s %12.1f %12.1f %7.2fx' % ('%d items' % (directCount / rounds),
+                                         legacyTime, directTime,
+                                         legacyTime / directTime)
+
+def LegacyStore(storage, lines):
+    '''原来的逐行 InsertTagEntry() 的方式'''
+    storage.Begin()
+    for tagEntry in TagLinesToEntries(lines):
+        storage.InsertTagEntry(tagEntry)
+    storage.Commit()
+
+def BulkStore(storage, lines):
+    '''ParseFilesAndStore() 初次导入的方式'''
+    initialLoad = storage.BeginBulkLoad()
+    storage.StoreLines(lines)
+    if initialLoad:
+        storage.EndBulkLoad()
+
+def BenchStore(count):
+    '''对比逐行插入和批量导入(包括重建索引)的吞吐量(tags/s)
+    两者都包括解析 ctags 输出, 解析本身的吞吐量单独列出'''
+    lines = list(GenTagLines(count))
+    t0 = time.time()
+    for tagEntry in TagLinesToEntries(lines):
+        pass
+    print '%-32s %12s' % ('parse + store', 'tags/s')
+    print '%-32s %12.0f' % ('(parse ctags lines only)',
+                            count / (time.time() - t0))
+    for name, func in (('InsertTagEntry', LegacyStore),
+                       ('StoreLines + bulk load', BulkStore)):
+        fd, fname = tempfile.mkstemp(suffix = '.vltags')
+        os.close(fd)
+        try:
+            storage = TagsStorageSQLite()
+            storage.OpenDatabase(fname)
+            t0 = time.time()
+            func(storage, lines)
+            elapsed = time.time() - t0
+            total = storage.Query("select count(*) from tags").fetchone()[0]
+            if total != count:
+                print '%s: stored %d != %d' % (name, total, count)
+            print '%-32s %12.0f' % (name, count / elapsed)
+            storage.CloseDatabase()
+        finally:
+            CONNECTION_POOL.Invalidate(os.path.realpath(fname))
+            os.remove(fname)
+
+def BenchOpen(fname, rounds = 500):
+    '''打开并关闭数据库的耗时, 对比每次新建连接和使用连接池'''
+    print '%-32s %12s' % ('open + close', 'us/open')
+    for pooled in (False, True):
+        t0 = time.time()
+        for i in xrange(rounds):
+            storage = TagsStorageSQLite(pooled = pooled)
+            storage.OpenDatabase(fname)
+            storage.CloseDatabase()
+        elapsed = time.time() - t0
+        print '%-32s %12.1f' % (pooled and 'pooled' or 'connect',
+                                elapsed / rounds * 1000000.0)
+
+def _StressWriter(fname, wal, count, stop, result):
+    '''不断地修改一个类的标签的行号并提交, 模拟保存文件后的重新 parse'''
+    storage = TagsStorageSQLite(wal = wal)
+    storage.OpenDatabase(fname)
+    fnames = ['/src/dir%d/file%d.hpp' % (cls / 100, cls)
+              for cls in xrange(max(count / MEMBERS_PER_CLASS, 1))]
+    i = 0
+    while not stop.is_set():
+        fname = fnames[(i * 7919) % len(fnames)]
+        tagEntries = storage.GetTagsByFiles([fname])
+        for tagEntry in tagEntries:
+            tagEntry.line += 1
+        try:
+            storage.Begin()
+            storage.DiffStoreTagEntries(fname, tagEntries)
+            # 流式入库的时候, 事务在 ctags 运行期间一直是打开的
+            time.sleep(0.005)
+            storage.db.commit()
+            result['writes'] += 1
+        except sqlite3.OperationalError:
+            storage.Rollback()
+            result['writeErrors'] += 1
+        i += 1
+    storage.CloseDatabase()
+
+def _StressReader(fname, wal, count, stop, result):
+    storage = TagsStorageSQLite(wal = wal, readOnly = True, busyTimeout = 0.2)
+    storage.OpenDatabase(fname)
+    sql = "select * from tags where scope = ? and name like ? ESCAPE '^'"
+    classes = max(count / MEMBERS_PER_CLASS, 1)
+    i = 0
+    while not stop.is_set():
+        t0 = time.time()
+        try:
+            # 直接执行, DoFetchTags() 会吞掉锁错误
+            storage.db.execute(sql, (GenScope(i % classes), 'Get%')).fetchall()
+            result['reads'] += 1
+        except sqlite3.OperationalError:
+            result['readErrors'] += 1
+        result['maxReadMs'] = max(result['maxReadMs'],
+                                  (time.time() - t0) * 1000.0)
+        i += 1
+    storage.CloseDatabase()
+
+def BenchConcurrent(count, seconds = 3.0, readers = 2):
+    '''一个线程写入, 多个线程同时查询, 对比回滚日志模式和 WAL 模式'''
+    print '%-8s %8s %8s %8s %8s %12s' % ('mode', 'writes', 'wErrors',
+                                          'reads', 'rErrors', 'maxRead(ms)')
+    for wal in (False, True):
+        fd, fname = tempfile.mkstemp(suffix = '.vltags')
+        os.close(fd)
+        try:
+            CreateDatabase(fname, count, wal).CloseDatabase()
+            stop = threading.Event()
+            result = {'writes': 0, 'writeErrors': 0, 'reads': 0,
+                      'readErrors': 0, 'maxReadMs': 0.0}
+            threads = [threading.Thread(target = _StressWriter,
+                                        args = (fname, wal, count, stop,
+                                                result))]
+            for i in xrange(readers):
+                threads.append(threading.Thread(target = _StressReader,
+                                                args = (fname, wal, count,
+                                                        stop, result)))
+            for t in threads:
+                t.start()
+            time.sleep(seconds)
+            stop.set()
+            for t in threads:
+                t.join()
+            print '%-8s %8d %8d %8d %8d %12.1f' % (
+                wal and 'wal' or 'journal', result['writes'],
+                result['writeErrors'], result['reads'], result['readErrors'],
+                result['maxReadMs'])
+        finally:
+            CONNECTION_POOL.Invalidate(os.path.realpath(fname))
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(fname + suffix):
+                    os.remove(fname + suffix)
+
+def main(argv):
+    count = 200000
+    if len(argv) > 1:
+        count = int(argv[1])
+
+    fd, fname = tempfile.mkstemp(suffix = '.vltags')
+    os.close(fd)
+    try:
+        t0 = time.time()
+        storage = CreateDatabase(fname, count)
+        print 'create database with %d tags: %.2fs' % (count, time.time() - t0)
+        BenchQuery(storage, count)
+        BenchSymbolIndex(storage, count)
+        BenchSnapshot(storage, count)
+        BenchTagEntry(storage)
+        BenchComplItems(storage, count)
+        storage.CloseDatabase()
+        BenchOpen(fname)
+    finally:
+        CONNECTION_POOL.Invalidate(os.path.realpath(fname))
+        os.remove(fname)
+
+    BenchStore(count)
+    BenchConcurrent(count)
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    if ret is None:
+        ret = 0
+    sys.exit(ret)
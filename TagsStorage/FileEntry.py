@@ -7,4 +7,37 @@ class FileEntry:
         self.file = ''
         # 最近 parse 的时间, 单位是秒
         self.tagtime = 0
+        # parse 之前的文件状态, 用于判断文件是否改变
+        self.size = 0
+        self.mtime_ns = 0
+        self.hash = ''          # 文件内容的散列值, 空表示未知
 
+    def GetId(self):
+        return self.id
+    def SetId(self, id):
+        self.id = id
+
+    def GetFile(self):
+        return self.file
+    def SetFile(self, file):
+        self.file = file
+
+    def GetLastRetaggedTimestamp(self):
+        return self.tagtime
+    def SetLastRetaggedTimestamp(self, tagtime):
+        self.tagtime = tagtime
+
+    def GetSize(self):
+        return self.size
+    def SetSize(self, size):
+        self.size = size
+
+    def GetMtimeNs(self):
+        return self.mtime_ns
+    def SetMtimeNs(self, mtime_ns):
+        self.mtime_ns = mtime_ns
+
+    def GetHash(self):
+        return self.hash
+    def SetHash(self, hash):
+        self.hash = hash
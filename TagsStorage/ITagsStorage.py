@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- encoding:utf-8 -*-
 
+from TagsStorageCache import TagsStorageCache
 
 
 class ITagsStorage:
@@ -18,6 +19,7 @@ class ITagsStorage:
         self.singleSearchLimit = 1000
         self.maxWorkspaceTagToColour = 1000
         self.useCache = False
+        self.cache = TagsStorageCache()
 
     def SetUseCache(self, useCache):
         self.useCache = useCache
@@ -25,6 +27,9 @@ class ITagsStorage:
     def GetUseCache(self):
         return self.useCache
 
+    def GetCacheStats(self):
+        return self.cache.GetStats()
+
     def GetDatabaseFileName(self):
         return self.fileName
 
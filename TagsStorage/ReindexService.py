@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+保存文件后在后台重新 parse 的服务
+
+* 同一个文件在 delay 秒内多次保存, 只 parse 一次(防抖)
+* 到期的文件合并为一批, 只运行一次 ParseFilesAndStore()
+* 还没开始的请求可以取消, 被新的保存代替的请求自动丢弃
+* 使用自己的数据库连接, 补全不需要等待 parse 完成
+'''
+
+import os.path
+import time
+import threading
+
+from TagsStorageSQLite import TagsStorageSQLite
+from TagsStorageSQLite import ParseFilesAndStore
+
+# 同一进程中同时只允许一个线程写数据库
+WRITER_LOCK = threading.Lock()
+
+class ReindexService(threading.Thread):
+    def __init__(self, dbFile, macrosFiles = [], delay = 0.5, jobs = 1,
+                 PostCallback = None, wal = False):
+        '''
+        PostCallback(files, touched) 在每批 parse 完成后在服务线程中调用,
+        touched 为 ParseFilesAndStore() 的返回值
+        wal 为真时使用 WAL 模式, 补全线程读取时不会被阻塞'''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = 'Videm-Reindex-' + self.name
+
+        self.dbFile = dbFile
+        self.macrosFiles = macrosFiles
+        self.delay = delay
+        self.jobs = jobs
+        self.PostCallback = PostCallback
+        self.wal = wal
+
+        self.cond = threading.Condition()
+        # {文件: 到期时间}, 重复保存会推迟到期时间
+        self.pending = {}
+        self.busy = False
+        self.stopped = False
+
+        self.stats = {
+            'requests': 0,
+            'debounced': 0,
+            'cancelled': 0,
+            'batches': 0,
+            'files': 0,
+            'touched': 0,
+        }
+
+    def Request(self, files, macrosFiles = None, delay = None):
+        '''请求重新 parse files, 立即返回
+        macrosFiles 和 delay 不为 None 时代替之前的设置, 之后的每批都使用新的'''
+        with self.cond:
+            if macrosFiles is not None:
+                self.macrosFiles = macrosFiles
+            if delay is not None:
+                self.delay = delay
+            deadline = time.time() + self.delay
+            for f in files:
+                f = os.path.abspath(f)
+                if f in self.pending:
+                    self.stats['debounced'] += 1
+                self.pending[f] = deadline
+            self.stats['requests'] += 1
+            self.cond.notify()
+
+    def Cancel(self, files = None):
+        '''取消还没开始的请求, files 为 None 时取消全部'''
+        with self.cond:
+            if files is None:
+                count = len(self.pending)
+                self.pending.clear()
+            else:
+                count = 0
+                for f in files:
+                    if self.pending.pop(os.path.abspath(f), None) is not None:
+                        count += 1
+            self.stats['cancelled'] += count
+
+    def Stop(self, wait = True):
+        '''停止服务, 丢弃还没开始的请求, 正在进行的一批会完成'''
+        with self.cond:
+            self.stopped = True
+            self.pending.clear()
+            self.cond.notify()
+        if wait and self.is_alive():
+            self.join()
+
+    def IsIdle(self):
+        with self.cond:
+            return not self.pending and not self.busy
+
+    def GetStats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats['pending'] = len(self.pending)
+            return stats
+
+    def _NextBatch(self):
+        '''等待到有文件到期, 返回 (全部已经到期的文件, macrosFiles),
+        停止时返回 None'''
+        with self.cond:
+            self.busy = False
+            while True:
+                if self.stopped:
+                    return None
+                if not self.pending:
+                    self.cond.wait()
+                    continue
+                now = time.time()
+                due = min(self.pending.itervalues())
+                if due > now:
+                    self.cond.wait(due - now)
+                    continue
+                batch = [f for f, d in self.pending.iteritems() if d <= now]
+                for f in batch:
+                    del self.pending[f]
+                self.busy = True
+                return batch, self.macrosFiles
+
+    def run(self):
+        storage = None
+        while True:
+            item = self._NextBatch()
+            if item is None:
+                break
+            batch, macrosFiles = item
+
+            touched = {}
+            with WRITER_LOCK:
+                try:
+                    if storage is None:
+                        storage = TagsStorageSQLite(wal = self.wal)
+                        storage.OpenDatabase(self.dbFile)
+                    # 内容没有改变的文件会被跳过, 所以重复的请求代价很小
+                    touched = ParseFilesAndStore(storage, batch,
+                                                 macrosFiles,
+                                                 filterNotNeed = True,
+                                                 onlyCpp = True,
+                                                 jobs = self.jobs)
+                except:
+                    # NOTE: 在 vim 里面不能随便打印
+                    pass
+
+            with self.cond:
+                self.stats['batches'] += 1
+                self.stats['files'] += len(batch)
+                self.stats['touched'] += sum(touched.itervalues())
+
+            if self.PostCallback:
+                try:
+                    self.PostCallback(batch, touched)
+                except:
+                    pass
+
+        if storage:
+            storage.CloseDatabase()
+
+def test():
+    service = ReindexService(':memory:', delay = 0.1)
+    service.start()
+    for i in range(5):
+        service.Request(['a.cpp', 'b.cpp'])
+    service.Request(['c.cpp'], ['macros.h'], 0.2)
+    assert service.macrosFiles == ['macros.h'] and service.delay == 0.2
+    service.Cancel(['c.cpp'])
+    while not service.IsIdle():
+        time.sleep(0.05)
+    service.Stop()
+    stats = service.GetStats()
+    assert stats['batches'] == 1 and stats['files'] == 2
+    assert stats['debounced'] == 8 and stats['cancelled'] == 1
+    print stats
+
+if __name__ == '__main__':
+    test()
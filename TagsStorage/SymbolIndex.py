@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+TAGS 表的内存索引, 用于补全时的 作用域 + 名字前缀 查询
+
+* 一次性载入 TAGS 表, 按列保存在 array 中, 字符串全部驻留为整数 id
+* 每个作用域的名字排序后二分查找前缀, 排序是第一次查询这个作用域时进行的
+* 本连接的修改以文件为单位增量更新, 被修改的文件由 MarkFiles() 登记,
+  下次查询前重新载入
+* 其他连接提交的修改通过 PRAGMA data_version 检测, 无法知道修改了哪些文件,
+  只能全部重新载入, 所以结果永远不会比数据库旧
+
+匹配规则与 SQL 相同: 前缀匹配默认不区分 ASCII 大小写(icase),
+完全匹配区分大小写, 结果按名字升序排序
+'''
+
+import threading
+import bisect
+from array import array
+
+from TagEntry import TagEntry
+from TagsStorageSQLite import SplitInParams
+
+# 载入的列, 顺序与 TAGS 表相同, 不包括 path
+LOAD_SQL = "SELECT id, name, file, fileid, line, kind, scope, parent_kind, "\
+        "access, inherits, signature, extra FROM TAGS"
+
+# 需要驻留的列在 LOAD_SQL 中的下标和 TagEntry 扩展域的名字
+EXT_FIELDS = (
+    (7, 'parent_kind'),
+    (8, 'access'),
+    (9, 'inherits'),
+    (10, 'signature'),
+)
+
+# 一次增量更新的文件超过已知文件的这个比例(且不少于 RELOAD_MIN_FILES)的话,
+# 直接全部重新载入
+RELOAD_RATIO = 0.3
+RELOAD_MIN_FILES = 64
+
+def LowerName(name):
+    '''LIKE 只对 ASCII 字符不区分大小写, python2 的 str.lower() 也是如此'''
+    return name.lower()
+
+class SymbolIndex(object):
+    def __init__(self):
+        self.loaded = False
+        self.dataVersion = None
+
+        # 需要重新载入的文件, 可以在其他线程登记
+        self.lock = threading.Lock()
+        self.pendingFiles = set()
+        self.pendingAll = True
+
+        self.stats = {
+            'loads': 0,
+            'deltas': 0,
+            'stale': 0,
+            'queries': 0,
+        }
+
+        self.Clear()
+
+    def Clear(self):
+        # 驻留的字符串, id 即下标
+        self.strings = []
+        self.stringIds = {}
+
+        # 列, 每行一个元素, 字符串列保存的是驻留 id
+        self.ids = array('l')
+        self.names = array('l')
+        self.files = array('l')
+        self.fileids = array('l')
+        self.lines = array('l')
+        self.kinds = array('l')
+        self.scopes = array('l')
+        self.extras = array('l')
+        self.exts = [array('l') for idx, key in EXT_FIELDS]
+        # 行是否有效, 删除的行只做标记
+        self.alive = bytearray()
+        self.dead = 0
+
+        # {文件 id: [行, ...]}, {作用域 id: [行, ...]}, 可能包含已删除的行
+        self.fileRows = {}
+        self.scopeRows = {}
+        # {作用域 id: (小写名字列表, 行列表)}, 第一次查询时建立
+        self.scopeSorted = {}
+        self.loaded = False
+
+    def __len__(self):
+        return len(self.alive) - self.dead
+
+    def Intern(self, string):
+        sid = self.stringIds.get(string)
+        if sid is None:
+            sid = len(self.strings)
+            self.strings.append(string)
+            self.stringIds[string] = sid
+        return sid
+
+    def MarkFiles(self, files):
+        '''登记被修改的文件, 线程安全'''
+        with self.lock:
+            self.pendingFiles.update(files)
+
+    def MarkAll(self):
+        '''下次查询前全部重新载入, 线程安全'''
+        with self.lock:
+            self.pendingAll = True
+            self.pendingFiles.clear()
+
+    def GetStats(self):
+        stats = dict(self.stats)
+        stats['rows'] = len(self)
+        stats['strings'] = len(self.strings)
+        stats['sortedScopes'] = len(self.scopeSorted)
+        return stats
+
+    def _AppendRows(self, rows):
+        intern = self.Intern
+        for row in rows:
+            r = len(self.alive)
+            self.ids.append(row[0])
+            self.names.append(intern(row[1]))
+            fid = intern(row[2])
+            self.files.append(fid)
+            self.fileids.append(row[3] or 0)
+            self.lines.append(row[4] or 0)
+            self.kinds.append(intern(row[5]))
+            sid = intern(row[6])
+            self.scopes.append(sid)
+            self.extras.append(intern(row[11]))
+            for col, (idx, key) in zip(self.exts, EXT_FIELDS):
+                col.append(intern(row[idx]))
+            self.alive.append(1)
+
+            self.fileRows.setdefault(fid, []).append(r)
+            self.scopeRows.setdefault(sid, []).append(r)
+            # 这个作用域需要重新排序
+            self.scopeSorted.pop(sid, None)
+
+    def Load(self, db):
+        '''从 sqlite3 的连接载入全部标签'''
+        self.Clear()
+        self._AppendRows(db.execute(LOAD_SQL))
+        self.loaded = True
+        self.pendingAll = False
+        self.stats['loads'] += 1
+
+    def ApplyFileDelta(self, db, files):
+        '''重新载入 files 的标签'''
+        for f in files:
+            fid = self.stringIds.get(f)
+            if fid is None:
+                continue
+            for r in self.fileRows.pop(fid, ()):
+                if self.alive[r]:
+                    self.alive[r] = 0
+                    self.dead += 1
+                    self.scopeSorted.pop(self.scopes[r], None)
+
+        for qmarks, params in SplitInParams(files):
+            # IN 语句中填充的重复参数不会造成重复的行
+            self._AppendRows(db.execute(LOAD_SQL + " WHERE file IN " + qmarks,
+                                        params))
+        self.stats['deltas'] += 1
+
+        # 删除的行太多的话重新载入, 顺便回收空间
+        if self.dead > len(self.alive) / 2:
+            self.Load(db)
+
+    def Sync(self, db):
+        '''查询前调用, 应用登记的修改
+        返回 False 表示索引比数据库旧, 不能使用(目前总是返回 True)'''
+        try:
+            row = db.execute("PRAGMA data_version").fetchone()
+            dataVersion = row and row[0]
+        except Exception:
+            dataVersion = None
+
+        with self.lock:
+            pendingAll = self.pendingAll
+            pending = self.pendingFiles
+            self.pendingAll = False
+            self.pendingFiles = set()
+
+        if self.loaded and dataVersion != self.dataVersion:
+            # 其他连接提交了修改, 即使有登记, 中间也可能有没有登记的提交,
+            # 只有全部重新载入才能保证不丢失修改
+            self.stats['stale'] += 1
+            pendingAll = True
+
+        if not self.loaded or pendingAll or len(pending) > \
+                max(len(self.fileRows) * RELOAD_RATIO, RELOAD_MIN_FILES):
+            self.Load(db)
+            self.dataVersion = dataVersion
+            return True
+
+        if pending:
+            # 本连接的修改不会改变 data_version
+            self.ApplyFileDelta(db, sorted(pending))
+        return True
+
+    def _SortedScope(self, sid):
+        result = self.scopeSorted.get(sid)
+        if result is None:
+            alive = self.alive
+            rows = [r for r in self.scopeRows.get(sid, ()) if alive[r]]
+            # 顺便清理已删除的行
+            self.scopeRows[sid] = rows
+            strings = self.strings
+            names = self.names
+            rows.sort(key = lambda r: (LowerName(strings[names[r]]), r))
+            result = ([LowerName(strings[names[r]]) for r in rows], rows)
+            self.scopeSorted[sid] = result
+        return result
+
+    def MakeTagEntry(self, r):
+        '''与 TagsStorageSQLite.FromSQLite3ResultSet() 的结果相同'''
+        strings = self.strings
+        entry = TagEntry()
+        entry.id = self.ids[r]
+        entry.name = strings[self.names[r]]
+        entry.file = strings[self.files[r]]
+        entry.fileid = self.fileids[r]
+        entry.line = self.lines[r]
+        entry.kind = strings[self.kinds[r]]
+        entry.scope = strings[self.scopes[r]]
+        entry.extra = strings[self.extras[r]]
+        # EXT_FIELDS 的顺序与 EXT_ROW_FIELDS 相同
+        entry.SetExtRow(tuple([strings[col[r]] for col in self.exts]))
+        return entry
+
+    def GetOrderedTagsByScopesAndName(self, scopes, name, partialMatch = False,
+                                      limit = 1000, icase = True):
+        '''获取按名字升序排序后的 tags, 需要先调用 Sync()
+        icase 只影响前缀匹配'''
+        self.stats['queries'] += 1
+        lowerName = LowerName(name)
+        strings = self.strings
+        names = self.names
+        result = []
+        for scope in set(scopes):
+            sid = self.stringIds.get(scope)
+            if sid is None or sid not in self.scopeRows:
+                continue
+            keys, rows = self._SortedScope(sid)
+            lo = bisect.bisect_left(keys, lowerName)
+            for i in xrange(lo, len(keys)):
+                if not keys[i].startswith(lowerName):
+                    break
+                r = rows[i]
+                if partialMatch:
+                    if icase or strings[names[r]].startswith(name):
+                        result.append(r)
+                elif strings[names[r]] == name:
+                    result.append(r)
+                elif keys[i] != lowerName:
+                    # 完全匹配只需要检查小写相同的部分
+                    break
+
+        result.sort(key = lambda r: (strings[names[r]], r))
+        return [self.MakeTagEntry(r) for r in result[:limit]]
+
+def test():
+    from TagsStorageSQLite import TagsStorageSQLite
+    storage = TagsStorageSQLite()
+    storage.OpenDatabase(':memory:')
+    lines = [
+        'GetX\ta.h\t/^x$/;"\tp\tline:1\tclass:NsA::C\taccess:public\tsignature:()',
+        'getY\ta.h\t/^x$/;"\tp\tline:2\tclass:NsA::C\taccess:public\tsignature:()',
+        'Get_Z\tb.h\t/^x$/;"\tm\tline:3\tclass:NsA::C\taccess:private',
+        'GetX\tb.h\t/^x$/;"\tm\tline:4\tclass:NsB\taccess:public',
+        'Other\tb.h\t/^x$/;"\tm\tline:5\tclass:NsA::C\taccess:public',
+    ]
+    storage.StoreLines(lines)
+
+    index = storage.EnableSymbolIndex()
+    def Fields(t):
+        return (t.id, t.name, t.file, t.fileid, t.line, t.kind, t.scope,
+                t.extra, sorted(t.exts.items()))
+    def Check(scopes, name, partialMatch, icase = True):
+        got = storage.GetOrderedTagsByScopesAndName(scopes, name, partialMatch,
+                                                    icase)
+        storage.symbolIndex = None
+        want = storage.GetOrderedTagsByScopesAndName(scopes, name,
+                                                     partialMatch, icase)
+        storage.symbolIndex = index
+        assert map(Fields, got) == map(Fields, want), \
+                (scopes, name, partialMatch)
+        return got
+
+    assert len(Check(['NsA::C'], 'get', True)) == 3
+    assert len(Check(['NsA::C'], 'Get', True, False)) == 2
+    assert len(Check(['NsA::C', 'NsB'], 'GetX', False)) == 2
+    assert len(Check(['NsA::C'], 'getx', False)) == 0
+    assert len(Check(['NsA::C'], 'Get_', True)) == 1
+    assert len(Check(['None'], '', True)) == 0
+
+    # 增量更新 b.h
+    storage.DiffStoreLines(
+        ['GetW\tb.h\t/^x$/;"\tm\tline:3\tclass:NsA::C\taccess:private'],
+        ['b.h'])
+    assert [t.name for t in Check(['NsA::C'], '', True)] \
+            == ['GetW', 'GetX', 'getY']
+    assert index.stats['deltas'] == 1 and index.stats['loads'] == 1
+
+    # 其他连接的提交, 即使只登记了部分文件也要全部重新载入
+    import os, sqlite3, tempfile
+    fd, dbFile = tempfile.mkstemp(suffix = '.db')
+    os.close(fd)
+    try:
+        storage = TagsStorageSQLite()
+        storage.OpenDatabase(dbFile)
+        storage.StoreLines(lines)
+        index = storage.EnableSymbolIndex()
+        assert len(Check(['NsA::C'], 'get', True)) == 3
+        other = TagsStorageSQLite()
+        other.OpenDatabase(dbFile)
+        other.DiffStoreLines(
+            ['GetV\tb.h\t/^x$/;"\tm\tline:3\tclass:NsA::C\taccess:public'],
+            ['b.h'])
+        other.DiffStoreLines(
+            ['GetU\ta.h\t/^x$/;"\tm\tline:1\tclass:NsA::C\taccess:public'],
+            ['a.h'])
+        index.MarkFiles(['b.h'])
+        assert [t.name for t in Check(['NsA::C'], 'get', True)] \
+                == ['GetU', 'GetV']
+        assert index.stats['stale'] == 1 and index.stats['loads'] == 2
+        other.CloseDatabase()
+        storage.CloseDatabase()
+    finally:
+        os.remove(dbFile)
+    print index.GetStats()
+
+if __name__ == '__main__':
+    test()
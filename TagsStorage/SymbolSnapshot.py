@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+只读的二进制标签快照, 用 mmap 打开, 多个进程共享同一份页缓存
+
+由 ExportSnapshot() 从数据库导出, 先写临时文件再改名, 读取者不会看到
+写了一半的文件. 已经打开的读取者继续使用旧的文件, 调用 Refresh() 切换.
+
+文件格式, 除了头部的数据库签名之外全部为小端的 32 位整数:
+    头部            HEADER_FORMAT
+    字符串偏移表    (字符串数 + 1) 个偏移, 相对于字符串数据
+    字符串数据      按字节序排序, 所以字符串 id 的大小关系就是字符串的大小关系
+    记录            每个标签 RECORD_FIELDS 个整数, 字符串列为字符串 id
+    path 索引       (path, 记录号), 升序
+    scope 索引      (scope, 小写的 name, 记录号), 升序
+    name 索引       (小写的 name, 记录号), 升序
+
+前缀匹配的规则与 SQL 相同, 见 SymbolIndex
+
+注意读取并不是零拷贝的: 查找时按需从 mmap 中解出整数元组, 读取过的字符串
+复制为 Python 字符串并缓存, 结果再构造为 TagEntry. 省掉的是打开时把全部
+标签载入内存的开销, 而不是每次查询的对象分配
+'''
+
+import os
+import sys
+import mmap
+import struct
+import bisect
+import tempfile
+from array import array
+
+from TagEntry import TagEntry
+
+SNAPSHOT_MAGIC = 'VLTSNAP\0'
+SNAPSHOT_VERSION = 1
+
+# 魔数, 格式版本, 数据库版本, 字符串数, 记录数, 数据库签名(4 个, 64 位),
+# 各部分的偏移(6 个)
+HEADER_FORMAT = '<8s' + 'i' * 4 + 'q' * 4 + 'i' * 6
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# 记录的字段, 除了 id, fileid, line 之外都是字符串 id
+RECORD_FIELDS = ('id', 'name', 'file', 'fileid', 'line', 'kind', 'scope',
+                 'parent_kind', 'access', 'inherits', 'signature', 'extra',
+                 'path', 'lname')
+INT_FIELDS = set(['id', 'fileid', 'line'])
+
+EXPORT_SQL = "SELECT id, name, file, fileid, line, kind, scope, parent_kind, "\
+        "access, inherits, signature, extra, path FROM TAGS"
+
+# 用于判断快照是否和数据库一致, 文件重新 parse 之后它的状态一定改变了
+# 取模是为了求和的时候不会溢出
+SIGNATURE_SQL = "SELECT (SELECT count(*) FROM TAGS), "\
+        "(SELECT max(id) FROM TAGS), (SELECT max(tagtime) FROM FILES), "\
+        "(SELECT sum(mtime_ns % 1000000007 + size) FROM FILES)"
+
+# 标签的扩展域在记录中的下标
+EXT_FIELDS = [(RECORD_FIELDS.index(key), key)
+              for key in ('parent_kind', 'access', 'inherits', 'signature')]
+
+def SnapshotFileName(dbFile):
+    return dbFile + '.snap'
+
+def GetSignature(db):
+    '''数据库的 (标签数, 最大的标签 id, 最大的 tagtime, 文件状态之和)'''
+    row = db.execute(SIGNATURE_SQL).fetchone()
+    return tuple(int(v or 0) for v in row)
+
+def _ToLE(arr):
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+def ExportSnapshot(db, fname, storageVersion = 0):
+    '''把 sqlite3 连接 db 的 TAGS 表导出到 fname, 成功返回 True'''
+    signature = GetSignature(db)
+    rows = []
+    strings = set([''])
+    for row in db.execute(EXPORT_SQL):
+        row = [v if v is not None else '' for v in row]
+        row.append(row[1].lower())
+        rows.append(row)
+        strings.update(row[i] for i in (1, 2, 5, 6, 7, 8, 9, 10, 11, 12, 13))
+
+    strings = sorted(strings)
+    stringIds = dict((s, i) for i, s in enumerate(strings))
+
+    offsets = array('i', [0])
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+
+    records = array('i')
+    for row in rows:
+        for i, field in enumerate(RECORD_FIELDS):
+            if field in INT_FIELDS:
+                records.append(int(row[i] or 0))
+            else:
+                records.append(stringIds[row[i]])
+
+    n = len(RECORD_FIELDS)
+    def Column(field):
+        i = RECORD_FIELDS.index(field)
+        return records[i::n]
+    paths, scopes, lnames = Column('path'), Column('scope'), Column('lname')
+
+    pathIndex = array('i')
+    for r in sorted(xrange(len(rows)), key = lambda r: (paths[r], r)):
+        pathIndex.extend((paths[r], r))
+    scopeIndex = array('i')
+    for r in sorted(xrange(len(rows)),
+                    key = lambda r: (scopes[r], lnames[r], r)):
+        scopeIndex.extend((scopes[r], lnames[r], r))
+    nameIndex = array('i')
+    for r in sorted(xrange(len(rows)), key = lambda r: (lnames[r], r)):
+        nameIndex.extend((lnames[r], r))
+
+    blob = ''.join(strings)
+    parts = [_ToLE(offsets), blob, _ToLE(records), _ToLE(pathIndex),
+             _ToLE(scopeIndex), _ToLE(nameIndex)]
+    sectionOffsets = []
+    pos = HEADER_SIZE
+    for part in parts:
+        sectionOffsets.append(pos)
+        if isinstance(part, array):
+            pos += part.itemsize * len(part)
+        else:
+            pos += len(part)
+    header = struct.pack(HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                         storageVersion, len(strings), len(rows),
+                         *(signature + tuple(sectionOffsets)))
+
+    # 写到同一个目录的临时文件, 然后改名, 改名是原子操作
+    dirName = os.path.dirname(os.path.abspath(fname))
+    fd, tmpName = tempfile.mkstemp(prefix = '.snap', dir = dirName)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            for part in parts:
+                if isinstance(part, array):
+                    part.tofile(f)
+                else:
+                    f.write(part)
+        if os.name == 'nt' and os.path.exists(fname):
+            # Windows 不能覆盖已经存在的文件
+            os.remove(fname)
+        os.rename(tmpName, fname)
+    except (IOError, OSError):
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        return False
+    return True
+
+class _Section(object):
+    '''把 mmap 中的整数数组当作元组的序列, 供 bisect 使用'''
+    def __init__(self, buf, offset, width, count):
+        self.buf = buf
+        self.offset = offset
+        self.width = width
+        self.count = count
+        self.fmt = struct.Struct('<' + 'i' * width)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.fmt.unpack_from(self.buf, self.offset + i * self.fmt.size)
+
+class _Strings(object):
+    '''字符串表, 读取过的字符串缓存起来, 补全时反复出现的总是那一小部分'''
+    def __init__(self, buf, offset, blobOffset, count):
+        self.buf = buf
+        self.offset = offset
+        self.blobOffset = blobOffset
+        self.count = count
+        self.fmt = struct.Struct('<ii')
+        self.cache = {}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        string = self.cache.get(i)
+        if string is None:
+            start, end = self.fmt.unpack_from(self.buf, self.offset + i * 4)
+            string = self.buf[self.blobOffset + start : self.blobOffset + end]
+            self.cache[i] = string
+        return string
+
+class SymbolSnapshot(object):
+    def __init__(self, fname):
+        '''打开失败或格式不对时抛出 ValueError'''
+        self.fname = fname
+        self.file = None
+        self.buf = None
+        self.stat = None
+        self.Open()
+
+    def Open(self):
+        f = open(self.fname, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            if st.st_size < HEADER_SIZE:
+                raise ValueError('%s: not a snapshot' % self.fname)
+            buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except:
+            f.close()
+            raise
+        header = struct.unpack_from(HEADER_FORMAT, buf, 0)
+        if header[0] != SNAPSHOT_MAGIC or header[1] != SNAPSHOT_VERSION:
+            buf.close()
+            f.close()
+            raise ValueError('%s: bad snapshot version' % self.fname)
+
+        self.Close()
+        self.file = f
+        self.buf = buf
+        self.stat = (st.st_ino, st.st_mtime, st.st_size)
+        (self.storageVersion, stringCount, self.recordCount) = header[2:5]
+        self.signature = tuple(header[5:9])
+        (strOffset, blobOffset, recOffset,
+         pathOffset, scopeOffset, nameOffset) = header[9:15]
+
+        self.strings = _Strings(buf, strOffset, blobOffset, stringCount)
+        self.records = _Section(buf, recOffset, len(RECORD_FIELDS),
+                                self.recordCount)
+        self.pathIndex = _Section(buf, pathOffset, 2, self.recordCount)
+        self.scopeIndex = _Section(buf, scopeOffset, 3, self.recordCount)
+        self.nameIndex = _Section(buf, nameOffset, 2, self.recordCount)
+
+    def Close(self):
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __del__(self):
+        self.Close()
+
+    def __len__(self):
+        return self.recordCount
+
+    def Refresh(self):
+        '''文件被新的快照替换的话重新打开, 返回是否重新打开了'''
+        try:
+            st = os.stat(self.fname)
+        except OSError:
+            return False
+        if (st.st_ino, st.st_mtime, st.st_size) == self.stat:
+            return False
+        try:
+            self.Open()
+        except (IOError, ValueError):
+            return False
+        return True
+
+    def IsFresh(self, db):
+        '''快照是否和 sqlite3 连接 db 的数据一致'''
+        try:
+            return GetSignature(db) == self.signature
+        except Exception:
+            return False
+
+    def FindString(self, string):
+        '''返回字符串 id, 不存在返回 -1'''
+        i = bisect.bisect_left(self.strings, string)
+        if i < len(self.strings) and self.strings[i] == string:
+            return i
+        return -1
+
+    def PrefixRange(self, prefix):
+        '''以 prefix 开头的字符串的 id 范围 [lo, hi)'''
+        lo = bisect.bisect_left(self.strings, prefix)
+        # 以 prefix 开头的字符串都小于 prefix + '\xff'
+        hi = bisect.bisect_left(self.strings, prefix + '\xff', lo)
+        return lo, hi
+
+    def MakeTagEntry(self, r):
+        return self.RecordToTagEntry(self.records[r])
+
+    def RecordToTagEntry(self, rec):
+        strings = self.strings
+        # 大部分字符串已经在缓存中, 直接查字典快很多
+        get = strings.cache.get
+        entry = TagEntry()
+        entry.id = rec[0]
+        entry.name = get(rec[1]) or strings[rec[1]]
+        entry.file = get(rec[2]) or strings[rec[2]]
+        entry.fileid = rec[3]
+        entry.line = rec[4]
+        entry.kind = get(rec[5]) or strings[rec[5]]
+        entry.scope = get(rec[6]) or strings[rec[6]]
+        entry.extra = get(rec[11]) or strings[rec[11]]
+        # EXT_FIELDS 的顺序与 EXT_ROW_FIELDS 相同
+        entry.SetExtRow(tuple([rec[idx] and (get(rec[idx]) or strings[rec[idx]])
+                               for idx, key in EXT_FIELDS]))
+        return entry
+
+    def GetTagsByPath(self, path):
+        sid = self.FindString(path)
+        if sid < 0:
+            return []
+        index = self.pathIndex
+        i = bisect.bisect_left(index, (sid, ))
+        result = []
+        while i < len(index):
+            key = index[i]
+            if key[0] != sid:
+                break
+            result.append(self.MakeTagEntry(key[1]))
+            i += 1
+        return result
+
+    def GetOrderedTagsByScopesAndName(self, scopes, name, partialMatch = False,
+                                      limit = 1000, icase = True):
+        '''获取按名字升序排序后的 tags, icase 只影响前缀匹配'''
+        lname = name.lower()
+        if partialMatch:
+            lo, hi = self.PrefixRange(lname)
+        else:
+            lo = self.FindString(lname)
+            hi = lo + 1
+        if lo < 0 or lo >= hi:
+            return []
+
+        index = self.scopeIndex
+        matches = []
+        for scope in set(scopes):
+            sid = self.FindString(scope)
+            if sid < 0:
+                continue
+            i = bisect.bisect_left(index, (sid, lo))
+            while i < len(index):
+                key = index[i]
+                if key[0] != sid or key[1] >= hi:
+                    break
+                rec = self.records[key[2]]
+                # 名字的字符串 id 的顺序就是名字的顺序
+                matches.append((rec[1], rec[0], rec))
+                i += 1
+
+        if not partialMatch:
+            nameId = self.FindString(name)
+            matches = [m for m in matches if m[0] == nameId]
+        elif not icase:
+            # 以 name 开头的名字的 id 是连续的
+            nlo, nhi = self.PrefixRange(name)
+            matches = [m for m in matches if nlo <= m[0] < nhi]
+        matches.sort()
+        return [self.RecordToTagEntry(m[2]) for m in matches[:limit]]
+
+def OpenSnapshot(fname):
+    '''打开快照, 不存在或格式不对返回 None'''
+    try:
+        return SymbolSnapshot(fname)
+    except (IOError, ValueError, mmap.error):
+        return None
+
+def test():
+    from TagsStorageSQLite import TagsStorageSQLite
+    storage = TagsStorageSQLite()
+    storage.OpenDatabase(':memory:')
+    storage.StoreLines([
+        'GetX\ta.h\t/^x$/;"\tp\tline:1\tclass:NsA::C\taccess:public\tsignature:()',
+        'getY\ta.h\t/^x$/;"\tp\tline:2\tclass:NsA::C\taccess:public\tsignature:()',
+        'Get_Z\tb.h\t/^x$/;"\tm\tline:3\tclass:NsA::C\taccess:private',
+        'GetX\tb.h\t/^x$/;"\tm\tline:4\tclass:NsB\taccess:public',
+        'Other\tb.h\t/^x$/;"\tm\tline:5\tclass:NsA::C\taccess:public',
+    ])
+    fd, fname = tempfile.mkstemp(suffix = '.snap')
+    os.close(fd)
+    try:
+        assert ExportSnapshot(storage.db, fname)
+        snapshot = OpenSnapshot(fname)
+        assert snapshot and len(snapshot) == 5
+        assert snapshot.IsFresh(storage.db)
+
+        def Fields(t):
+            return (t.id, t.name, t.file, t.fileid, t.line, t.kind, t.scope,
+                    t.extra, sorted(t.exts.items()))
+        def Check(scopes, name, partialMatch, icase = True):
+            got = snapshot.GetOrderedTagsByScopesAndName(
+                scopes, name, partialMatch, icase = icase)
+            want = storage.GetOrderedTagsByScopesAndName(
+                scopes, name, partialMatch, icase)
+            assert map(Fields, got) == map(Fields, want), \
+                    (scopes, name, partialMatch)
+            return got
+
+        assert len(Check(['NsA::C'], 'get', True)) == 3
+        assert len(Check(['NsA::C'], 'Get', True, False)) == 2
+        assert len(Check(['NsA::C', 'NsB'], 'GetX', False)) == 2
+        assert len(Check(['NsA::C'], 'getx', False)) == 0
+        assert len(Check(['NsA::C'], '', True)) == 4
+        assert map(Fields, snapshot.GetTagsByPath('NsA::C::GetX')) \
+                == map(Fields, storage.GetTagsByPath('NsA::C::GetX'))
+        assert snapshot.GetTagsByPath('NsA::C::None') == []
+
+        # 替换快照
+        storage.DeleteTagsByFiles(['b.h'])
+        assert not snapshot.IsFresh(storage.db)
+        assert ExportSnapshot(storage.db, fname)
+        assert snapshot.Refresh() and len(snapshot) == 2
+        snapshot.Close()
+        print 'ok'
+    finally:
+        os.remove(fname)
+
+if __name__ == '__main__':
+    test()
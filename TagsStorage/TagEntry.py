@@ -2,7 +2,6 @@
 # -*- encoding:utf-8 -*-
 
 import re
-#from Misc import Obj2Dict, Dict2Obj
 
 CKinds = {
     'c': "class",     
@@ -84,12 +83,36 @@ def GetMacroSignature(srcLine):
     else:
         return ''
 
+# Create() 用来提取 extra 的正则表达式, 每个标签都要用, 预先编译
+patTypedefExtra = re.compile(r'typedef\s+|\s+[a-zA-Z_]\w*\s*;\s*$')
+patTemplate = re.compile(r'\btemplate\s*<.*>')
+patFuncPrefix = re.compile(r'([^(]+)\(')
+patTrailingWord = re.compile(r'\s*[a-zA-Z_]\w*$')
+patLeadingBrace = re.compile(r'^\s*}\s*')
+
+# 决定 scope 的扩展域, 按优先级排列, 以及对应的 parent_kind
+SCOPE_EXT_FIELDS = [(kind, ToAbbrKind(kind))
+                    for kind in ('class', 'struct', 'namespace', 'union',
+                                 'enum')]
+
 def GenPath(scope, name):
     if scope == '<global>':
         return name
     return '%s::%s' % (scope, name)
 
-class TagEntry():
+# 数据库中保存的扩展域, 顺序与 TAGS 表的列相同, 见 TagEntry.SetExtRow()
+EXT_ROW_FIELDS = ('parent_kind', 'access', 'inherits', 'signature')
+EXT_ROW_INDEX = dict((key, idx) for idx, key in enumerate(EXT_ROW_FIELDS))
+
+# 补全菜单中的访问控制符号
+COMPL_ACCESS_MAPPING = {'public': '+', 'protected': '#', 'private': '-'}
+
+class TagEntry(object):
+    # 查询结果可能有上万个, 不使用 __dict__
+    # 从数据库取出的扩展域先按行保存在 _extRow, 访问 exts 时才转为字典
+    __slots__ = ('id', 'name', 'file', 'fileid', 'line', 'kind', 'scope',
+                 'extra', '_exts', '_extRow')
+
     def __init__(self):
         '''
         与数据库保持一致
@@ -127,32 +150,74 @@ class TagEntry():
         # 上述存储模板信息的时候, 如果存在模板特化, 则要把文本存储到符号">"为止
         self.extra = ''
 
-        self.exts = {}              # Additional extension fields
+        self._exts = None           # Additional extension fields, 见 exts
+        self._extRow = None
+
+    @property
+    def exts(self):
+        '''扩展域的字典, 第一次访问时才建立'''
+        if self._exts is None:
+            exts = {}
+            if self._extRow:
+                for key, value in zip(EXT_ROW_FIELDS, self._extRow):
+                    if value:
+                        exts[key] = value
+                self._extRow = None
+            self._exts = exts
+        return self._exts
+
+    @exts.setter
+    def exts(self, exts):
+        self._exts = exts
+        self._extRow = None
+
+    def SetExtRow(self, values):
+        '''设置数据库中保存的扩展域, values 的顺序与 EXT_ROW_FIELDS 相同'''
+        self._extRow = values
+        self._exts = None
+
+    def ExtValues(self):
+        '''非空的扩展域的值, 不会建立 exts 字典'''
+        if self._exts is not None:
+            return self._exts.values()
+        return [value for value in self._extRow or () if value]
 
     def ToDict(self):
-        return Obj2Dict(self, set(['differOnByLineNumber']))
+        '''返回 {属性: 值}, 扩展域为解码后的字典 exts'''
+        d = {}
+        for key in self.__slots__:
+            if not key.startswith('_'):
+                d[key] = getattr(self, key)
+        d['exts'] = dict(self.exts)
+        return d
 
     def FromDict(self, d):
-        Dict2Obj(self, d)
+        '''ToDict() 的逆操作, 没有的键保持不变'''
+        for key in self.__slots__:
+            if not key.startswith('_') and key in d:
+                setattr(self, key, d[key])
+        if 'exts' in d:
+            self.exts = dict(d['exts'])
 
     def Create(self, name, fname, line, text, kind, exts, pattern = ''):
         '''
         @kind:  全称
+        批量导入时每个标签都要调用, 所以直接访问属性而不是用 Set*()
         '''
-        self.SetId(-1)
-        self.SetName(name)
-        self.SetFile(fname)
-        self.SetLine(line)
+        self.id = -1
+        self.name = name
+        self.file = fname
+        self.line = line
         if kind:
-            self.SetKind(kind)
+            self.kind = ToAbbrKind(kind)
         self.exts = exts
 
         extra = ''
 
         if kind == 'typedef':
-            extra = re.sub(r'typedef\s+|\s+[a-zA-Z_]\w*\s*;\s*$', '', text)
+            extra = patTypedefExtra.sub('', text)
         elif kind == 'struct' or kind == 'class':
-            m = re.search(r'\btemplate\s*<.*>', text)
+            m = patTemplate.search(text)
             if m:
                 extra = m.group()
         elif kind == 'function':
@@ -161,16 +226,16 @@ class TagEntry():
             template<> A<B>::C *** func (void) {}
             template<class T> A<B>::C *** func <X, Y> (void) {}
             '''
-            m = re.search(r'([^(]+)\(', text)
+            m = patFuncPrefix.search(text)
             if m:
-                extra = re.sub(r'\s*[a-zA-Z_]\w*$', '', m.group(1).strip())
+                extra = patTrailingWord.sub('', m.group(1).strip())
         elif kind == 'variable' or kind == 'externvar':
             # TODO: 数组形式未能解决, 很复杂, 暂时无法完善处理, 全部存起来
-            if exts.has_key('typeref'):
+            if 'typeref' in exts:
                 # 从这个域解析
                 # typeref:struct:ss    } ***p, *x;
                 extra = exts['typeref'].partition(':')[2]
-                extra += re.sub(r'^\s*}\s*', '', text)
+                extra += patLeadingBrace.sub('', text)
             else:
                 extra = text
         else:
@@ -181,33 +246,23 @@ class TagEntry():
         # Check if we can get full name (including path)
         # 添加 parent_kind 属性, 以保证不丢失信息
         scope = ''
-        if self.GetExtField('class'):
-            self.SetParentKind('class')
-            scope = self.GetExtField('class')
-        elif self.GetExtField('struct'):
-            self.SetParentKind('struct')
-            scope = self.GetExtField('struct')
-        elif self.GetExtField('namespace'):
-            self.SetParentKind('namespace')
-            scope = self.GetExtField('namespace')
-        elif self.GetExtField('union'):
-            self.SetParentKind('union')
-            scope = self.GetExtField('union')
-        elif self.GetExtField('enum'):
-            self.SetParentKind('enum')
-            # enumerator 的 scope 和 path 要退一级
-            scope = '::'.join(self.GetExtField('enum').split('::')[:-1])
-        else:
-            pass
+        for field, parentKind in SCOPE_EXT_FIELDS:
+            scope = exts.get(field)
+            if scope:
+                exts['parent_kind'] = parentKind
+                if field == 'enum':
+                    # enumerator 的 scope 和 path 要退一级
+                    scope = '::'.join(scope.split('::')[:-1])
+                break
 
         if not scope:
             scope = '<global>'
-        self.SetScope(scope)
+        self.scope = scope
 
         if kind == 'macro':
             sig = GetMacroSignature(pattern[2:-2])
             if sig:
-                self.SetSignature(sig)
+                exts['signature'] = sig
 
     def FromLine(self, strLine):
         strLine = strLine
@@ -255,8 +310,9 @@ class TagEntry():
 
         if strLine:
             for i in strLine.split('\t'):
-                key = i.partition(':')[0].strip()
-                val = i.partition(':')[2].strip()
+                key, sep, val = i.partition(':')
+                key = key.strip()
+                val = val.strip()
 
                 if key == 'line' and val:
                     line = int(val)
@@ -298,12 +354,15 @@ class TagEntry():
 
     @property
     def parent(self):
-        return self.scope.split('::')[-1]
+        return self.scope.rpartition('::')[2]
 
     @property
     def path(self):
         return GenPath(self.scope, self.name)
 
+    def GetParent(self):
+        return self.parent
+
     def GetExtra(self):
         return self.extra
 
@@ -508,7 +567,34 @@ class TagEntry():
     #  Extenstion fields
     # ------------------------------------------
     def GetExtField(self, extField):
-        return self.exts.get(extField, '')
+        if self._exts is not None:
+            return self._exts.get(extField, '')
+        if self._extRow:
+            idx = EXT_ROW_INDEX.get(extField)
+            if idx is not None:
+                return self._extRow[idx] or ''
+        return ''
+
+    def ToComplItem(self):
+        '''直接转为 vim 的补全项目, 与 omnicxx.ToVimComplItem(TagEntry2Tag())
+        的结果相同, 但是不需要中间的 tag 字典'''
+        kind = self.kind
+        access = self.GetExtField('access')
+        if kind == 'f' and not access \
+                and self.GetExtField('parent_kind') == 'c':
+            # 没有访问控制信息的类成员函数, 跳过
+            return {}
+
+        menu = ''
+        if access:
+            menu += COMPL_ACCESS_MAPPING.get(access, ' ')
+        menu += ' ' + self.parent
+
+        word = self.name
+        if kind in ('f', 'p'):
+            word += '()'
+        return {'word': word, 'menu': menu, 'kind': kind, 'icase': 1,
+                'dup': 0}
 
     # ------------------------------------------
     #  Misc
@@ -559,3 +645,27 @@ if __name__ == '__main__':
         entry.FromLine(line)
         entry.Print()
 
+    # 从数据库取出的扩展域需要时才转为字典
+    entry = TagEntry()
+    entry.name, entry.kind, entry.scope = 'Get', 'f', 'A::B'
+    entry.SetExtRow(('c', 'protected', '', '()'))
+    assert entry._exts is None and entry.GetAccess() == 'protected'
+    assert sorted(entry.ExtValues()) == ['()', 'c', 'protected']
+    assert entry._exts is None and entry.parent == 'B'
+    assert entry.ToComplItem() == {'word': 'Get()', 'menu': '# B', 'kind': 'f',
+                                   'icase': 1, 'dup': 0}
+    assert entry.exts == {'parent_kind': 'c', 'access': 'protected',
+                          'signature': '()'}
+    entry.SetExtRow(('c', '', '', ''))
+    assert entry.ToComplItem() == {}
+
+
+    # ToDict() 不依赖 __dict__
+    entry.SetExtRow(('c', 'public', '', '(int)'))
+    d = entry.ToDict()
+    assert d['name'] == 'Get' and d['scope'] == 'A::B'
+    assert d['exts'] == {'parent_kind': 'c', 'access': 'public',
+                         'signature': '(int)'}
+    copy = TagEntry()
+    copy.FromDict(d)
+    assert copy.ToDict() == d
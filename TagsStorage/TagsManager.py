@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
+import os.path
 import time
 import threading
 import TagsStorageSQLite as TagsStorage
+from SymbolSnapshot import OpenSnapshot, SnapshotFileName
 from TagEntry import ToFullKind, ToFullKinds
 from Misc import RunSimpleThread
+from ReindexService import ReindexService
+from ReindexService import WRITER_LOCK
 
 
 def TagEntry2Tag(tagEntry):
@@ -59,15 +63,21 @@ def TagEntries2Tags(tagEntries):
         tags.append(TagEntry2Tag(tagEntry))
     return tags
 
+def ComplRows2Items(rows):
+    '''把 IterRankedComplRows() 的结果转为 vim 的补全项目列表'''
+    return [{'word': word, 'menu': menu, 'kind': kind, 'icase': 1, 'dup': 0}
+            for name, word, menu, kind, scope in rows]
+
 AppendCtagsOpt = TagsStorage.AppendCtagsOpt
 
 class ParseFilesThread(threading.Thread):
-    '''同时只允许单个线程工作'''
-    lock = threading.Lock()
+    '''同时只允许单个线程工作, 与 ReindexService 共用一个锁'''
+    lock = WRITER_LOCK
 
     def __init__(self, dbFile, files, macrosFiles = [],
                  PostCallback = None, callbackPara = None,
-                 filterNotNeed = True, onlyCpp = False):
+                 filterNotNeed = True, onlyCpp = False, jobs = 1,
+                 wal = False):
         '''
         异步 parse 文件线程
         NOTE: sqlite3 是线程安全的
@@ -83,6 +93,8 @@ class ParseFilesThread(threading.Thread):
         self.callbackPara = callbackPara
         self.filterNotNeed = filterNotNeed
         self.onlyCpp = onlyCpp
+        self.jobs = jobs
+        self.wal = wal
 
         self.name = 'Videm-' + self.name
 
@@ -90,11 +102,12 @@ class ParseFilesThread(threading.Thread):
         ParseFilesThread.lock.acquire()
 
         try:
-            storage = TagsStorage.TagsStorageSQLite()
+            storage = TagsStorage.TagsStorageSQLite(wal = self.wal)
             storage.OpenDatabase(self.dbFile)
             TagsStorage.ParseFilesAndStore(storage, self.files,
                                            self.macrosFiles, self.filterNotNeed,
-                                           onlyCpp = self.onlyCpp)
+                                           onlyCpp = self.onlyCpp,
+                                           jobs = self.jobs)
             del storage
         except:
             # FIXME: gvim里面这样打印就会导致gvim崩溃了
@@ -128,53 +141,118 @@ def AsyncTagsStorageOperate(data):
     eval(s)
 
 class TagsManager(object):
-    def __init__(self, dbFile = ''):
-        self.storage = TagsStorage.TagsStorageSQLite()
+    def __init__(self, dbFile = '', wal = False, readOnly = False):
+        '''wal 和 readOnly 见 TagsStorageSQLite'''
+        self.wal = wal
+        self.readOnly = readOnly
+        self.storage = TagsStorage.TagsStorageSQLite(wal, readOnly)
         if dbFile:
             self.storage.OpenDatabase(dbFile)
 
-        # 这样做的目的是为了下面的 self.parseThread.join() 不出错
-        self.parseThread = threading.Thread()
-        self.parseThread.start()
+        # 还没有等待过的异步 parse 线程, 见 WaitParseThreads()
+        self.parseThreads = []
+
+        # 保存文件后的后台 parse 服务, 第一次请求时启动
+        self.reindexService = None
 
     def OpenDatabase(self, dbFile):
+        # 后台服务使用的是原来的数据库
+        self.StopReindex()
         return self.storage.OpenDatabase(dbFile)
 
     def CloseDatabase(self):
-        self.storage = TagsStorage.TagsStorageSQLite()
+        self.StopReindex()
+        useIndex = self.storage.GetSymbolIndex() is not None
+        useCache = self.storage.GetUseCache()
+        self.storage = TagsStorage.TagsStorageSQLite(self.wal, self.readOnly)
+        self.storage.EnableSymbolIndex(useIndex)
+        self.storage.SetUseCache(useCache)
 
     def RecreateDatabase(self):
-        self.storage.RecreateDatabase()
+        # 删除数据库文件的时候不能有其他线程在写入
+        self.StopReindex()
+        self.WaitParseThreads()
+        with WRITER_LOCK:
+            self.storage.RecreateDatabase()
 
     def GetTagsBySql(self, sql):
         return self.storage.GetTagsBySql(sql)
 
     def AsyncParseFiles(self, files, macrosFiles = [],
                         PostCallback = None, callbackPara = None,
-                        filterNotNeed = True, onlyCpp = False):
-        # 暂时只允许单个异步 parse
-        try:
-            self.parseThread.join()
-        except RuntimeError:
-            pass
-
-        self.parseThread = ParseFilesThread(self.storage.GetDatabaseFileName(),
-                                            files, macrosFiles,
-                                            PostCallback, callbackPara,
-                                            filterNotNeed, onlyCpp)
-        self.parseThread.start()
+                        filterNotNeed = True, onlyCpp = False, jobs = 1):
+        '''不等待之前的 parse, 立即返回
+        多个 parse 线程由 ParseFilesThread.lock 串行写入数据库'''
+        self.parseThreads = [t for t in self.parseThreads if t.is_alive()]
+        thrd = ParseFilesThread(self.storage.GetDatabaseFileName(),
+                                files, macrosFiles,
+                                PostCallback, callbackPara,
+                                filterNotNeed, onlyCpp, jobs,
+                                self.wal)
+        thrd.start()
+        self.parseThreads.append(thrd)
+
+    def WaitParseThreads(self):
+        '''等待全部异步 parse 完成'''
+        for thrd in self.parseThreads:
+            thrd.join()
+        self.parseThreads = []
+
+    def RequestReindex(self, files, macrosFiles = [], delay = 0.5):
+        '''请求在后台重新 parse files, 不等待之前的 parse, 立即返回
+        短时间内重复的请求会被合并, macrosFiles 和 delay 以最后一次请求为准'''
+        if self.reindexService is None:
+            # WAL 模式是持久的, 数据库已经是 WAL 模式的话服务也按 WAL 处理
+            self.reindexService = ReindexService(
+                self.storage.GetDatabaseFileName(), macrosFiles, delay,
+                wal = self.wal or self.storage.IsWal())
+            self.reindexService.start()
+        self.reindexService.Request(files, macrosFiles, delay)
+
+    def SetUseCache(self, useCache):
+        '''缓存查询结果, 用于长期使用的补全 tagmgr
+        其他连接提交修改后整个缓存失效, 见 TagsStorageSQLite.CheckDataVersion()'''
+        self.storage.SetUseCache(useCache)
+
+    def EnableSymbolIndex(self, enable = True):
+        '''补全时使用内存索引, 见 TagsStorageSQLite.EnableSymbolIndex()'''
+        return self.storage.EnableSymbolIndex(enable)
+
+    def ExportSnapshot(self):
+        '''导出只读的快照, 之后的 parse 不会自动更新, 需要时再次调用'''
+        dbFile = self.storage.GetDatabaseFileName()
+        if not dbFile or dbFile == ':memory:':
+            return False
+        return TagsStorage.ExportSnapshot(self.storage.db,
+                                          SnapshotFileName(dbFile),
+                                          self.storage.GetVersion())
+
+    def OpenSnapshot(self, dbFile = ''):
+        '''打开数据库 dbFile 的快照, 不需要打开数据库, 失败返回 None'''
+        if not dbFile:
+            dbFile = self.storage.GetDatabaseFileName()
+        if not dbFile:
+            return None
+        return OpenSnapshot(SnapshotFileName(os.path.realpath(dbFile)))
+
+    def StopReindex(self, wait = True):
+        '''停止后台 parse 服务, 丢弃还没开始的请求
+        wait 为真时等待正在进行的一批写完, 见 ReindexService.Stop()'''
+        if self.reindexService is not None:
+            self.reindexService.Stop(wait)
+            self.reindexService = None
 
     def ParseFiles(self, files, macrosFiles = [], indicator = None,
-                   filterNotNeed = True, onlyCpp = False):
+                   filterNotNeed = True, onlyCpp = False, jobs = 1):
+        '''jobs > 1 时同时运行多个 ctags, 数据库依然只在当前线程写入
+        返回 {文件: 改动的行数}'''
         # 需要等待 parse 线程
-        try:
-            self.parseThread.join()
-        except RuntimeError:
-            pass
-        TagsStorage.ParseFilesAndStore(self.storage, files, macrosFiles, 
-                                       filterNotNeed = filterNotNeed,
-                                       indicator = indicator,
-                                       onlyCpp = onlyCpp)
+        self.WaitParseThreads()
+        return TagsStorage.ParseFilesAndStore(self.storage, files, macrosFiles, 
+                                              filterNotNeed = filterNotNeed,
+                                              indicator = indicator,
+                                              onlyCpp = onlyCpp,
+                                              jobs = jobs)
 
     def DeleteTagsByFile(self, fn, async = False):
         return self.DeleteTagsByFiles([fn], async)
@@ -211,16 +289,64 @@ class TagsManager(object):
         tagEntries = self.storage.GetTagsByScopeAndName(scope, name, True)
         return tagEntries
 
-    def GetTagsByScopesAndName(self, scopes, name, partialMatch = True):
+    def GetTagsByScopesAndName(self, scopes, name, partialMatch = True,
+                               icase = True):
         tagEntries = self.storage.GetTagsByScopeAndName(
-            scopes, name, partialMatch)
+            scopes, name, partialMatch, icase)
         return tagEntries
 
-    def GetOrderedTagsByScopesAndName(self, scopes, name, partialMatch = True):
+    def GetOrderedTagsByScopesAndName(self, scopes, name, partialMatch = True,
+                                      icase = True):
+        '''icase 为假时前缀匹配区分大小写'''
         tagEntries = self.storage.GetOrderedTagsByScopesAndName(
-            scopes, name, partialMatch)
+            scopes, name, partialMatch, icase)
         return tagEntries
 
+    def GetRankedTagsByScopesAndName(self, scopes, name, partialMatch = True,
+                                     limit = None, icase = True,
+                                     excludeKinds = [], skipCtorDtor = False,
+                                     shadow = False):
+        '''补全用, 全部过滤之后按作用域和 kind 排序的前 limit 个标签
+返回 vim 的 tag 字典列表'''
+        tagEntries = self.storage.GetRankedTagsByScopesAndName(
+            scopes, name, partialMatch, limit, icase,
+            ToFullKinds(excludeKinds), skipCtorDtor, shadow)
+        return TagEntries2Tags(tagEntries)
+
+    def GetRankedComplItems(self, scopes, name, partialMatch = True,
+                            limit = None, icase = True, excludeKinds = [],
+                            skipCtorDtor = False, shadow = False):
+        '''同 GetRankedTagsByScopesAndName(), 但是直接返回 vim 的补全项目列表,
+不建立标签对象, 用于成员补全'''
+        return ComplRows2Items(self.storage.IterRankedComplRows(
+            scopes, name, partialMatch, limit, icase,
+            ToFullKinds(excludeKinds), skipCtorDtor, shadow))
+
+    def GetNamesByScopes(self, scopes, excludeKinds = [], skipCtorDtor = False):
+        return self.storage.GetNamesByScopes(scopes, ToFullKinds(excludeKinds),
+                                             skipCtorDtor)
+
+    def GetChangeStamp(self):
+        return self.storage.GetChangeStamp()
+
+    def GetRankedTagsByScopesAndNames(self, scopes, names, excludeKinds = [],
+                                      skipCtorDtor = False):
+        '''按 names 的顺序排序的 tags, 用于模糊匹配, 返回 vim 的 tag 字典列表'''
+        return TagEntries2Tags(self.storage.GetRankedTagsByScopesAndNames(
+            scopes, names, ToFullKinds(excludeKinds), skipCtorDtor))
+
+    def GetGroupedTagsByScopesAndName(self, scopes, name, partialMatch = True,
+                                      limit = None, icase = True,
+                                      excludeKinds = [], skipCtorDtor = False,
+                                      shadow = True):
+        '''同 GetRankedTagsByScopesAndName(), 但是按作用域分组
+返回 [(作用域, [vim 的 tag 字典, ...]), ...]'''
+        groups = self.storage.GetGroupedTagsByScopesAndName(
+            scopes, name, partialMatch, limit, icase,
+            ToFullKinds(excludeKinds), skipCtorDtor, shadow)
+        return [(scope, TagEntries2Tags(tagEntries))
+                for scope, tagEntries in groups]
+
     def GetTagsByScopeAndKind(self, scope, kind):
         return self.GetTagsByScopesAndKinds([scope], [kind])
 
@@ -237,6 +363,14 @@ class TagsManager(object):
         tagEntries = self.storage.GetTagsByKindAndPath(ToFullKind(kind), path)
         return tagEntries
 
+    def GetFirstMatchTagByPaths(self, paths, kinds = []):
+        '''一次查询找出 paths 中第一个匹配的标签, 供语义分析使用
+返回 vim 的 tag 字典, 找不到返回空字典'''
+        tagEntry = self.storage.GetFirstMatchTagByPaths(paths, kinds)
+        if tagEntry is None:
+            return {}
+        return TagEntry2Tag(tagEntry)
+
 
 def test():
     import time
@@ -263,7 +397,7 @@ def test():
     vtm.AsyncParseFiles(['/usr/include/stdio.h'],
                         PostCallback = Test, callbackPara = None)
     while True:
-        if vtm.parseThread.isAlive():
+        if vtm.parseThreads[-1].isAlive():
             print "parsing"
         else:
             print "End"
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+TagsStorage 的查询结果缓存
+
+键为 (sql, 参数, kinds), 值为 TagEntry 列表, 按条目数和估算的字节数限制大小,
+超出的时候淘汰最久没有使用的条目(LRU)
+
+失效是有选择的, 重新 parse 一个文件的时候, 只需要失效:
+    1. 结果中包含这个文件的标签的条目
+    2. 查询参数中有这个文件的标签的 scope/path/name/file 的条目
+    3. 无法判断的条目(没有可用于判断的参数, 见 SelectiveTerms())
+这样修改一个头文件不会清空整个工程的缓存
+'''
+
+from collections import OrderedDict
+
+# 每个缓存的标签的额外开销(字节), 粗略估算
+TAG_OVERHEAD = 400
+# 每个条目的额外开销(字节)
+ENTRY_OVERHEAD = 200
+
+def EstimateSize(tags):
+    '''估算一个条目占用的字节数'''
+    size = ENTRY_OVERHEAD
+    for tag in tags:
+        size += TAG_OVERHEAD + len(tag.name) + len(tag.file) + len(tag.scope)
+        for v in tag.ExtValues():
+            size += len(v)
+    return size
+
+class RangeBound(str):
+    '''范围查询的边界参数(例如名字前缀查询的上下界), 不是相等条件
+    sqlite3 绑定时与 str 相同'''
+    __slots__ = ()
+
+def SelectiveTerms(params):
+    '''从查询参数中提取可用于失效判断的值
+
+这些查询中的字符串参数都是 AND 连接的相等条件(IN 语句也是),
+新增或删除的标签要影响结果, 必须匹配其中的某个值.
+LIKE 模式, RangeBound 和单个字符的参数(一般是 kind 的缩写)无法据此判断,
+忽略之. 返回空集合的话表示这个条目无法判断'''
+    terms = set()
+    for param in params:
+        if isinstance(param, basestring) and len(param) > 1 \
+                and '%' not in param and not isinstance(param, RangeBound):
+            terms.add(param)
+    return terms
+
+def TagTerms(tag):
+    '''标签可能匹配到的查询参数'''
+    return (tag.file, tag.scope, tag.name, tag.GetPath())
+
+class CacheEntry(object):
+    __slots__ = ('tags', 'size', 'files', 'terms', 'generation')
+
+    def __init__(self, tags, files, terms, generation):
+        self.tags = tags
+        self.size = EstimateSize(tags)
+        self.files = files
+        self.terms = terms
+        self.generation = generation
+
+class TagsStorageCache(object):
+    def __init__(self, maxEntries = 1000, maxBytes = 16 * 1024 * 1024):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+
+        # {键: CacheEntry}, 按使用顺序排列, 最近使用的在最后
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # 反向索引, {文件名: 键集合}, {参数: 键集合}
+        self.fileIndex = {}
+        self.termIndex = {}
+        # 无法判断的条目的键, 任何修改都要失效
+        self.wildcards = set()
+
+        # 每次失效(即每次修改数据)都会递增, 即使没有条目被删除,
+        # 外部可以用来判断数据是否改变过, 见 TagsStorageSQLite.GetChangeStamp()
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def MakeKey(self, key, kinds = []):
+        if kinds:
+            return key + (tuple(sorted(kinds)), )
+        return key
+
+    def Get(self, key, kinds = []):
+        '''返回缓存的标签列表, 不存在返回 None'''
+        key = self.MakeKey(key, kinds)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        # 移到最后
+        self.entries[key] = entry
+        self.hits += 1
+        return list(entry.tags)
+
+    def Store(self, key, tags, kinds = []):
+        '''key 为 (sql, params)'''
+        terms = SelectiveTerms(key[1])
+        key = self.MakeKey(key, kinds)
+        self._Remove(key)
+
+        entry = CacheEntry(list(tags), set(t.file for t in tags), terms,
+                           self.generation)
+        if entry.size > self.maxBytes:
+            return
+
+        self.entries[key] = entry
+        self.bytes += entry.size
+        for f in entry.files:
+            self.fileIndex.setdefault(f, set()).add(key)
+        if terms:
+            for t in terms:
+                self.termIndex.setdefault(t, set()).add(key)
+        else:
+            self.wildcards.add(key)
+
+        while len(self.entries) > self.maxEntries or self.bytes > self.maxBytes:
+            oldest = next(iter(self.entries))
+            self._Remove(oldest)
+            self.evictions += 1
+
+    def _Remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        self.bytes -= entry.size
+        for f in entry.files:
+            keys = self.fileIndex.get(f)
+            keys.discard(key)
+            if not keys:
+                del self.fileIndex[f]
+        for t in entry.terms:
+            keys = self.termIndex.get(t)
+            keys.discard(key)
+            if not keys:
+                del self.termIndex[t]
+        self.wildcards.discard(key)
+        return True
+
+    def _RemoveKeys(self, keys):
+        for key in keys:
+            if self._Remove(key):
+                self.invalidations += 1
+        self.generation += 1
+
+    def InvalidateFiles(self, files):
+        '''失效 files 相关的条目, 文件的标签被删除或替换之前调用'''
+        keys = set(self.wildcards)
+        for f in files:
+            keys.update(self.fileIndex.get(f, ()))
+            keys.update(self.termIndex.get(f, ()))
+        self._RemoveKeys(keys)
+
+    def InvalidateFilePrefix(self, prefix):
+        '''失效文件名以 prefix 开头的文件相关的条目'''
+        files = [f for f in self.fileIndex if f.startswith(prefix)]
+        files.extend(t for t in self.termIndex if t.startswith(prefix))
+        self.InvalidateFiles(files)
+
+    def InvalidateTags(self, tags):
+        '''失效新增或修改的 tags 可能影响的条目'''
+        if not self.entries:
+            # 没有需要失效的条目, 但是数据已经改变了
+            self.generation += 1
+            return
+        keys = set(self.wildcards)
+        for tag in tags:
+            keys.update(self.fileIndex.get(tag.file, ()))
+            for t in TagTerms(tag):
+                keys.update(self.termIndex.get(t, ()))
+        self._RemoveKeys(keys)
+
+    def InvalidateAll(self):
+        self.invalidations += len(self.entries)
+        self.Clear()
+
+    def Clear(self):
+        self.entries.clear()
+        self.fileIndex.clear()
+        self.termIndex.clear()
+        self.wildcards.clear()
+        self.bytes = 0
+        self.generation += 1
+
+    def GetGeneration(self):
+        return self.generation
+
+    def GetStats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'generation': self.generation,
+        }
+
+def test():
+    from TagEntry import TagEntry
+    def MakeTag(name, file, scope):
+        tag = TagEntry()
+        tag.name, tag.file, tag.scope, tag.kind = name, file, scope, 'f'
+        return tag
+
+    cache = TagsStorageCache(maxEntries = 3)
+    key1 = ('select * from tags where scope = ?', ('NsA', ))
+    key2 = ('select * from tags where scope = ?', ('NsB', ))
+    key3 = ('select * from tags where name like ?', ('Get%', ))
+    cache.Store(key1, [MakeTag('foo', 'a.h', 'NsA')])
+    cache.Store(key2, [])
+    cache.Store(key3, [MakeTag('GetX', 'b.h', 'NsB')])
+    assert cache.Get(key2) == []
+    assert cache.Get(('x', ())) is None
+
+    # 新增 NsB 作用域的标签, 只失效 key2 和无法判断的 key3
+    cache.InvalidateTags([MakeTag('bar', 'c.h', 'NsB')])
+    assert cache.Get(key1) is not None
+    assert cache.Get(key2) is None and cache.Get(key3) is None
+
+    cache.InvalidateFiles(['a.h'])
+    assert cache.Get(key1) is None
+
+    for i in range(5):
+        cache.Store(('q', ('S%d' % i, )), [])
+    assert len(cache) == 3 and cache.evictions == 2
+    print cache.GetStats()
+
+    # 缓存为空的时候, 修改数据也要改变代数
+    cache = TagsStorageCache()
+    generation = cache.GetGeneration()
+    cache.InvalidateTags([MakeTag('bar', 'c.h', 'NsB')])
+    assert cache.GetGeneration() != generation
+
+    # 前缀查询的边界不是相等条件, 插入匹配的标签之后必须失效
+    from TagsStorageSQLite import TagsStorageSQLite
+    storage = TagsStorageSQLite()
+    storage.OpenDatabase(':memory:')
+    storage.SetUseCache(True)
+    storage.StoreLines(['bar\ta.h\t/^x$/;"\tm\tline:1\tclass:A\taccess:public'])
+    assert storage.GetTagsByScopeAndName('A', 'foo', True) == []
+    storage.DiffStoreLines(
+        ['foobaz\tb.h\t/^x$/;"\tm\tline:2\tclass:A\taccess:public'], ['b.h'])
+    assert [t.name for t in storage.GetTagsByScopeAndName('A', 'foo', True)] \
+            == ['foobaz']
+
+if __name__ == '__main__':
+    test()
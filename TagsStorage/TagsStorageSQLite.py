@@ -4,17 +4,25 @@
 
 from ITagsStorage import ITagsStorage
 from TagEntry import TagEntry
+from TagEntry import ToAbbrKinds
+from TagEntry import GenPath
 from FileEntry import FileEntry
+from SymbolSnapshot import ExportSnapshot, SnapshotFileName
+from TagsStorageCache import RangeBound
 from Misc import ToU
 
 import os, os.path
+import itertools
 import tempfile
 import time
 import subprocess
 import platform
 import sqlite3
+import hashlib
+import threading
+import Queue
 
-STORAGE_VERSION = 3000
+STORAGE_VERSION = 3002
 
 # 这两个变量暂时只对本模块生效
 # FIXME: 应该使用公共的模块定义这两个变量
@@ -39,20 +47,330 @@ def MakeQMarkString(count):
     else:
         return "(%s)" % ", ".join(["?" for i in range(count)])
 
-class PrintExcept(*args):
+# IN (...) 语句的占位符数量分档, 相同形状的语句才能命中 sqlite3 的语句缓存
+# 超过最大档的列表分批查询
+IN_BUCKETS = (1, 4, 16, 64, 256)
+
+# sqlite3 模块的语句缓存大小, 需要大于所有语句形状的数量
+STATEMENT_CACHE_SIZE = 256
+
+def InBucketSize(count):
+    '''返回能容纳 count 个参数的最小档'''
+    for size in IN_BUCKETS:
+        if count <= size:
+            return size
+    return IN_BUCKETS[-1]
+
+def SplitInParams(items):
+    '''把 IN 语句的参数列表按档分批, 返回 [(占位符字符串, 参数列表), ...]
+    不足一档的用最后一个参数填充, IN 语句中重复的参数不影响结果'''
+    items = list(items)
+    result = []
+    maxSize = IN_BUCKETS[-1]
+    for i in range(0, len(items), maxSize):
+        chunk = items[i : i + maxSize]
+        size = InBucketSize(len(chunk))
+        chunk += [chunk[-1]] * (size - len(chunk))
+        result.append((MakeQMarkString(size), chunk))
+    return result
+
+def LikeEscape(string):
+    '''转义 LIKE 的通配符, 转义字符为 '^', 配合 ESCAPE '^' 使用'''
+    return string.replace('^', '^^').replace('%', '^%').replace('_', '^_')
+
+def PrefixUpperBound(prefix, icase = False):
+    '''前缀范围查询的上界, 以 prefix 开头的字符串都小于它, 没有上界返回 None
+    icase 为真时用于 COLLATE NOCASE 的比较, prefix 需要先转为小写'''
+    prefix = prefix.rstrip('\xff')
+    if not prefix:
+        return None
+    c = chr(ord(prefix[-1]) + 1)
+    if icase and 'A' <= c <= 'Z':
+        # NOCASE 比较时大写字母等同于小写字母, 所以紧接着 '@' 的是 '['
+        c = '['
+    return prefix[:-1] + c
+
+# 允许用于排序的列
+ORDERING_COLUMNS = set(['id', 'name', 'file', 'fileid', 'line', 'kind',
+                        'scope', 'parent_kind', 'access', 'signature'])
+
+def OrderByClause(orderingColumn, order):
+    '''列名无法使用占位符, 只允许已知的列'''
+    if not orderingColumn or orderingColumn not in ORDERING_COLUMNS:
+        return ''
+    sql = " ORDER BY " + orderingColumn
+    if order == ITagsStorage.OrderAsc:
+        sql += " ASC"
+    elif order == ITagsStorage.OrderDesc:
+        sql += " DESC"
+    return sql
+
+# 补全结果中 kind 的先后顺序, 不在其中的排在最后
+COMPL_KIND_ORDER = ('m', 'f', 'p', 'v', 'x', 'e', 'g', 'c', 's', 'u', 't', 'n',
+                    'd')
+COMPL_KIND_RANK_SQL = "CASE kind %s ELSE %d END" % (
+    ' '.join(["WHEN '%s' THEN %d" % (kind, i)
+              for i, kind in enumerate(COMPL_KIND_ORDER)]),
+    len(COMPL_KIND_ORDER))
+
+# 没有访问控制信息的类成员函数(类外的定义), 补全时使用类内的原型
+NO_ACCESS_MEMBER_FUNC_COND = \
+        " NOT (kind = 'f' AND parent_kind = 'c' AND "\
+        "(access IS NULL OR access = '')) "
+
+# 构造和析构函数: 名字与作用域的最后一部分相同, eg. A::B::B, A::B::~B
+CTOR_DTOR_COND = \
+        " kind IN ('f', 'p') AND (scope = name "\
+        "OR substr(scope, -length(name) - 2) = '::' || name "\
+        "OR (substr(name, 1, 1) = '~' AND (scope = substr(name, 2) "\
+        "OR substr(scope, -length(name) - 1) = '::' || substr(name, 2)))) "
+
+# sqlite 3.25 开始支持窗口函数, 用于在查询中消除被遮蔽的名字
+HAS_WINDOW_FUNCTIONS = sqlite3.sqlite_version_info >= (3, 25, 0)
+
+def ScopeRankSQL(count):
+    '''作用域在 count 个参数中的位置的表达式, 重复的参数取第一个位置'''
+    return "CASE scope %s ELSE %d END" % (
+        ' '.join(["WHEN ? THEN %d" % i for i in range(count)]), count)
+
+# 补全项目的 word, 函数加上括号
+COMPL_WORD_SQL = "name || CASE WHEN kind IN ('f', 'p') THEN '()' ELSE '' END"
+
+# 补全菜单中的访问控制符号, 与 TagEntry.COMPL_ACCESS_MAPPING 相同
+COMPL_ACCESS_SQL = "CASE WHEN access IS NULL OR access = '' THEN '' "\
+        "WHEN access = 'public' THEN '+' WHEN access = 'protected' THEN '#' "\
+        "WHEN access = 'private' THEN '-' ELSE ' ' END"
+
+def ScopeParentSQL(count):
+    '''作用域的最后一部分(即 TagEntry.parent)的表达式, 参数为 count 对
+    (作用域, 最后一部分), SQLite 没有反向查找, 所以由调用者计算'''
+    return "CASE scope %s ELSE '' END" % ' '.join(["WHEN ? THEN ?"] * count)
+
+def TagEntry2Row(tagEntry):
+    '''把 TagEntry 转为 TAGS 表的一行, 不包括 id 列
+    批量导入时每个标签都要调用, 所以直接访问属性而不是用 Get*()'''
+    exts = tagEntry.exts
+    return (tagEntry.name,
+            tagEntry.file,
+            tagEntry.fileid,
+            tagEntry.line,
+            tagEntry.kind,
+            tagEntry.scope,
+            exts.get('parent_kind', ''),
+            exts.get('access', ''),
+            exts.get('inherits', ''),
+            exts.get('signature', ''),
+            tagEntry.extra,
+            GenPath(tagEntry.scope, tagEntry.name))
+
+INSERT_TAG_SQL = "INSERT OR REPLACE INTO TAGS VALUES (NULL, "\
+        "?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+# 数据库被锁住时等待的秒数, WAL 模式下只有写入者之间会互相等待
+BUSY_TIMEOUT = 5.0
+# WAL 文件达到这么多页时自动检查点
+WAL_AUTOCHECKPOINT = 4096
+
+# 批量导入时每次 executemany() 的行数
+BULK_CHUNK_SIZE = 4096
+
+# TAGS 表的二级索引, 初次建立数据库时先删除, 导入完成后再建立,
+# 插入和建立索引的总耗时少 20% 左右, 见 Benchmark.py
+# TAGS_UNIQ_IDX 是 INSERT OR REPLACE 所依赖的, 不在此列
+TAGS_SECONDARY_INDEXES = [
+    ('TAGS_KIND_IDX',
+     "CREATE INDEX IF NOT EXISTS TAGS_KIND_IDX ON TAGS(kind);"),
+    ('TAGS_FILE_IDX',
+     "CREATE INDEX IF NOT EXISTS TAGS_FILE_IDX ON TAGS(file);"),
+    ('TAGS_NAME_IDX',
+     "CREATE INDEX IF NOT EXISTS TAGS_NAME_IDX ON TAGS(name);"),
+    #"CREATE INDEX IF NOT EXISTS TAGS_PARENT_IDX ON TAGS(parent);",
+
+    # 补全时的常用查询都是这几种组合, 一次索引查找即可
+    # (scope, name) 兼作 scope 的索引
+    ('TAGS_PATH_KIND_IDX',
+     "CREATE INDEX IF NOT EXISTS TAGS_PATH_KIND_IDX ON TAGS(path, kind);"),
+    ('TAGS_SCOPE_NAME_IDX',
+     "CREATE INDEX IF NOT EXISTS TAGS_SCOPE_NAME_IDX ON TAGS(scope, name);"),
+    # 不区分大小写的名字前缀查询, 见 _NameCondition()
+    ('TAGS_SCOPE_NAME_NOCASE_IDX',
+     "CREATE INDEX IF NOT EXISTS TAGS_SCOPE_NAME_NOCASE_IDX "
+     "ON TAGS(scope, name COLLATE NOCASE);"),
+    ('TAGS_SCOPE_KIND_IDX',
+     "CREATE INDEX IF NOT EXISTS TAGS_SCOPE_KIND_IDX ON TAGS(scope, kind);"),
+]
+
+# 当前版本的数据库必须存在的全部索引, 用于判断是否需要执行 CreateSchema()
+# 批量导入中途退出的话, 版本号是对的但是二级索引不存在
+SCHEMA_INDEXES = ['FILES_UNIQ_IDX', 'TAGS_UNIQ_IDX', 'TAGS_VERSION_UNIQ_IDX'] \
+        + [name for name, sql in TAGS_SECONDARY_INDEXES]
+
+SCHEMA_CHECK_SQL = "SELECT (SELECT max(version) FROM TAGS_VERSION), "\
+        "(SELECT count(*) FROM sqlite_master WHERE type = 'index' "\
+        "AND name IN %s)" % MakeQMarkString(len(SCHEMA_INDEXES))
+
+def TagLinesToEntries(lines):
+    '''把 ctags 输出的行逐行转为 TagEntry, 跳过注释和无效的行'''
+    for line in lines:
+        if not line or line.startswith('!'): # 跳过注释
+            continue
+        tagEntry = TagEntry()
+        tagEntry.FromLine(line)
+        if tagEntry.IsValid():
+            yield tagEntry
+
+def StatFile(fname):
+    '''返回 (大小, 纳秒单位的修改时间), 不是普通文件的话返回 None'''
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    if not os.path.stat.S_ISREG(st.st_mode):
+        return None
+    # python2 没有 st_mtime_ns, 精度受限于浮点数, 但同一平台上是稳定的
+    return st.st_size, int(st.st_mtime * 1000000000)
+
+def HashFile(fname):
+    '''文件内容的散列值, 读取失败返回空字符串'''
+    h = hashlib.md5()
+    try:
+        with open(fname, 'rb') as f:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                h.update(data)
+    except IOError:
+        return ''
+    return h.hexdigest()
+
+def FileSignature(fname):
+    '''返回 (大小, 修改时间, 散列值), 在 parse 之前获取
+    这样 parse 期间的修改在下次会被发现. 不是普通文件的话返回 None'''
+    st = StatFile(fname)
+    if st is None:
+        return None
+    return st + (HashFile(fname), )
+
+def PrintExcept(*args):
     '''打印异常'''
     pass
 
+class ConnectionPool(object):
+    '''进程内的数据库连接池
+
+    sqlite3 的连接只能在建立它的线程中使用, 所以空闲的连接按线程保存,
+    键为 (数据库文件, 是否只读). 归还的连接已经设置好 PRAGMA, 再次打开
+    同一个数据库的时候直接取出, 不需要重新连接和检查数据库结构.
+    数据库结构按文件只检查一次, 重建数据库的时候需要调用 Invalidate()'''
+    def __init__(self, maxIdle = 4):
+        # 每个线程每个键最多保留的空闲连接数
+        self.maxIdle = maxIdle
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # {数据库文件: 代数}, Invalidate() 后旧的连接不再放回池中
+        self.generations = {}
+        # 已经检查过数据库结构的文件
+        self.checked = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _Idle(self):
+        idle = getattr(self.local, 'idle', None)
+        if idle is None:
+            idle = self.local.idle = {}
+        return idle
+
+    def GetGeneration(self, fname):
+        with self.lock:
+            return self.generations.get(fname, 0)
+
+    def Acquire(self, key):
+        '''返回 (空闲的连接, 代数), 没有可用的连接时连接为 None'''
+        gen = self.GetGeneration(key[0])
+        conns = self._Idle().get(key)
+        while conns:
+            conn, connGen = conns.pop()
+            if connGen == gen:
+                with self.lock:
+                    self.hits += 1
+                return conn, gen
+            conn.close()
+        with self.lock:
+            self.misses += 1
+        return None, gen
+
+    def Release(self, key, conn, gen):
+        '''归还连接, 未提交的事务会被回滚'''
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        conns = self._Idle().setdefault(key, [])
+        if gen != self.GetGeneration(key[0]) or len(conns) >= self.maxIdle:
+            conn.close()
+            return
+        conns.append((conn, gen))
+
+    def IsSchemaChecked(self, fname):
+        with self.lock:
+            return fname in self.checked
+
+    def SetSchemaChecked(self, fname):
+        with self.lock:
+            self.checked.add(fname)
+
+    def Invalidate(self, fname):
+        '''数据库文件被删除或重建, 丢弃所有线程中的空闲连接
+        当前线程的空闲连接立即关闭, 其他线程的在下次取出时关闭'''
+        with self.lock:
+            self.generations[fname] = self.generations.get(fname, 0) + 1
+            self.checked.discard(fname)
+        idle = self._Idle()
+        for key in [k for k in idle if k[0] == fname]:
+            for conn, gen in idle.pop(key):
+                conn.close()
+
+    def Clear(self):
+        '''关闭当前线程的所有空闲连接, 线程退出前可以调用'''
+        idle = self._Idle()
+        for conns in idle.itervalues():
+            for conn, gen in conns:
+                conn.close()
+        idle.clear()
+
+    def GetStats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'checked': len(self.checked)}
+
+CONNECTION_POOL = ConnectionPool()
+
 class TagsStorageSQLite(ITagsStorage):
-    def __init__(self):
+    def __init__(self, wal = False, readOnly = False,
+                 busyTimeout = BUSY_TIMEOUT, pooled = True):
+        '''
+        wal:        使用 WAL 日志模式, parse 的时候补全线程依然可以读取
+        readOnly:   只读的连接, 供补全线程使用, 不建立或升级数据库结构
+        pooled:     从 CONNECTION_POOL 取得连接, 关闭时归还
+        '''
         ITagsStorage.__init__(self)
         self.fname = ''     # 数据库文件, os.path.realpath() 的返回值
         self.db = None      # sqlite3 的连接实例, 取此名字是为了与 codelite 统一
+        self.wal = wal
+        self.readOnly = readOnly
+        self.busyTimeout = busyTimeout
+        self.pooled = pooled
+        # 连接从池中取出时的代数, 为 None 表示不归还
+        self.poolGen = None
+        # 内存索引, 见 EnableSymbolIndex()
+        self.symbolIndex = None
+        # 上一次查询时的 PRAGMA data_version, 见 CheckDataVersion()
+        self.dataVersion = None
 
     def __del__(self):
-        if self.db:
-            self.db.close()
-            self.db = None
+        self.CloseDatabase()
 
     def GetVersion(self):
         global STORAGE_VERSION
@@ -88,8 +406,16 @@ class TagsStorageSQLite(ITagsStorage):
 
     def CloseDatabase(self):
         if self.IsOpen():
-            self.db.close()
+            if self.poolGen is not None:
+                CONNECTION_POOL.Release((self.fname, self.readOnly), self.db,
+                                        self.poolGen)
+            else:
+                self.db.close()
             self.db = None
+            self.poolGen = None
+
+    def GetDatabaseFileName(self):
+        return self.fname
 
     def OpenDatabase(self, fname):
         '''正常返回0, 异常返回-1'''
@@ -111,22 +437,85 @@ class TagsStorageSQLite(ITagsStorage):
             return 0
 
         orig_fname = fname
-        if not fname == ':memory:' # ':memory:' 是一个特殊值, 表示内存数据库
+        if not fname == ':memory:': # ':memory:' 是一个特殊值, 表示内存数据库
             fname = os.path.realpath(fname)
 
         # 先把旧的关掉
         self.CloseDatabase()
+        self.ClearCache()
 
+        # 每个内存数据库都是独立的, 不能放到池中
+        pooled = self.pooled and fname != ':memory:'
+        key = (fname, self.readOnly)
         try:
-            self.db = sqlite3.connect(ToU(fname))
-            self.db.text_factory = str # 以字符串方式保存而不是 unicode
-            self.CreateSchema()
+            gen = None
+            if pooled:
+                self.db, gen = CONNECTION_POOL.Acquire(key)
+            if not self.db:
+                self.Connect(fname)
+            # 只读连接不写入任何东西, 数据库结构由写入者负责
+            if not self.readOnly and \
+                    not (pooled and CONNECTION_POOL.IsSchemaChecked(fname)):
+                self.CreateSchema()
+                if pooled:
+                    CONNECTION_POOL.SetSchemaChecked(fname)
             self.fname = fname
+            self.poolGen = gen
             return 0
         except sqlite3.OperationalError:
             PrintExcept()
+            if self.db:
+                self.db.close()
+                self.db = None
             return -1
 
+    def Connect(self, fname):
+        '''建立新的连接并设置好各个连接级别的 PRAGMA'''
+        self.db = sqlite3.connect(ToU(fname), timeout=self.busyTimeout,
+                                  cached_statements=STATEMENT_CACHE_SIZE)
+        self.db.text_factory = str # 以字符串方式保存而不是 unicode
+        # improve performace by using pragma command
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("PRAGMA temp_store = MEMORY")
+        if self.wal and fname != ':memory:':
+            self.EnableWal()
+        if self.readOnly:
+            self.db.execute("PRAGMA query_only = ON")
+
+    def EnableWal(self):
+        '''切换到 WAL 模式, 此模式是持久的, 保存在数据库文件中'''
+        try:
+            mode = self.db.execute("PRAGMA journal_mode = WAL").fetchone()
+            self.db.execute("PRAGMA wal_autocheckpoint = %d"
+                            % WAL_AUTOCHECKPOINT)
+        except sqlite3.OperationalError:
+            PrintExcept()
+            return False
+        return bool(mode) and mode[0].lower() == 'wal'
+
+    def IsWal(self):
+        if not self.IsOpen():
+            return False
+        try:
+            mode = self.db.execute("PRAGMA journal_mode").fetchone()
+        except sqlite3.OperationalError:
+            return False
+        return bool(mode) and mode[0].lower() == 'wal'
+
+    def Checkpoint(self, mode = 'PASSIVE'):
+        '''把 WAL 文件的内容写回数据库, mode 为 PASSIVE, FULL, RESTART 或
+        TRUNCATE. 返回 (是否被阻塞, WAL 页数, 已写回的页数), 失败返回 None'''
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            return None
+        if not self.IsOpen():
+            return None
+        try:
+            return self.db.execute("PRAGMA wal_checkpoint(%s)"
+                                   % mode).fetchone()
+        except sqlite3.OperationalError:
+            PrintExcept()
+            return None
+
     def ExecuteSQL(self, sql):
         '''NOTE: 不完全封装, 暂时不支持如果封装带占位符形式的参数, 懒得测试'''
         if not sql or not self.IsOpen():
@@ -164,22 +553,34 @@ class TagsStorageSQLite(ITagsStorage):
             "DROP INDEX IF EXISTS TAGS_FILE_IDX;",
             "DROP INDEX IF EXISTS TAGS_NAME_IDX;",
             "DROP INDEX IF EXISTS TAGS_SCOPE_IDX;",
+            "DROP INDEX IF EXISTS TAGS_PATH_KIND_IDX;",
+            "DROP INDEX IF EXISTS TAGS_SCOPE_NAME_IDX;",
+            "DROP INDEX IF EXISTS TAGS_SCOPE_NAME_NOCASE_IDX;",
+            "DROP INDEX IF EXISTS TAGS_SCOPE_KIND_IDX;",
             "DROP INDEX IF EXISTS TAGS_VERSION_UNIQ_IDX;",
         ]
 
         for sql in sqls:
             self.ExecuteSQL(sql)
+        CONNECTION_POOL.Invalidate(self.fname)
 
-    def CreateSchema(self):
+    def IsSchemaCurrent(self):
+        '''数据库结构是否为当前版本且完整, 只需要一次只读的查询'''
         try:
-            # improve performace by using pragma command:
-            # (this needs to be done before the creation of the
-            # tables and indices)
-            sql = "PRAGMA synchronous = OFF;"
-            self.ExecuteSQL(sql)
+            row = self.db.execute(SCHEMA_CHECK_SQL, SCHEMA_INDEXES).fetchone()
+        except sqlite3.OperationalError:
+            # 表不存在, 新的数据库
+            return False
+        return row[0] == self.GetVersion() and row[1] == len(SCHEMA_INDEXES)
 
-            sql = "PRAGMA temp_store = MEMORY;"
-            self.ExecuteSQL(sql)
+    def CreateSchema(self):
+        # 已经是当前版本的数据库不执行任何 DDL 和写操作,
+        # 否则即使什么都不改变, 提交也是一次写事务, 会和其他写入者竞争
+        if self.IsSchemaCurrent():
+            return
+
+        try:
+            # PRAGMA 在 Connect() 中设置
 
             # TAGS 表
             sql = '''
@@ -195,22 +596,29 @@ class TagsStorageSQLite(ITagsStorage):
                 access          STRING,
                 inherits        STRING,
                 signature       STRING,
-                extra           STRING);
+                extra           STRING,
+                path            STRING);
             '''
 
             self.ExecuteSQL(sql)
 
+            # 旧版本的数据库需要先升级, 之后才能建立索引
+            self.MigrateSchema()
+
             # FILES 表
             sql = '''
             CREATE TABLE IF NOT EXISTS FILES (
-                id      INTEGER PRIMARY KEY AUTOINCREMENT,
-                file    STRING,
-                tagtime INTEGER);
+                id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                file        STRING,
+                tagtime     INTEGER,
+                size        INTEGER,
+                mtime_ns    INTEGER,
+                hash        STRING);
             '''
             self.ExecuteSQL(sql)
 
             sqls = [
-                'CREATE UNIQUE INDEX IF NOT EXISTS FILES_UNIQ_IDX ON FILES(file);';
+                'CREATE UNIQUE INDEX IF NOT EXISTS FILES_UNIQ_IDX ON FILES(file);',
 
                 # 唯一索引 mod on 2011-01-07
                 # 不同源文件文件之间会存在相同的符号
@@ -222,21 +630,18 @@ class TagsStorageSQLite(ITagsStorage):
                     name, file, kind, scope, signature);
                 ''',
 
-                "CREATE INDEX IF NOT EXISTS TAGS_KIND_IDX ON TAGS(kind);",
-                "CREATE INDEX IF NOT EXISTS TAGS_FILE_IDX ON TAGS(file);",
-                "CREATE INDEX IF NOT EXISTS TAGS_NAME_IDX ON TAGS(name);",
-                "CREATE INDEX IF NOT EXISTS TAGS_SCOPE_IDX ON TAGS(scope);",
-                #"CREATE INDEX IF NOT EXISTS TAGS_PARENT_IDX ON TAGS(parent);",
-
                 # TAGS_VERSION 表
                 "CREATE TABLE IF NOT EXISTS TAGS_VERSION (version INTEGER PRIMARY KEY);",
                 "CREATE UNIQUE INDEX IF NOT EXISTS TAGS_VERSION_UNIQ_IDX ON TAGS_VERSION(version);",
             ]
 
+            sqls += [sql for name, sql in TAGS_SECONDARY_INDEXES]
+
             for sql in sqls:
                 self.ExecuteSQL(sql)
 
-            # 插入数据
+            # 插入数据, 只保留当前的版本号
+            self.db.execute("DELETE FROM TAGS_VERSION")
             self.db.execute("INSERT OR REPLACE INTO TAGS_VERSION VALUES(?)",
                             (self.GetVersion(), ))
 
@@ -245,14 +650,48 @@ class TagsStorageSQLite(ITagsStorage):
         except sqlite3.OperationalError:
             PrintExcept()
 
+    def MigrateSchema(self):
+        '''在线升级旧版本的数据库, 由 CreateSchema() 调用'''
+        version = self.GetSchemaVersion()
+        if not version or version >= self.GetVersion():
+            return
+
+        # 3000 -> 3001: 添加 path 列, 由 scope 和 name 生成
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(TAGS)")]
+        if 'path' not in columns:
+            self.db.execute("ALTER TABLE TAGS ADD COLUMN path STRING")
+            self.db.execute(
+                "UPDATE TAGS SET path = CASE "
+                "WHEN scope = '<global>' OR scope IS NULL OR scope = '' "
+                "THEN name ELSE scope || '::' || name END")
+            # 已经被 TAGS_SCOPE_NAME_IDX 代替
+            self.db.execute("DROP INDEX IF EXISTS TAGS_SCOPE_IDX")
+
+        # 3001 -> 3002: FILES 表添加文件状态和散列值
+        # 旧的条目的散列值为空, 由 PlanReindex() 按原来的时间戳规则处理
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(FILES)")]
+        if columns and 'hash' not in columns:
+            self.db.execute("ALTER TABLE FILES ADD COLUMN size INTEGER")
+            self.db.execute("ALTER TABLE FILES ADD COLUMN mtime_ns INTEGER")
+            self.db.execute("ALTER TABLE FILES ADD COLUMN hash STRING")
+
     def RecreateDatabase(self):
-        '''只有打开数据库的时候才能进行这个操作'''
+        '''只有打开数据库的时候才能进行这个操作
+
+        CONNECTION_POOL.Invalidate() 只丢弃空闲的连接, 其他线程正在使用的
+        连接依然指向旧的文件. 调用者需要先停止后台的写入者并持有
+        WRITER_LOCK, 见 TagsManager.RecreateDatabase()'''
         if not self.IsOpen():
             return -1
 
         # 处理后事
         self.Commit()
+        if self.wal:
+            # 尽量把 WAL 写回并清空, 下面还会删除 -wal 和 -shm 文件
+            self.Checkpoint('TRUNCATE')
         self.CloseDatabase()
+        # 各个线程中的空闲连接都指向旧的文件
+        CONNECTION_POOL.Invalidate(self.fname)
 
         # 内存数据库的话, 直接这样就行了
         if self.fname == ':memory:':
@@ -262,6 +701,10 @@ class TagsStorageSQLite(ITagsStorage):
         # 重新打开并重建 schema
         try:
             os.remove(self.fname)
+            # 残留的日志文件会被当作新数据库的日志, 必须一起删除
+            for suffix in ('-wal', '-shm', '-journal'):
+                if os.path.exists(self.fname + suffix):
+                    os.remove(self.fname + suffix)
         except:
             PrintExcept("Failed to remove %s" % self.fname)
             # Reopen the database
@@ -277,9 +720,9 @@ class TagsStorageSQLite(ITagsStorage):
     def GetSchemaVersion(self):
         version = 0
         try:
-            sql = "SELECT * FROM TAGS_VERSION;"
+            sql = "SELECT max(version) FROM TAGS_VERSION;"
             for row in self.db.execute(sql):
-                version = int(row[0])
+                version = int(row[0] or 0)
                 break
         except sqlite3.OperationalError:
             pass
@@ -303,52 +746,9 @@ class TagsStorageSQLite(ITagsStorage):
                 return False
 
             self.OpenDatabase(dbFile) # 这里, 如果 dbFile 为空, 表示使用原来的
-            try:
-                updateList = [] # 不存在的直接插入, 存在的需要更新
-
-                if auto_commit:
-                    self.Begin()
-                    #self.db.execute('begin;')
-
-                tagList = tags.split('\n')
-                tagListLen = len(tagList)
-                for idx, line in enumerate(tagList):
-                    # does not matter if we insert or update, 
-                    # the cache must be cleared for any related tags
-
-                    if indicator:
-                        indicator(idx, tagListLen - 1)
-
-                    tagEntry = TagEntry()
-                    tagEntry.FromLine(line)
-
-                    if not self.InsertTagEntry(tagEntry):
-                        # 插入不成功?
-                        # InsertTagEntry() 貌似是不会失败的?!
-                        updateList.append(tagEntry)
-
-                if auto_commit:
-                    self.Commit()
-
-                # Do we need to update?
-                if updateList:
-                    if auto_commit:
-                        self.Begin()
-                        #self.db.execute('begin;')
-
-                    for i in updateList:
-                        self.UpdateTagEntry(i)
-
-                    if auto_commit:
-                        self.Commit()
-                ret = True
-            except sqlite3.OperationalError:
-                ret = False
-                try:
-                    if auto_commit:
-                        self.db.rollback()
-                except sqlite3.OperationalError:
-                    pass
+            tagList = tags.split('\n')
+            ret = self.StoreLines(tagList, auto_commit, indicator,
+                                  len(tagList))
         else:
             pass
         return ret
@@ -365,60 +765,113 @@ class TagsStorageSQLite(ITagsStorage):
 
         self.OpenDatabase(dbFile) # 这里, 如果 dbFile 为空, 表示使用原来的
         try:
-            updateList = [] # 不存在的直接插入, 存在的需要更新
+            f = open(tagFile)
+        except:
+            return False
 
+        # 不需要一次读入整个文件
+        ret = self.StoreLines(f, auto_commit)
+        f.close()
+
+        return ret
+
+    def DiffStoreTagEntries(self, fname, tagEntries):
+        '''用 fname 的新标签集合更新数据库, 只插入, 删除, 更新改变了的行
+        标签的标识与 TAGS_UNIQ_IDX 相同: (name, kind, scope, signature)
+        不负责事务, 返回改动的行数'''
+        stored = {}
+        sql = "SELECT id, name, kind, scope, signature, "\
+                "fileid, line, parent_kind, access, inherits, extra "\
+                "FROM TAGS WHERE file = ?"
+        for row in self.db.execute(sql, (fname, )):
+            stored[row[1:5]] = (row[0], row[5:])
+
+        inserts = []
+        updates = []
+        seen = set()
+        for tagEntry in tagEntries:
+            row = TagEntry2Row(tagEntry)
+            key = (row[0], row[4], row[5], row[9])
+            if key in seen:
+                # 重复的标签, 与 INSERT OR REPLACE 一样, 后面的覆盖前面的
+                inserts.append(row)
+                continue
+            seen.add(key)
+            old = stored.pop(key, None)
+            if old is None:
+                inserts.append(row)
+            elif old[1] != (row[2], row[3], row[6], row[7], row[8], row[10]):
+                updates.append((row[2], row[3], row[6], row[7], row[8],
+                                row[10], old[0]))
+        # 剩下的就是已经不存在的标签
+        deletes = [(v[0], ) for v in stored.itervalues()]
+
+        if deletes:
+            self.db.executemany("DELETE FROM TAGS WHERE id = ?", deletes)
+        if updates:
+            # 这些列都不在二级索引里面, 不会引起索引的改动
+            self.db.executemany(
+                "UPDATE TAGS SET fileid=?, line=?, parent_kind=?, access=?, "
+                "inherits=?, extra=? WHERE id = ?", updates)
+        if inserts:
+            self.db.executemany(INSERT_TAG_SQL, inserts)
+
+        if deletes or updates or inserts:
+            self.InvalidateFiles([fname])
+        if inserts:
+            # 新的标签可能出现在其他条目的结果中
+            self.InvalidateTags(tagEntries)
+
+        return len(deletes) + len(updates) + len(inserts)
+
+    def DiffStoreLines(self, lines, files, auto_commit = True):
+        '''以文件为单位, 用 ctags 输出的行更新 files 的标签
+        ctags 的输出中同一个文件的标签是连续的, 所以只需保存一个文件的标签
+        files 中没有任何标签的文件, 其标签全部删除
+        返回 {文件: 改动的行数}, 失败返回 None'''
+        touched = {}
+        try:
             if auto_commit:
                 self.Begin()
 
-            try:
-                f = open(tagFile)
-            except:
-                return False
-
-            for line in f:
-                # does not matter if we insert or update, 
-                # the cache must be cleared for any related tags
-                if line.startswith('!'): # 跳过注释
+            for fname, group in itertools.groupby(TagLinesToEntries(lines),
+                                                  lambda t: t.file):
+                if fname in touched:
+                    # 不应该出现, 保险起见直接插入
+                    self.BulkInsertTagEntries(group)
                     continue
+                touched[fname] = self.DiffStoreTagEntries(fname, list(group))
 
-                tagEntry = TagEntry()
-                tagEntry.FromLine(line)
-
-                if not self.InsertTagEntry(tagEntry):
-                    # 插入不成功?
-                    # InsertTagEntry() 貌似是不会失败的?!
-                    updateList.append(tagEntry)
-
-                # enumerator 要双份，因为在两个作用域内有效
-                # added on 2012-05-17
-                #if tagEntry.GetParentType() == 'enum':
-                #    tagEntryDup = tagEntry
-                #    # 需要修改 scope 和 path
-                #    scope = tagEntryDup.GetScope()
-                #    # 扔掉 scope 最后的部分
-                #    scope = '::'.join(scope.split('::')[:-1])
-                #    if not scope:
-                #        scope = '<global>'
-                #    tagEntryDup.SetScope(scope)
-                #    tagEntryDup.UpdatePath(scope)
-                #    if not self.InsertTagEntry(tagEntryDup):
-                #        updateList.append(tagEntryDup)
+            for fname in files:
+                if fname not in touched:
+                    touched[fname] = self.DiffStoreTagEntries(fname, [])
 
             if auto_commit:
                 self.Commit()
-
-            # Do we need to update?
-            if updateList:
+        except sqlite3.OperationalError:
+            try:
                 if auto_commit:
-                    self.Begin()
+                    self.db.rollback()
+            except sqlite3.OperationalError:
+                pass
+            return None
 
-                for i in updateList:
-                    self.UpdateTagEntry(i)
+        return touched
 
-                if auto_commit:
-                    self.Commit()
+    def StoreLines(self, lines, auto_commit = True, indicator = None,
+                   total = 0):
+        '''批量保存 ctags 输出的行, lines 可以是任何可迭代对象
+        total 为行数, 仅用于 indicator'''
+        ret = False
+        try:
+            if auto_commit:
+                self.Begin()
+
+            self.BulkInsertTagEntries(TagLinesToEntries(lines), indicator,
+                                      total)
 
-            f.close()
+            if auto_commit:
+                self.Commit()
             ret = True
         except sqlite3.OperationalError:
             ret = False
@@ -430,6 +883,61 @@ class TagsStorageSQLite(ITagsStorage):
 
         return ret
 
+    def BulkInsertTagEntries(self, tagEntries, indicator = None, total = 0):
+        '''用 executemany() 分块插入, 不负责事务, 返回插入的数量
+        INSERT OR REPLACE 的语义下已存在的标签会被替换, 不需要再更新'''
+        count = 0
+        chunk = []
+        for tagEntry in tagEntries:
+            chunk.append(tagEntry)
+            if len(chunk) < BULK_CHUNK_SIZE:
+                continue
+            self.db.executemany(INSERT_TAG_SQL, map(TagEntry2Row, chunk))
+            self.InvalidateTags(chunk)
+            count += len(chunk)
+            chunk = []
+            if indicator and total:
+                indicator(min(count, total - 1), total - 1)
+
+        if chunk:
+            self.db.executemany(INSERT_TAG_SQL, map(TagEntry2Row, chunk))
+            self.InvalidateTags(chunk)
+            count += len(chunk)
+
+        if indicator and total:
+            indicator(total - 1, total - 1)
+        return count
+
+    def IsTagsEmpty(self):
+        for row in self.Query("SELECT 1 FROM TAGS LIMIT 1"):
+            return False
+        return True
+
+    def BeginBulkLoad(self):
+        '''开始批量导入, TAGS 表为空的时候先删除二级索引
+        返回 True 表示是初次导入(已删除索引), 需要调用 EndBulkLoad()'''
+        if not self.IsOpen() or not self.IsTagsEmpty():
+            return False
+        try:
+            for name, sql in TAGS_SECONDARY_INDEXES:
+                self.db.execute("DROP INDEX IF EXISTS %s" % name)
+            self.Commit()
+        except sqlite3.OperationalError:
+            PrintExcept()
+            return False
+        return True
+
+    def EndBulkLoad(self):
+        '''结束批量导入, 重建二级索引'''
+        if not self.IsOpen():
+            return
+        try:
+            for name, sql in TAGS_SECONDARY_INDEXES:
+                self.db.execute(sql)
+            self.Commit()
+        except sqlite3.OperationalError:
+            PrintExcept()
+
     def SelectTagsByFile(self, file, dbFile = ''):
         '''取出属于 file 文件的全部标签'''
         # Incase empty dbFile is provided, use the current file name
@@ -437,8 +945,8 @@ class TagsStorageSQLite(ITagsStorage):
             dbFile = self.fname
         self.OpenDatabase(dbFile)
 
-        sql = "select * from tags where file='" + file + "' "
-        return self.DoFetchTags(sql)
+        sql = "select * from tags where file=?"
+        return self.DoFetchTags(sql, params = (file, ))
 
     def DeleteByFileName(self, dbFile, fname, auto_commit = True):
         # [DEPRECATE]
@@ -451,6 +959,7 @@ class TagsStorageSQLite(ITagsStorage):
                 #self.db.execute('begin;')
 
             self.db.execute("DELETE FROM TAGS WHERE file=?", (fname, ))
+            self.InvalidateFiles([fname])
 
             if auto_commit:
                 self.Commit()
@@ -467,8 +976,10 @@ class TagsStorageSQLite(ITagsStorage):
             if auto_commit:
                 self.Begin()
 
-            self.db.execute(
-                "DELETE FROM tags WHERE file IN('%s')" % "', '".join(files))
+            for qmarks, params in SplitInParams(files):
+                self.db.execute("DELETE FROM tags WHERE file IN %s" % qmarks,
+                                params)
+            self.InvalidateFiles(files)
 
             if auto_commit:
                 self.Commit()
@@ -486,6 +997,7 @@ class TagsStorageSQLite(ITagsStorage):
                 self.Begin()
             self.db.execute("UPDATE TAGS set file=? WHERE file=?",
                             (newFile, oldFile))
+            self.InvalidateFiles([oldFile, newFile])
             if auto_commit:
                 self.Commit()
             ret = True
@@ -495,17 +1007,29 @@ class TagsStorageSQLite(ITagsStorage):
                 self.Rollback()
         return ret
 
-    def Query(self, sql, dbFile = ''):
+    def Query(self, sql, dbFile = '', params = ()):
         '''Execute a query sql and return result set.
 
-        这个函数特别之处在于自动 OpenDatabase()'''
+        这个函数特别之处在于自动 OpenDatabase()
+        params 为绑定到 sql 的占位符的参数'''
         try:
             self.OpenDatabase(dbFile)
-            return self.db.execute(sql)
+            return self.db.execute(sql, params)
         except:
             pass
         return [] # 具备迭代器的空对象
 
+    def QueryIn(self, sql, items, before = (), after = ()):
+        '''执行带有 IN 语句的查询, sql 中的 %s 会替换为 IN 的占位符
+        before 和 after 分别为 IN 语句之前和之后的占位符的参数
+        返回结果行的列表'''
+        rows = []
+        for qmarks, params in SplitInParams(items):
+            rows.extend(self.Query(sql % qmarks,
+                                   params = tuple(before) + tuple(params)
+                                            + tuple(after)))
+        return rows
+
     def ExecuteUpdate(self, sql):
         try:
             self.db.execute(sql)
@@ -518,6 +1042,16 @@ class TagsStorageSQLite(ITagsStorage):
         else:
             return False
 
+    def FileEntryFromResultSet(self, row):
+        fe = FileEntry()
+        fe.SetId(row[0])
+        fe.SetFile(row[1])
+        fe.SetLastRetaggedTimestamp(row[2])
+        fe.SetSize(row[3] or 0)
+        fe.SetMtimeNs(row[4] or 0)
+        fe.SetHash(row[5] or '')
+        return fe
+
     def GetFiles(self, partialName = ''):
         files = []
 
@@ -526,25 +1060,18 @@ class TagsStorageSQLite(ITagsStorage):
                 sql = "select * from files order by file"
                 res = self.db.execute(sql)
                 for row in res:
-                    fe = FileEntry()
-                    fe.SetId(row[0])
-                    fe.SetFile(row[1])
-                    fe.SetLastRetaggedTimestamp(row[2])
+                    fe = self.FileEntryFromResultSet(row)
                     files.append(fe)
             except:
                 pass
         else:
             try:
                 matchPath = partialName and partialName.endswith(os.sep)
-                tmpName = partialName.replace('_', '^_')
-                sql = "select * from files where file like '%" + tmpName \
-                        + "%' ESCAPE '^' "
-                res = self.db.execute(sql)
+                sql = "select * from files where file like ? ESCAPE '^' "
+                res = self.db.execute(sql,
+                                      ('%' + LikeEscape(partialName) + '%', ))
                 for row in res:
-                    fe = FileEntry()
-                    fe.SetId(row[0])
-                    fe.SetFile(row[1])
-                    fe.SetLastRetaggedTimestamp(row[2])
+                    fe = self.FileEntryFromResultSet(row)
 
                     fname = fe.GetFile()
                     match = os.path.basename(fname)
@@ -569,23 +1096,16 @@ class TagsStorageSQLite(ITagsStorage):
                 sql = "select * from files order by file"
                 res = self.db.execute(sql)
                 for row in res:
-                    fe = FileEntry()
-                    fe.SetId(row[0])
-                    fe.SetFile(row[1])
-                    fe.SetLastRetaggedTimestamp(row[2])
+                    fe = self.FileEntryFromResultSet(row)
                     filesMap[fe.GetFile()] = fe
             except:
                 pass
         else:
             try:
-                sql = "select * from files where file in('%s')" \
-                        % "','".join(matchFiles)
-                res = self.db.execute(sql)
+                res = self.QueryIn("select * from files where file in %s",
+                                   matchFiles)
                 for row in res:
-                    fe = FileEntry()
-                    fe.SetId(row[0])
-                    fe.SetFile(row[1])
-                    fe.SetLastRetaggedTimestamp(row[2])
+                    fe = self.FileEntryFromResultSet(row)
                     filesMap[fe.GetFile()] = fe
             except:
                 pass
@@ -595,9 +1115,9 @@ class TagsStorageSQLite(ITagsStorage):
     def DeleteByFilePrefix(self, dbFile, filePrefix):
         try:
             self.OpenDatabase(dbFile)
-            sql = "delete from tags where file like '" \
-                    + filePrefix.replace('_', '^_') + "%' ESCAPE '^' "
-            self.db.execute(sql)
+            sql = "delete from tags where file like ? ESCAPE '^' "
+            self.db.execute(sql, (LikeEscape(filePrefix) + '%', ))
+            self.InvalidateFilePrefix(filePrefix)
         except:
             pass
 
@@ -605,24 +1125,18 @@ class TagsStorageSQLite(ITagsStorage):
         if not files:
             return
 
-        sql = "delete from FILES where file in ("
-        for file in files:
-            sql += "'" + file + "',"
-
-        # remove last ','
-        sql = sql[:-1] + ')'
-
         try:
-            self.db.execute(sql)
+            for qmarks, params in SplitInParams(files):
+                self.db.execute("delete from FILES where file in %s" % qmarks,
+                                params)
         except:
             pass
 
     def DeleteFromFilesByPrefix(self, dbFile, filePrefix):
         try:
             self.OpenDatabase(dbFile)
-            sql = "delete from FILES where file like '" \
-                    + filePrefix.replace('_', '^_') + "%' ESCAPE '^' "
-            self.db.execute(sql)
+            sql = "delete from FILES where file like ? ESCAPE '^' "
+            self.db.execute(sql, (LikeEscape(filePrefix) + '%', ))
         except:
             pass
 
@@ -631,9 +1145,9 @@ class TagsStorageSQLite(ITagsStorage):
 
     def FromSQLite3ResultSet(self, row):
         '''从数据库的一行数据中提取标签对象
-| id | name | file | fileid | line | kind | scope | parent_kind | access | inherits | signature | extra |
-|----|------|------|--------|------|------|-------|-------------|--------|----------|-----------|-------|
-|    |      |      |        |      |      |       |             |        |          |           |       |
+| id | name | file | fileid | line | kind | scope | parent_kind | access | inherits | signature | extra | path |
+|----|------|------|--------|------|------|-------|-------------|--------|----------|-----------|-------|------|
+|    |      |      |        |      |      |       |             |        |          |           |       |      |
 '''
         entry = TagEntry()
         entry.id          = (row[0])
@@ -644,203 +1158,434 @@ class TagsStorageSQLite(ITagsStorage):
 
         entry.kind        = (row[5])
         entry.scope       = (row[6])
-        entry.parent_kind = (row[7])
-        entry.access      = (row[8])
-        entry.inherits    = (row[9])
-        entry.signature   = (row[10])
         entry.extra       = (row[11])
 
+        # 这些是 TagEntry 的扩展域, 列的顺序与 EXT_ROW_FIELDS 相同,
+        # 需要时才转为字典
+        entry.SetExtRow(row[7:11])
+
         return entry
 
     def _FetchTags(self, sql):
         pass
 
-    def DoFetchTags(self, sql, kinds = []):
-        '''从数据库中取出 tags'''
-        tags = []
+    def DoFetchTags(self, sql, kinds = [], params = ()):
+        '''从数据库中取出 tags
+        params 为绑定到 sql 的占位符的参数'''
+        key = (sql, tuple(params))
 
-        if not kinds:
-            if self.GetUseCache():
-                # 尝试从缓存中获取
-                tags = self.cache.Get(sql)
-                if tags:
-                    print '[CACHED ITEMS] %s\n' % sql
-                    return
+        if self.GetUseCache():
+            # 其他连接提交的修改不会经过本连接的失效, 先检查数据库版本
+            self.CheckDataVersion()
+            # 尝试从缓存中获取, 空结果也会缓存
+            tags = self.cache.Get(key, kinds)
+            if tags is not None:
+                return tags
 
-            try:
-                exRs = self.Query(sql)
+        tags = []
+        # 数据库中保存的是 kind 的缩写
+        kindSet = set(ToAbbrKinds(kinds))
+        try:
+            exRs = self.Query(sql, params = params)
+            for row in exRs:
+                if kindSet and row[5] not in kindSet:
+                    continue
+                tag = self.FromSQLite3ResultSet(row)
+                tags.append(tag)
+        except:
+            pass
 
-                # add results from external database to the workspace database
-                for row in exRs:
-                    tag = self.FromSQLite3ResultSet(row)
-                    tags.append(tag)
-            except:
-                pass
+        if self.GetUseCache():
+            # 保存到缓存以供下次快速使用
+            self.cache.Store(key, tags, kinds)
 
-            if self.GetUseCache():
-                # 保存到缓存以供下次快速使用
-                self.cache.Store(sql, tags)
-        else:
-            if self.GetUseCache():
-                # 尝试从缓存中获取
-                tags = self.cache.Get(sql, kinds)
-                if tags:
-                    print '[CACHED ITEMS] %s\n' % sql
-                    return
+        return tags
 
-            try:
-                exRs = self.Query(sql)
-                for row in exRs:
-                    try:
-                        kinds.index(row[7])
-                    except ValueError:
-                        continue
-                    else:
-                        tag = self.FromSQLite3ResultSet(row)
-                        tags.append(tag)
-            except:
-                pass
+    def DoFetchTagsIn(self, sql, items, before = (), after = (), kinds = []):
+        '''DoFetchTags() 的 IN 语句版本, 参数同 QueryIn()'''
+        tags = []
+        for qmarks, params in SplitInParams(items):
+            tags.extend(self.DoFetchTags(sql % qmarks, kinds,
+                                         tuple(before) + tuple(params)
+                                         + tuple(after)))
+        return tags
 
-            if self.GetUseCache():
-                # 保存到缓存以供下次快速使用
-                self.cache.Store(sql, tags, kinds)
+    def _NameCondition(self, name, partialMatch, icase = True):
+        '''返回名字匹配的条件语句和参数元组
 
-        return tags
+        前缀匹配使用范围查询, 这样才能用上 (scope, name) 的索引,
+        LIKE 加上 ESCAPE 之后 sqlite 不会使用索引.
+        icase 只影响前缀匹配, 为真时不区分 ASCII 字符的大小写(与 LIKE 相同),
+        使用 TAGS_SCOPE_NAME_NOCASE_IDX'''
+        if not partialMatch:
+            return " name = ? ", (name, )
 
-    def GetTagsByScopeAndName(self, scope, name, partialNameAllowed = False):
+        if icase:
+            column = "name COLLATE NOCASE"
+            name = name.lower()
+        else:
+            column = "name"
+        # 边界不是相等条件, 缓存不能用它们判断失效
+        upper = PrefixUpperBound(name, icase)
+        if upper is None:
+            return " %s >= ? " % column, (RangeBound(name), )
+        return " %s >= ? AND %s < ? " % (column, column), \
+                (RangeBound(name), RangeBound(upper))
+
+    def GetTagsByScopeAndName(self, scope, name, partialNameAllowed = False,
+                              icase = True):
         if type(scope) == type(''):
             if not scope:
                 return []
 
-            tmpName = name.replace('_', '^_')
-
-            sql = "select * from tags where "
-
-            # did we get scope?
-            if scope:
-                sql += "scope='" + scope + "' and "
-
-            # add the name condition
-            if partialNameAllowed:
-                sql += " name like '" + tmpName + "%' ESCAPE '^' "
-            else:
-                sql += " name ='" + name + "' "
-
-            sql += " LIMIT " + str(self.GetSingleSearchLimit())
+            cond, nameParams = self._NameCondition(name, partialNameAllowed,
+                                                   icase)
+            sql = "select * from tags where scope = ? and " + cond + " LIMIT ?"
 
             # get the tags
-            return self.DoFetchTags(sql)
+            return self.DoFetchTags(
+                sql, params = (scope, ) + nameParams
+                        + (self.GetSingleSearchLimit(), ))
         elif type(scope) == type([]):
             scopes = scope
             if not scopes:
                 return []
 
-            tmpName = name.replace('_', '^_')
-
-            sql = "select * from tags where scope in("
-            for i in scopes:
-                sql += "'" + i + "',"
-            sql = sql[:-1] + ") and "
-
-            # add the name condition
-            if partialNameAllowed:
-                sql += " name like '" + tmpName + "%' ESCAPE '^' "
-            else:
-                sql += " name ='" + name + "' "
+            cond, nameParams = self._NameCondition(name, partialNameAllowed,
+                                                   icase)
+            sql = "select * from tags where scope in %s and " + cond
 
             # get the tags
-            return self.DoFetchTags(sql)
+            return self.DoFetchTagsIn(sql, scopes, after = nameParams)
         else:
             return []
 
-    def GetOrderedTagsByScopesAndName(self, scopes, name, partialMatch = False):
+    def GetOrderedTagsByScopesAndName(self, scopes, name, partialMatch = False,
+                                      icase = True):
         '''获取按名字升序排序后的 tags'''
         if not scopes:
             return []
 
-        tmpName = name.replace('_', '^_')
-
-        sql = "select * from tags where scope in("
-        for i in scopes:
-            sql += "'" + i + "',"
-        sql = sql[:-1] + ") and "
+        limit = self.GetSingleSearchLimit()
+        if self.symbolIndex is not None and self.IsOpen() \
+                and self.symbolIndex.Sync(self.db):
+            return self.symbolIndex.GetOrderedTagsByScopesAndName(
+                scopes, name, partialMatch, limit, icase)
 
-        # add the name condition
-        if partialMatch:
-            sql += " name like '" + tmpName + "%' ESCAPE '^' "
-        else:
-            sql += " name ='" + name + "' "
+        cond, nameParams = self._NameCondition(name, partialMatch, icase)
+        sql = "select * from tags where scope in %s and " + cond \
+                + " order by name ASC LIMIT ?"
 
-        sql += 'order by name ASC'
-        sql += ' LIMIT ' + str(self.GetSingleSearchLimit())
+        tags = self.DoFetchTagsIn(sql, scopes, after = nameParams + (limit, ))
+        if len(scopes) > IN_BUCKETS[-1]:
+            # 分批查询的, 需要重新排序
+            tags.sort(key = lambda tag: tag.name)
+            del tags[limit:]
 
         # get the tags
-        return self.DoFetchTags(sql)
+        return tags
+
+    def GetRankedTagsByScopesAndName(self, scopes, name, partialMatch = True,
+                                     limit = None, icase = True,
+                                     excludeKinds = [], skipCtorDtor = False,
+                                     shadow = False):
+        '''获取补全用的 tags, 先应用全部过滤条件再截取前 limit 个
+        排序: 作用域在 scopes 中的位置, kind (COMPL_KIND_ORDER), 名字
+        @excludeKinds:  不需要的 kind
+        @skipCtorDtor:  跳过构造和析构函数
+        @shadow:        消除被遮蔽的名字, 即前面的作用域有同名的标签的话,
+                        跳过后面的作用域中的这个名字
+        没有访问控制信息的类成员函数总是跳过, 与 omnicxx.ToVimComplItem() 一致
+
+        过滤, 排序和消除遮蔽都在一次查询中完成, 作用域超过 IN_BUCKETS[-1] 个
+        时才分批查询'''
+        if not scopes:
+            return []
+        if limit is None:
+            limit = self.GetSingleSearchLimit()
+
+        scopes, ranks = self._RankScopes(scopes)
+        where, whereParams = self._RankedCondition(name, partialMatch, icase,
+                                                   excludeKinds, skipCtorDtor)
+        order = " order by srank, " + COMPL_KIND_RANK_SQL + ", name ASC LIMIT ?"
+        # 不支持窗口函数的话, 取出全部结果后再消除遮蔽
+        sqlLimit = limit
+        if shadow and not HAS_WINDOW_FUNCTIONS:
+            sqlLimit = -1
+
+        tags = []
+        # {名字: 第一次出现的作用域的位置}
+        firstRanks = {}
+        for qmarks, params in SplitInParams(scopes):
+            if len(tags) >= limit:
+                break
+            sql = self._RankedSQL("*", qmarks, len(params), where, shadow)
+            params = tuple(params)
+            for tag in self.DoFetchTags(sql + order,
+                                        params = params + params + whereParams
+                                        + (sqlLimit, )):
+                if shadow:
+                    # 分批查询的时候, 需要处理前面的批次的遮蔽
+                    rank = ranks[tag.scope]
+                    if firstRanks.setdefault(tag.name, rank) != rank:
+                        continue
+                tags.append(tag)
+                if len(tags) >= limit:
+                    break
+
+        return tags
+
+    def _RankScopes(self, scopes):
+        '''去掉重复的作用域, 保持顺序, 返回 (作用域列表, {作用域: 位置})'''
+        ranks = {}
+        for scope in scopes:
+            ranks.setdefault(scope, len(ranks))
+        return sorted(ranks, key = ranks.get), ranks
+
+    def _RankedCondition(self, name, partialMatch, icase, excludeKinds,
+                         skipCtorDtor):
+        '''补全查询的过滤条件, 返回 (条件, 参数)
+        name 为 None 时没有名字的条件'''
+        if name is None:
+            # 空的前缀也会产生范围条件, 使得 sqlite 扫描整个作用域
+            where, params = NO_ACCESS_MEMBER_FUNC_COND, ()
+        else:
+            cond, params = self._NameCondition(name, partialMatch, icase)
+            where = cond + " and " + NO_ACCESS_MEMBER_FUNC_COND
+            params = tuple(params)
+        excludeKinds = sorted(set(ToAbbrKinds(excludeKinds)))
+        if excludeKinds:
+            # kind 不多, 只有一档
+            for qmarks, kindParams in SplitInParams(excludeKinds):
+                where += " and kind not in " + qmarks
+                params += tuple(kindParams)
+        if skipCtorDtor:
+            where += " and not (" + CTOR_DTOR_COND + ")"
+        return where, params
+
+    def _RankedSQL(self, columns, qmarks, count, where, shadow):
+        '''一批作用域的补全查询, 结果包括 columns 和 srank 列
+        参数依次为: count 个作用域(srank), count 个作用域(IN), where 的参数'''
+        sql = "select %s, %s as srank from tags where scope in %s and %s" \
+                % (columns, ScopeRankSQL(count), qmarks, where)
+        if shadow and HAS_WINDOW_FUNCTIONS:
+            sql = "select * from (select *, min(srank) over "\
+                    "(partition by name) as mrank from (%s)) "\
+                    "where srank = mrank" % sql
+        return sql
+
+    def IterRankedComplRows(self, scopes, name, partialMatch = True,
+                            limit = None, icase = True, excludeKinds = [],
+                            skipCtorDtor = False, shadow = False):
+        '''同 GetRankedTagsByScopesAndName(), 但是只取补全需要的列, 逐行产生
+        (name, word, menu, kind, scope), word 和 menu 与
+        TagEntry.ToComplItem() 的相同, 都在 SQL 中计算, 不建立 TagEntry
+        结果不经过缓存'''
+        if not scopes:
+            return
+        if limit is None:
+            limit = self.GetSingleSearchLimit()
+
+        scopes, ranks = self._RankScopes(scopes)
+        where, whereParams = self._RankedCondition(name, partialMatch, icase,
+                                                   excludeKinds, skipCtorDtor)
+        order = " order by srank, " + COMPL_KIND_RANK_SQL + ", name ASC LIMIT ?"
+        sqlLimit = limit
+        if shadow and not HAS_WINDOW_FUNCTIONS:
+            sqlLimit = -1
+
+        count = 0
+        firstRanks = {}
+        for qmarks, params in SplitInParams(scopes):
+            if count >= limit:
+                break
+            params = tuple(params)
+            # 填充的重复参数的 parent 也是相同的
+            parentParams = ()
+            for scope in params:
+                parentParams += (scope, scope.rpartition('::')[2])
+            sql = "select name, %s, %s || ' ' || %s, kind, scope from (%s)" % (
+                COMPL_WORD_SQL, COMPL_ACCESS_SQL, ScopeParentSQL(len(params)),
+                self._RankedSQL("name, kind, access, scope", qmarks,
+                                len(params), where, shadow))
+            for row in self.Query(sql + order,
+                                  params = parentParams + params + params
+                                  + whereParams + (sqlLimit, )):
+                if shadow:
+                    rank = ranks[row[4]]
+                    if firstRanks.setdefault(row[0], rank) != rank:
+                        continue
+                yield row
+                count += 1
+                if count >= limit:
+                    break
+
+    def GetGroupedTagsByScopesAndName(self, scopes, name, partialMatch = True,
+                                      limit = None, icase = True,
+                                      excludeKinds = [], skipCtorDtor = False,
+                                      shadow = True):
+        '''同 GetRankedTagsByScopesAndName(), 但是按作用域分组,
+        返回 [(作用域, [标签, ...]), ...], 没有标签的作用域不出现在结果中'''
+        groups = []
+        for tag in self.GetRankedTagsByScopesAndName(scopes, name, partialMatch,
+                                                     limit, icase, excludeKinds,
+                                                     skipCtorDtor, shadow):
+            if not groups or groups[-1][0] != tag.scope:
+                groups.append((tag.scope, []))
+            groups[-1][1].append(tag)
+        return groups
+
+    def GetNamesByScopes(self, scopes, excludeKinds = [], skipCtorDtor = False):
+        '''scopes 中满足补全过滤条件的全部名字(不重复), 用于建立模糊匹配的索引
+        过滤条件与 GetRankedTagsByScopesAndName() 相同'''
+        where, whereParams = self._RankedCondition(None, True, True,
+                                                   excludeKinds, skipCtorDtor)
+        names = set()
+        for qmarks, params in SplitInParams(self._RankScopes(scopes)[0]):
+            sql = "select distinct name from tags where scope in %s and %s" \
+                    % (qmarks, where)
+            names.update(row[0] for row in
+                         self.Query(sql, params = tuple(params) + whereParams))
+        return sorted(names)
+
+    def GetDataVersion(self):
+        '''PRAGMA data_version, 其他连接提交修改后会改变, 失败返回 None'''
+        try:
+            row = self.Query("PRAGMA data_version").fetchone()
+            return row and row[0]
+        except Exception:
+            return None
+
+    def CheckDataVersion(self):
+        '''其他连接(例如后台 parse)提交了修改的话, 失效全部缓存
+        返回是否失效了'''
+        dataVersion = self.GetDataVersion()
+        changed = self.dataVersion is not None \
+                and dataVersion != self.dataVersion
+        self.dataVersion = dataVersion
+        if changed:
+            self.cache.InvalidateAll()
+        return changed
+
+    def GetChangeStamp(self):
+        '''数据库内容的版本, 改变了的话之前获取的结果可能已经过时
+        包括本连接的修改(缓存的失效次数)和其他连接提交的修改(data_version)'''
+        return (self.cache.GetGeneration(), self.GetDataVersion())
+
+    def GetRankedTagsByScopesAndNames(self, scopes, names, excludeKinds = [],
+                                      skipCtorDtor = False):
+        '''获取名字完全匹配 names 中的某个的 tags, 结果按 names 中的顺序排序,
+        同名的按作用域在 scopes 中的位置和 kind 排序
+        过滤条件与 GetRankedTagsByScopesAndName() 相同, 不经过缓存'''
+        if not scopes or not names:
+            return []
+        scopes, ranks = self._RankScopes(scopes)
+        where, whereParams = self._RankedCondition(None, True, True,
+                                                   excludeKinds, skipCtorDtor)
+        nameRanks = {}
+        for name in names:
+            nameRanks.setdefault(name, len(nameRanks))
+
+        result = []
+        for qmarks, params in SplitInParams(scopes):
+            params = tuple(params)
+            for nameQMarks, nameParams in SplitInParams(
+                    sorted(nameRanks, key = nameRanks.get)):
+                sql = "select *, %s from tags where scope in %s and "\
+                        "name in %s and %s" % (COMPL_KIND_RANK_SQL, qmarks,
+                                               nameQMarks, where)
+                for row in self.Query(sql, params = params + tuple(nameParams)
+                                      + whereParams):
+                    result.append(((nameRanks[row[1]], ranks[row[6]], row[13]),
+                                   self.FromSQLite3ResultSet(row)))
+        result.sort(key = lambda x: x[0])
+        return [tag for key, tag in result]
 
     def GetTagsByScope(self, scope):
-        sql = "select * from tags where scope='" + scope + "' limit " \
-                + str(self.GetSingleSearchLimit())
-        return self.DoFetchTags(sql)
+        sql = "select * from tags where scope = ? limit ?"
+        return self.DoFetchTags(sql,
+                                params = (scope, self.GetSingleSearchLimit()))
 
     def GetTagsByKinds(self, kinds, orderingColumn, order):
-        sql = "select * from tags where kind in ("
-        for i in kinds:
-            sql += "'" + i + "',"
-
-        sql = sql[:-1] + ") "
-
-        if orderingColumn:
-            sql += "order by " + orderingColumn
-            if order == ITagsStorage.OrderAsc:
-                sql += " ASC"
-            elif order == ITagsStorage.OrderDesc:
-                sql += " DESC"
-            else:
-                pass
-
-        return self.DoFetchTags(sql)
+        sql = "select * from tags where kind in %s" \
+                + OrderByClause(orderingColumn, order)
+        return self.DoFetchTagsIn(sql, ToAbbrKinds(kinds))
 
     def GetTagsByPath(self, path):
         if type(path) == type([]):
-            sql = "select * from tags where path IN("
-            for i in path:
-                sql += "'" + i + "',"
-            sql = sql[:-1] + ") "
-            return self.DoFetchTags(sql)
+            sql = "select * from tags where path IN %s"
+            return self.DoFetchTagsIn(sql, path)
         else:
             # FIXME: 为什么要 LIMIT 1 ？
             #sql = "select * from tags where path ='" + path + "' LIMIT 1"
-            sql = "select * from tags where path ='%s'" % path
+            sql = "select * from tags where path = ?"
             # NOTE: 为什么？按照函数语义，不应该这么做，应该交给外层过滤
             #sql = "select * from tags where path ='%s' and kind != 'externvar' "\
                     #"LIMIT 1" % (path, )
-            return self.DoFetchTags(sql)
+            return self.DoFetchTags(sql, params = (path, ))
 
     def GetTagsByPaths(self, paths):
         return self.GetTagsByPath(paths)
 
+    def GetFirstMatchTagByPaths(self, paths, kinds = []):
+        '''按优先级顺序在 paths 中查找第一个匹配的标签, 只需一次查询
+@paths: 优先级从高到低的 path 列表
+@kinds: 非空的时候, 只有 kind 在此列表中的标签才会匹配,
+        否则每个 path 的第一个标签就是候选, 但跳过构造和析构函数
+返回 TagEntry, 找不到的时候返回 None'''
+        if not paths:
+            return None
+
+        sql = "select * from tags where path in %s"
+        if kinds:
+            tags = []
+            for qmarks, params in SplitInParams(ToAbbrKinds(kinds)):
+                tags.extend(self.DoFetchTagsIn(sql + " and kind in " + qmarks,
+                                               paths, after = params))
+        else:
+            tags = self.DoFetchTagsIn(sql, paths)
+
+        # 按 path 分组, 组内保持数据库返回的顺序, 与单个 path 查询的结果一致
+        groups = {}
+        for tag in tags:
+            groups.setdefault(tag.GetPath(), []).append(tag)
+
+        for path in paths:
+            group = groups.get(path)
+            if not group:
+                continue
+            if kinds:
+                return group[0]
+            tag = group[0]
+            if tag.GetAbbrKind() in ('f', 'p') and \
+                    tag.name in (tag.parent, '~' + tag.parent):
+                # 跳过构造和析构函数的标签, eg. A::A, A::~A
+                continue
+            return tag
+
+        return None
+
     def GetTagsByNameAndParent(self, name, parent):
         '''根据标签名称和其父亲获取标签'''
-        sql = "select * from tags where name='" + name + "'"
-        tags = self.DoFetchTags(sql)
+        sql = "select * from tags where name = ?"
+        tags = self.DoFetchTags(sql, params = (name, ))
 
         # 过滤掉不符合要求的标签
-        return [i for i in tags if i.GetParent() == parent]
+        return [i for i in tags if i.parent == parent]
 
     def GetTagsByKindsAndPath(self, kinds, path):
         if not kinds:
             return []
 
-        sql = "select * from tags where path='" + path + "'"
-        return self.DoFetchTags(sql, kinds)
+        sql = "select * from tags where path = ? and kind in %s"
+        return self.DoFetchTagsIn(sql, ToAbbrKinds(kinds), before = (path, ))
 
     def GetTagsByKindAndPath(self, kind, path):
         return self.GetTagsByKindsAndPath([kind], path)
 
     def GetTagsByFileAndLine(self, file, line):
-        sql = "select * from tags where file='" + file \
-                + "' and line=" + line + " "
-        return self.DoFetchTags(sql)
+        sql = "select * from tags where file = ? and line = ?"
+        return self.DoFetchTags(sql, params = (file, int(line)))
 
     def GetTagsByScopeAndKind(self, scope, kind):
         return self.GetTagsByScopesAndKinds([scope], [kind])
@@ -849,28 +1594,16 @@ class TagsStorageSQLite(ITagsStorage):
         if not kinds:
             return []
 
-        sql = "select * from tags where scope='" + scope + "'"
-        return self.DoFetchTags(sql, kinds)
+        sql = "select * from tags where scope = ? and kind in %s"
+        return self.DoFetchTagsIn(sql, ToAbbrKinds(kinds), before = (scope, ))
 
     def GetTagsByKindsAndFile(self, kinds, fname, orderingColumn, order):
         if not kinds:
             return []
 
-        sql = "select * from tags where file='" + fname + "' and kind in ("
-        for i in kinds:
-            sql += "'" + i + "',"
-        sql = sql[:-1] + ")"
-
-        if orderingColumn:
-            sql += "order by " + orderingColumn
-            if order == ITagsStorage.OrderAsc:
-                sql += " ASC"
-            elif order == ITagsStorage.OrderDesc:
-                sql += " DESC"
-            else:
-                pass
-
-        return self.DoFetchTags(sql)
+        sql = "select * from tags where file = ? and kind in %s" \
+                + OrderByClause(orderingColumn, order)
+        return self.DoFetchTagsIn(sql, ToAbbrKinds(kinds), before = (fname, ))
 
     def DeleteFileEntry(self, fname):
         try:
@@ -883,19 +1616,22 @@ class TagsStorageSQLite(ITagsStorage):
 
     def DeleteFileEntries(self, files):
         try:
-            self.db.execute("DELETE FROM FILES WHERE file IN %s;" 
-                            % MakeQMarkString(len(files)), tuple(files))
+            for qmarks, params in SplitInParams(files):
+                self.db.execute("DELETE FROM FILES WHERE file IN %s;" % qmarks,
+                                params)
             self.Commit()
         except sqlite3.OperationalError:
             return -1
         else:
             return 0
 
-    def InsertFileEntry(self, fname, tagtime, auto_commit = True):
+    def InsertFileEntry(self, fname, tagtime, auto_commit = True,
+                        size = 0, mtime_ns = 0, contentHash = ''):
         try:
             # 理论上, 不会插入失败
-            self.db.execute("INSERT OR REPLACE INTO FILES VALUES(NULL, ?, ?);", 
-                           (fname, tagtime))
+            self.db.execute(
+                "INSERT OR REPLACE INTO FILES VALUES(NULL, ?, ?, ?, ?, ?);", 
+                (fname, tagtime, size, mtime_ns, contentHash))
             if auto_commit:
                 self.Commit()
         except:
@@ -915,11 +1651,63 @@ class TagsStorageSQLite(ITagsStorage):
         else:
             return 0
 
+    def UpdateFileSignatures(self, signatures, auto_commit = True):
+        '''signatures: [(文件, 大小, 修改时间, 散列值), ...]
+        只更新文件状态, 用于内容没有改变的文件'''
+        try:
+            self.db.executemany(
+                "UPDATE FILES SET size=?, mtime_ns=?, hash=? WHERE file=?;",
+                [(size, mtime_ns, h, f) for f, size, mtime_ns, h in signatures])
+            if auto_commit:
+                self.Commit()
+        except sqlite3.OperationalError:
+            return -1
+        else:
+            return 0
+
+    def PlanReindex(self, files):
+        '''找出需要重新 parse 的文件
+        返回 (需要 parse 的文件列表, 内容没有改变但需要更新状态的列表)
+        大小和修改时间都没有变化的文件直接跳过, 不需要读取内容,
+        否则比较内容的散列值, 只是 touch 过的文件不需要重新 parse'''
+        changed = []
+        refresh = []
+        filesMap = self.GetFilesMap(files)
+        for f in files:
+            fe = filesMap.get(f)
+            st = StatFile(f)
+            if fe is None:
+                # 新文件, 不存在的文件也交给 ctags 报错
+                changed.append(f)
+                continue
+            if st is None:
+                # 数据库中有, 但文件已经不存在, 跳过
+                continue
+            size, mtime_ns = st
+            if fe.GetHash() and fe.GetSize() == size \
+                    and fe.GetMtimeNs() == mtime_ns:
+                continue
+
+            h = HashFile(f)
+            if fe.GetHash():
+                unchanged = fe.GetHash() == h
+            else:
+                # 旧版本的条目, 没有散列值, 沿用时间戳的比较方法
+                unchanged = fe.GetLastRetaggedTimestamp() >= mtime_ns / 1000000000
+            if unchanged:
+                refresh.append((f, size, mtime_ns, h))
+            else:
+                changed.append(f)
+
+        return changed, refresh
+
     def DeleteTagEntry(self, kind, signature, path):
         try:
             self.db.execute(
                 "DELETE FROM TAGS WHERE Kind=? AND Signature=? AND Path=?", 
                 (kind, signature, path))
+            # 不知道所属的文件, 只能全部失效
+            self.InvalidateAll()
             self.Commit()
         except:
             return False
@@ -927,78 +1715,38 @@ class TagsStorageSQLite(ITagsStorage):
             return True
 
     def InsertTagEntry(self, tag):
-        if not tag.IsOk():
+        if not tag.IsValid():
             return False
 
-        if self.GetUseCache():
-            self.ClearCache()
+        # 缓存为空的时候(例如批量 parse)几乎没有开销
+        self.InvalidateTags([tag])
 
         try:
-        #if 1:
             # INSERT OR REPLACE 貌似是不会失败的?!
-            # 添加 parentType
-            self.db.execute(
-                "INSERT OR REPLACE INTO TAGS VALUES (NULL, "\
-                "?, ?, ?, ?, "
-                "?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", 
-                (tag.GetName(),
-                 tag.GetFile(),
-                 tag.GetLine(),
-                 tag.GetText(),
-
-                 tag.GetAccess(),
-                 tag.GetInheritsAsString(),
-                 tag.GetKind(),
-                 tag.GetParent(),
-                 tag.GetParentType(),
-                 tag.GetPath(),
-                 tag.GetReturn(),
-                 tag.GetScope(),
-                 tag.GetSignature(),
-                 tag.GetTemplate(),
-                 tag.GetTyperef()))
+            self.db.execute(INSERT_TAG_SQL, TagEntry2Row(tag))
         except:
             return False
         else:
             return True
 
     def UpdateTagEntry(self, tag):
-        if not tag.IsOk():
+        if not tag.IsValid():
             return True
 
-        if self.GetUseCache():
-            self.ClearCache()
+        # 缓存为空的时候(例如批量 parse)几乎没有开销
+        self.InvalidateTags([tag])
 
         try:
-            # 添加 parentType
+            row = TagEntry2Row(tag)
             self.db.execute(
                 "UPDATE OR REPLACE TAGS SET "
-                "name=?, file=?, line=?, text=?, "
-                "access=?, inherits=?, kind=?, parent=?, parent_type=?"
-                "path=?, return=?, scope=?, signature=?, template=?, typeref=?"
-                "WHERE file=? AND kind=? AND path=? AND signature=?", 
-                (tag.GetName(),
-                 tag.GetFile(),
-                 tag.GetLine(),
-                 tag.GetText(),
-
-                 tag.GetAccess(),
-                 tag.GetInheritsAsString(),
-                 tag.GetKind(),
-                 tag.GetParent(),
-                 tag.GetParentType(),
-                 tag.GetPath(),
-                 tag.GetReturn(),
-                 tag.GetScope(),
-                 tag.GetSignature(),
-                 tag.GetTemplate(),
-                 tag.GetTyperef(),
-
-                 # where 这四个参数能唯一定位?
-                 tag.GetFile(),
-                 tag.GetKind(), 
-                 tag.GetPath(), 
-                 tag.GetSignature()))
+                "fileid=?, line=?, parent_kind=?, access=?, inherits=?, "
+                "extra=?, path=? "
+                # 与 TAGS_UNIQ_IDX 一致, 可以唯一定位
+                "WHERE name=? AND file=? AND kind=? AND scope=? "
+                "AND signature=?",
+                (row[2], row[3], row[6], row[7], row[8], row[10], row[11],
+                 row[0], row[1], row[4], row[5], row[9]))
             self.Commit()
         except:
             return False
@@ -1028,21 +1776,19 @@ class TagsStorageSQLite(ITagsStorage):
                 combinedScope += '::'
             combinedScope += scopeOne
 
-        sql = "select scope,kind from tags where name='" + typeNameNoScope + "'"
+        # 数据库中保存的是 kind 的缩写
+        sql = "select scope from tags where name = ? and kind in ('c', 's')"
 
         foundGlobal = False
 
         try:
-            for row in self.Query(sql):
+            for row in self.Query(sql, params = (typeNameNoScope, )):
                 scopeFounded = row[0]
-                kindFounded = row[1]
-                containerKind = kindFounded == "struct" \
-                        or kindFounded == "class"
-                if scopeFounded == combinedScope and containerKind:
+                if scopeFounded == combinedScope:
                     scope = combinedScope
                     typeName = typeNameNoScope
                     return True, typeName, scope
-                elif scopeFounded == scopeOne and containerKind:
+                elif scopeFounded == scopeOne:
                     # this is equal to cases like this:
                     # class A {
                     #     typedef std::list<int> List;
@@ -1053,7 +1799,7 @@ class TagsStorageSQLite(ITagsStorage):
                     scope = scopeOne
                     typeName = typeNameNoScope
                     return True, typeName, scope
-                elif containerKind and scopeFounded == "<global>":
+                elif scopeFounded == "<global>":
                     foundGlobal = True
         except:
             pass
@@ -1078,8 +1824,8 @@ class TagsStorageSQLite(ITagsStorage):
         if not strippedName:
             return False
 
-        sql = "select scope,parent from tags where name='" + strippedName \
-                + "' and kind in ('class', 'struct', 'typedef') LIMIT 50"
+        sql = "select scope from tags where name = ? "\
+                "and kind in ('c', 's', 't') LIMIT 50"
         foundOther = 0
 
         if secondScope:
@@ -1088,9 +1834,9 @@ class TagsStorageSQLite(ITagsStorage):
         parent = tmpScope.rpartition(':')[2]
 
         try:
-            for row in self.Query(sql):
+            for row in self.Query(sql, params = (strippedName, )):
                 scopeFounded = row[0]
-                parentFounded = row[1]
+                parentFounded = scopeFounded.rpartition(':')[2]
 
                 if scopeFounded == tmpScope:
                     scope = scopeFounded
@@ -1117,37 +1863,34 @@ class TagsStorageSQLite(ITagsStorage):
 
     def GetScopesFromFileAsc(self, fname, scopes):
         '''传入的 scopes 为列表'''
-        sql = "select * from tags where file = '" + fname + "' " \
-                + " and kind in('prototype', 'function', 'enum')" \
-                + " order by scope ASC"
+        sql = "select * from tags where file = ? " \
+                " and kind in ('p', 'f', 'g') order by scope ASC"
 
         # we take the first entry
         try:
-            for row in self.Query(sql):
+            for row in self.Query(sql, params = (fname, )):
                 scopes.append(row[0])
                 break
         except:
             pass
 
     def GetTagsByFileScopeAndKinds(self, fname, scopeName, kinds):
-        sql = "select * from tags where file = '" + fname + "' " \
-                + " and scope='" + scopeName + "' "
+        sql = "select * from tags where file = ? and scope = ?"
 
         if kinds:
-            sql += " and kind in("
-            for i in kinds:
-                sql += "'" + i + "',"
-            sql = sql[:-1] + ")"
+            sql += " and kind in %s"
+            return self.DoFetchTagsIn(sql, ToAbbrKinds(kinds),
+                                      before = (fname, scopeName))
 
-        return DoFetchTags(sql)
+        return self.DoFetchTags(sql, params = (fname, scopeName))
 
     def GetAllTagsNames(self):
         names = []
         try:
-            sql = "SELECT distinct name FROM tags order by name ASC LIMIT " \
-                    + str(self.GetMaxWorkspaceTagToColour())
+            sql = "SELECT distinct name FROM tags order by name ASC LIMIT ?"
 
-            for row in self.Query(sql):
+            for row in self.Query(
+                sql, params = (self.GetMaxWorkspaceTagToColour(), )):
                 # add unique strings only
                 names.append(row[0])
         except:
@@ -1161,16 +1904,11 @@ class TagsStorageSQLite(ITagsStorage):
 
         names = []
         try:
-            whereClause = " kind IN ("
-            for kind in kinds:
-                whereClause += "'" + kind + "',"
-
-            whereClause = whereClause[:-1] + ") "
-
-            sql = "SELECT distinct name FROM tags WHERE "
-            sql += whereClause + " order by name ASC LIMIT " \
-                    + str(self.GetMaxWorkspaceTagToColour())
-            for row in self.Query(sql):
+            sql = "SELECT distinct name FROM tags WHERE kind IN %s " \
+                    "order by name ASC LIMIT ?"
+            for row in self.QueryIn(
+                sql, ToAbbrKinds(kinds),
+                after = (self.GetMaxWorkspaceTagToColour(), )):
                 names.append(row[0])
         except:
             pass
@@ -1181,90 +1919,65 @@ class TagsStorageSQLite(ITagsStorage):
         if not kinds or not scopes:
             return []
 
-        sql = "select * from tags where scope in ("
-        for scope in scopes:
-            sql += "'" + scope + "',"
-        sql = sql[:-1] + ") "
-
-        return self.DoFetchTags(sql, kinds)
+        # 两个 IN 语句的占位符都是分档的, 组合起来的语句形状依然有限
+        tags = []
+        for qmarks, params in SplitInParams(ToAbbrKinds(kinds)):
+            sql = "select * from tags where kind in %s and scope in " % qmarks
+            tags.extend(self.DoFetchTagsIn(sql + "%s", scopes,
+                                           before = params))
+        return tags
 
     def GetGlobalFunctions(self):
         sql = "select * from tags where scope = '<global>' "\
-                "AND kind IN ('function', 'prototype') LIMIT " \
-                + str(self.GetSingleSearchLimit())
-        return self.DoFetchTags(sql)
+                "AND kind IN ('f', 'p') LIMIT ?"
+        return self.DoFetchTags(sql, params = (self.GetSingleSearchLimit(), ))
 
     def GetTagsByFiles(self, files):
         if not files:
             return []
 
-        sql = "select * from tags where file in ("
-        for file in files:
-            sql += "'" + file + "',"
-        sql = sql[:-1] + ")"
-        return self.DoFetchTags(sql)
+        sql = "select * from tags where file in %s"
+        return self.DoFetchTagsIn(sql, files)
 
     def GetTagsByFilesAndScope(self, files, scope):
         if not files:
             return []
 
-        sql = "select * from tags where file in ("
-        for file in files:
-            sql += "'" + file + "',"
-        sql = sql[:-1] + ")"
-        sql += " AND scope='" + scope + "'"
-        return self.DoFetchTags(sql)
+        sql = "select * from tags where scope = ? AND file in %s"
+        return self.DoFetchTagsIn(sql, files, before = (scope, ))
 
     def GetTagsByFilesKindsAndScope(self, files, kinds, scope):
         if not files:
             return []
 
-        sql = "select * from tags where file in ("
-        for file in files:
-            sql += "'" + file + "',"
-        sql = sql[:-1] + ")"
-
-        sql += " AND scope='" + scope + "'"
-
-        return self.DoFetchTags(sql, kinds)
+        sql = "select * from tags where scope = ? AND file in %s"
+        return self.DoFetchTagsIn(sql, files, before = (scope, ),
+                                  kinds = kinds)
 
     def GetTagsByFilesScopeTyperefAndKinds(self, files, kinds, scope, typeref):
         if not files:
             return []
 
-        sql = "select * from tags where file in ("
-        for file in files:
-            sql += "'" + file + "',"
-        sql = sql[:-1] + ")"
-
-        sql += " AND scope='" + scope + "'"
-        sql += " AND typeref='" + typeref + "'"
-
-        return self.DoFetchTags(sql, kinds)
+        sql = "select * from tags where scope = ? AND typeref = ? "\
+                "AND file in %s"
+        return self.DoFetchTagsIn(sql, files, before = (scope, typeref),
+                                  kinds = kinds)
 
     def GetTagsByKindsLimit(self, kinds, orderingColumn, order, limit, partName):
-        sql = "select * from tags where kind in ("
-        for kind in kinds:
-            sql += "'" + kind + "',"
-        sql = sql[:-1] + ") "
-
-        if orderingColumn:
-            sql += "order by " + orderingColumn
-            if order == ITagsStorage.OrderAsc:
-                sql += " ASC"
-            elif order == ITagsStorage.OrderDesc:
-                sql += " DESC"
-            else:
-                pass
+        sql = "select * from tags where kind in %s"
+        after = []
 
         if partName:
-            tmpName = partName.replace('_', '^_')
-            sql += " AND name like '%" + tmpName + "%' ESCAPE '^' "
+            sql += " AND name like ? ESCAPE '^' "
+            after.append('%' + LikeEscape(partName) + '%')
+
+        sql += OrderByClause(orderingColumn, order)
 
         if limit > 0:
-            sql += " LIMIT " + str(limit)
+            sql += " LIMIT ?"
+            after.append(limit)
 
-        return self.DoFetchTags(sql)
+        return self.DoFetchTagsIn(sql, ToAbbrKinds(kinds), after = after)
 
     def IsTypeAndScopeExistLimitOne(self, typeName, scope):
         path = ''
@@ -1274,11 +1987,11 @@ class TagsStorageSQLite(ITagsStorage):
             path += scope + "::"
 
         path += typeName
-        sql += "select ID from tags where path='" + path \
-                + "' and kind in ('class', 'struct', 'typedef') LIMIT 1"
+        sql = "select ID from tags where path = ? "\
+                "and kind in ('c', 's', 't') LIMIT 1"
 
         try:
-            for row in self.Query(sql):
+            for row in self.Query(sql, params = (path, )):
                 return True
         except:
             pass
@@ -1286,18 +1999,54 @@ class TagsStorageSQLite(ITagsStorage):
         return False
 
     def GetDereferenceOperator(self, scope):
-        sql = "select * from tags where scope ='" + scope \
-                + "' and name like 'operator%->%' LIMIT 1"
-        return self.DoFetchTags(sql)
+        sql = "select * from tags where scope = ? "\
+                "and name like 'operator%->%' LIMIT 1"
+        return self.DoFetchTags(sql, params = (scope, ))
 
     def GetSubscriptOperator(self, scope):
-        sql = "select * from tags where scope ='" + scope \
-                + "' and name like 'operator%[%]%' LIMIT 1"
-        return self.DoFetchTags(sql)
+        sql = "select * from tags where scope = ? "\
+                "and name like 'operator%[%]%' LIMIT 1"
+        return self.DoFetchTags(sql, params = (scope, ))
 
     def ClearCache(self):
-        if self.cache:
-            self.cache.Clear()
+        self.cache.Clear()
+        # data_version 只在同一个连接中可以比较
+        self.dataVersion = None
+        if self.symbolIndex is not None:
+            self.symbolIndex.MarkAll()
+
+    def InvalidateFiles(self, files):
+        self.cache.InvalidateFiles(files)
+        if self.symbolIndex is not None:
+            self.symbolIndex.MarkFiles(files)
+
+    def InvalidateTags(self, tags):
+        self.cache.InvalidateTags(tags)
+        if self.symbolIndex is not None:
+            self.symbolIndex.MarkFiles(set(tag.file for tag in tags))
+
+    def InvalidateFilePrefix(self, prefix):
+        self.cache.InvalidateFilePrefix(prefix)
+        if self.symbolIndex is not None:
+            self.symbolIndex.MarkAll()
+
+    def InvalidateAll(self):
+        self.cache.InvalidateAll()
+        if self.symbolIndex is not None:
+            self.symbolIndex.MarkAll()
+
+    def EnableSymbolIndex(self, enable = True):
+        '''使用内存索引回答 GetOrderedTagsByScopesAndName(), 第一次查询时载入
+        其他连接提交修改后下次查询时全部重新载入, 见 SymbolIndex.Sync()'''
+        if not enable:
+            self.symbolIndex = None
+        elif self.symbolIndex is None:
+            from SymbolIndex import SymbolIndex
+            self.symbolIndex = SymbolIndex()
+        return self.symbolIndex
+
+    def GetSymbolIndex(self):
+        return self.symbolIndex
 
 
 try:
@@ -1349,40 +2098,212 @@ def IsCppHeaderFile(fname):
     else:
         return False
 
-def ParseFiles(files, macrosFiles = []):
-    '返回标签文本'
+class CtagsProcess(object):
+    '''运行 ctags -f -, 标签从 stdout 逐行读取, 边解析边入库
+    stderr 重定向到临时文件, 以免管道写满导致 ctags 阻塞'''
+    def __init__(self, files, macrosFiles = []):
+        envDict = os.environ.copy()
+        if macrosFiles: # 全局宏定义文件列表
+            envDict['CTAGS_GLOBAL_MACROS_FILES'] = ','.join(macrosFiles)
+
+        self.errFile = tempfile.TemporaryFile()
+        if platform.system() == 'Windows':
+            self.cmd = '"%s" %s -f - "%s"' % (CTAGS, CTAGS_OPTS,
+                                              '" "'.join(files))
+            shell = True
+        else:
+            self.cmd = [CTAGS] + CTAGS_OPTS_LIST + ['-f', '-'] + files
+            # NOTE: 不用 shell，会快近两倍！
+            shell = False
+        self.p = subprocess.Popen(self.cmd, shell=shell,
+                                  stdout=subprocess.PIPE, stderr=self.errFile,
+                                  env=envDict)
+        self.stdout = self.p.stdout
+
+    def Wait(self):
+        '''读完 stdout 后调用, 返回是否成功'''
+        # 丢弃没有读取的输出, 否则 ctags 可能阻塞
+        for line in self.stdout:
+            pass
+        self.stdout.close()
+        self.p.wait()
+
+        ret = True
+        if self.p.returncode != 0:
+            self.errFile.seek(0)
+            print self.cmd
+            print '%d: ctags occured some errors' % self.p.returncode
+            print self.errFile.read()
+            ret = False
+        self.errFile.close()
+        return ret
+
+    def Kill(self):
+        '''入库出错时调用, 结束 ctags 并回收进程, 不读取剩下的输出'''
+        if self.p.poll() is None:
+            try:
+                self.p.kill()
+            except OSError:
+                pass
+        self.stdout.close()
+        self.p.wait()
+        self.errFile.close()
+
+def RunCtags(files, macrosFiles = []):
+    '''运行 ctags, 返回 (是否成功, 标签文本)'''
     if not files:
-        return ''
+        return True, ''
 
-    envDict = os.environ.copy()
-    if macrosFiles: # 全局宏定义文件列表
-        envDict['CTAGS_GLOBAL_MACROS_FILES'] = ','.join(macrosFiles)
+    proc = CtagsProcess(files, macrosFiles)
+    out = proc.stdout.read()
+    return proc.Wait(), out
 
-    tags = ''
-    if platform.system() == 'Windows':
-        cmd = '"%s" %s -f - "%s"' % (CTAGS, CTAGS_OPTS, '" "'.join(files))
-        p = subprocess.Popen(cmd, shell=True,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                             env=envDict)
-    else:
-        #cmd = '"%s" %s -f - "%s"' % (CTAGS, CTAGS_OPTS, '" "'.join(files))
-        cmd = [CTAGS] + CTAGS_OPTS_LIST + ['-f', '-'] + files
-        # NOTE: 不用 shell，会快近两倍！
-        p = subprocess.Popen(cmd, shell=False,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                             env=envDict)
+def ParseFiles(files, macrosFiles = []):
+    '返回标签文本'
+    return RunCtags(files, macrosFiles)[1]
+
+class CtagsWorker(threading.Thread):
+    '''从 inQueue 取出 (序号, 文件列表), 运行 ctags 后把
+    (序号, 文件列表, 是否成功, 标签文本, 文件状态) 放到 outQueue
+    ctags 是外部进程, 所以多个线程就可以利用多个核心, 而不需要在 vim 里面用
+    multiprocessing. 线程不访问数据库'''
+    def __init__(self, inQueue, outQueue, macrosFiles = []):
+        threading.Thread.__init__(self)
+        self.inQueue = inQueue
+        self.outQueue = outQueue
+        self.macrosFiles = macrosFiles
+        self.daemon = True
+        self.name = 'Videm-Ctags-' + self.name
+
+    def run(self):
+        while True:
+            item = self.inQueue.get()
+            if item is None:
+                break
+            idx, files = item
+            try:
+                signatures = dict((f, FileSignature(f)) for f in files)
+                ok, tags = RunCtags(files, self.macrosFiles)
+            except:
+                signatures, ok, tags = {}, False, ''
+            self.outQueue.put((idx, files, ok, tags, signatures))
+
+def StoreFileEntries(storage, batchFiles, signatures):
+    '''signatures: {文件: FileSignature()}, 在 parse 之前获取'''
+    timestamp = int(time.time())
+    for f in batchFiles:
+        sig = signatures.get(f)
+        if sig:
+            storage.InsertFileEntry(f, timestamp, False, *sig)
+
+def StoreBatchTags(storage, batchFiles, lines, initialLoad = False,
+                   touched = None):
+    '''在事务中保存 batchFiles 的标签, 返回是否成功
+    初次导入时直接插入, 否则与数据库中的标签比较, 只改动变化了的行,
+    每个文件改动的行数保存到 touched 字典'''
+    if initialLoad:
+        return storage.StoreLines(lines, auto_commit = False)
+
+    result = storage.DiffStoreLines(lines, batchFiles, auto_commit = False)
+    if result is None:
+        return False
+    if touched is not None:
+        touched.update(result)
+    return True
 
-    # NOTE: 详见 python 手册关于 subprocess 的 warning
-    out, err = p.communicate()
-    tags = out
+def StoreParsedBatch(storage, batchFiles, lines, initialLoad = False,
+                     signatures = {}, touched = None):
+    '''在一个事务中更新 batchFiles 的标签和 FILES 表'''
+    storage.Begin()
+    if not StoreBatchTags(storage, batchFiles, lines, initialLoad, touched):
+        storage.Rollback()
+        storage.Begin()
+    StoreFileEntries(storage, batchFiles, signatures)
+    storage.Commit()
+
+def StreamParseFilesAndStore(storage, batchFiles, macrosFiles = [],
+                             initialLoad = False, touched = None):
+    '''边运行 ctags 边入库, 不经过临时文件, 内存占用只有一个文件的标签
+    ctags 失败的话回滚这一批, 返回是否成功'''
+    signatures = dict((f, FileSignature(f)) for f in batchFiles)
+    proc = CtagsProcess(batchFiles, macrosFiles)
+
+    storage.Begin()
+    stored = False
+    try:
+        storeRet = StoreBatchTags(storage, batchFiles, proc.stdout,
+                                  initialLoad, touched)
+        stored = True
+    finally:
+        # NOTE: 不用 except 再 raise, python2 里面处理其他异常后 raise 的是
+        #       最后处理的异常, 而 finally 之后总是继续原来的异常
+        if not stored:
+            # 例如 FromLine() 的 ValueError, 丢弃这一批已经写入的标签
+            storage.Rollback()
+            proc.Kill()
+
+    if not proc.Wait(): # 只有解析成功才入库
+        storage.Rollback()
+        return False
 
-    if p.returncode != 0:
-        print cmd
-        print '%d: ctags occured some errors' % p.returncode
-        print err
+    if not storeRet:
+        storage.Rollback()
+        storage.Begin()
+    StoreFileEntries(storage, batchFiles, signatures)
+    storage.Commit()
+    return True
+
+def ParallelParseFilesAndStore(storage, batches, macrosFiles = [], jobs = 2,
+                               indicator = None, initialLoad = False,
+                               touched = None):
+    '''多个 ctags 同时运行, 当前线程是唯一的写入者, 按完成的顺序入库'''
+    totalCount = sum(len(batch) for batch in batches)
+    inQueue = Queue.Queue()
+    # 限制积压的结果, 以免写入跟不上的时候占用太多内存
+    outQueue = Queue.Queue(jobs * 2)
+    for item in enumerate(batches):
+        inQueue.put(item)
+
+    workers = []
+    for i in range(min(jobs, len(batches))):
+        inQueue.put(None)
+        worker = CtagsWorker(inQueue, outQueue, macrosFiles)
+        worker.start()
+        workers.append(worker)
+
+    doneCount = 0
+    stored = False
+    try:
+        for i in range(len(batches)):
+            idx, batchFiles, ok, tags, signatures = outQueue.get()
+            if ok: # 只有解析成功才入库
+                StoreParsedBatch(storage, batchFiles, tags.split('\n'),
+                                 initialLoad, signatures, touched)
+            doneCount += len(batchFiles)
+            if indicator:
+                indicator(doneCount, totalCount - 1)
+        stored = True
+    finally:
+        if not stored:
+            storage.Rollback()
+            # 丢弃还没开始的批次, 等待正在运行的 ctags 结束, 不留下僵尸进程
+            try:
+                while True:
+                    inQueue.get_nowait()
+            except Queue.Empty:
+                pass
+            for worker in workers:
+                inQueue.put(None)
+            while any(worker.is_alive() for worker in workers):
+                try:
+                    outQueue.get(timeout = 0.1)
+                except Queue.Empty:
+                    pass
 
-    return tags
+    for worker in workers:
+        worker.join()
 
+# [DEPRECATE] ParseFilesAndStore() 已经改为直接读取 ctags 的输出
 def ParseFilesToTags(files, tagFile, macrosFiles = []):
     if platform.system() == 'Windows':
         # Windows 下的 cmd.exe 不支持过长的命令行
@@ -1483,15 +2404,19 @@ def ParseFile(fname, macrosFiles = []):
 
 def ParseFilesAndStore(storage, files, macrosFiles = [], filterNotNeed = True, 
                        indicator = None, useCppTagsDb = False,
-                       onlyCpp = False):
+                       onlyCpp = False, jobs = 1, snapshot = False):
     '''
-    onlyCpp = False 表示不检查文件是否c++头文件或源文件'''
-    # 确保打开了一个数据库
-    if not storage.OpenDatabase():
-        return
+    onlyCpp = False 表示不检查文件是否c++头文件或源文件
+    jobs > 1 时同时运行 jobs 个 ctags
+    snapshot = True 时完成后导出快照, 否则不会更新已经存在的快照.
+    补全不读取快照, 所以保存文件后的重新 parse 不承担导出的开销
+    返回 {文件: 改动的行数}, 初次导入时为空字典'''
+    # 确保打开了一个数据库, 文件名为空表示使用已经打开的
+    if storage.OpenDatabase('') != 0:
+        return {}
 
     if not files:
-        return
+        return {}
 
     # NOTE: 全部转为绝对路径, 仅 parse C++ 头文件和源文件
     tmpFiles = []
@@ -1501,30 +2426,20 @@ def ParseFilesAndStore(storage, files, macrosFiles = [], filterNotNeed = True,
     else:
         tmpFiles += [os.path.abspath(f) for f in files]
 
-    # 过滤不需要的. 通过比较时间戳
+    # 过滤不需要的. 通过比较文件状态和内容的散列值
     if filterNotNeed:
-        filesMap = storage.GetFilesMap(tmpFiles)
-        mapLen = len(tmpFiles)
-        idx = 0
-        while idx < mapLen and filesMap:
-            f = tmpFiles[idx]
-            if filesMap.has_key(f):
-                # 开始比较时间戳
-                try:
-                    mtime = int(os.path.getmtime(f))
-                except OSError:
-                    # 可能文件 f 不存在, 设置为 0, 即跳过
-                    mtime = 0
-                if filesMap[f].GetLastRetaggedTimestamp() >= mtime:
-                    # 过滤掉
-                    del tmpFiles[idx]
-                    mapLen -= 1
-                    continue
-            idx += 1
+        tmpFiles, refresh = storage.PlanReindex(tmpFiles)
+        if refresh:
+            storage.UpdateFileSignatures(refresh)
 
     # 分批 parse
     totalCount = len(tmpFiles)
-    batchCount = totalCount / 10
+    parallel = jobs > 1 and not useCppTagsDb
+    if parallel:
+        # 批次多一些, 各个 ctags 的负载才能均衡
+        batchCount = totalCount / (jobs * 4)
+    else:
+        batchCount = totalCount / 10
     if batchCount > 200: # 上限
         batchCount = 200
     if batchCount <= 0: # 下限
@@ -1543,54 +2458,69 @@ def ParseFilesAndStore(storage, files, macrosFiles = [], filterNotNeed = True,
     # 这个时间取尽量早的时间，理论上使用文件的修改时间戳比较好
     lastRetagTime = int(time.time())
 
-    tagFileFd, tagFile = tempfile.mkstemp()
-    while batchFiles:
-        parseRet = True
-        if useCppTagsDb:
-            if not CppTagsDbParseFilesAndStore(
-                storage.GetDatabaseFileName(), batchFiles, macrosFiles):
-                print 'CppTagsDbParseFilesAndStore() failed'
-        elif True:
-            # 使用临时文件
-            parseRet = ParseFilesToTags(batchFiles, tagFile, macrosFiles)
-            if parseRet: # 只有解析成功才入库
-                storage.Begin()
-                if not storage.DeleteTagsByFiles(batchFiles,
-                                                 auto_commit = False):
-                    storage.Rollback()
-                    storage.Begin()
-                if not storage.StoreFromTagFile(tagFile, auto_commit = False):
-                    storage.Rollback()
-                    storage.Begin()
-                timestamp = int(time.time())
-                for f in batchFiles:
-                    if os.path.isfile(f):
-                        storage.InsertFileEntry(f, timestamp,
-                                                auto_commit = False)
-                storage.Commit()
-        #else:
-            #tags = ParseFiles(batchFiles, macrosFiles)
-            #storage.Begin()
-            #if not storage.DeleteTagsByFiles(batchFiles, auto_commit = False):
-                #storage.Rollback()
-                #storage.Begin()
-            #if not storage.Store(tags, auto_commit = False, indicator = None):
-                #storage.Rollback()
-                #storage.Begin()
-            #storage.Commit()
-
-        if indicator:
-            indicator(i, totalCount - 1)
-        i += batchCount
-        # 下一个 batchFiles
-        batchFiles = tmpFiles[i : i + batchCount]
-
-    os.close(tagFileFd)
-    os.remove(tagFile)
+    # 初次建立数据库的时候, 延迟建立二级索引, 也不需要删除旧的标签
+    initialLoad = not useCppTagsDb and storage.BeginBulkLoad()
+    # {文件: 改动的行数}, 初次导入的时候为空
+    touched = {}
+
+    ok = False
+    try:
+        if parallel:
+            batches = [tmpFiles[j : j + batchCount]
+                       for j in xrange(0, totalCount, batchCount)]
+            ParallelParseFilesAndStore(storage, batches, macrosFiles, jobs,
+                                       indicator, initialLoad, touched)
+        else:
+            while batchFiles:
+                parseRet = True
+                if useCppTagsDb:
+                    if not CppTagsDbParseFilesAndStore(
+                        storage.GetDatabaseFileName(), batchFiles, macrosFiles):
+                        print 'CppTagsDbParseFilesAndStore() failed'
+                elif True:
+                    # 直接读取 ctags 的输出, 不使用临时文件
+                    parseRet = StreamParseFilesAndStore(storage, batchFiles,
+                                                        macrosFiles, initialLoad,
+                                                        touched)
+                #else:
+                    #tags = ParseFiles(batchFiles, macrosFiles)
+                    #storage.Begin()
+                    #if not storage.DeleteTagsByFiles(batchFiles, auto_commit = False):
+                        #storage.Rollback()
+                        #storage.Begin()
+                    #if not storage.Store(tags, auto_commit = False, indicator = None):
+                        #storage.Rollback()
+                        #storage.Begin()
+                    #storage.Commit()
+
+                if indicator:
+                    indicator(i, totalCount - 1)
+                i += batchCount
+                # 下一个 batchFiles
+                batchFiles = tmpFiles[i : i + batchCount]
+        ok = True
+    finally:
+        if not ok:
+            # 回滚出错的一批, 之前的批次已经连同 FILES 表一起提交了
+            # NOTE: 必须在 EndBulkLoad() 之前, 建立索引会提交未完成的事务
+            storage.Rollback()
+        # 中途出错也要重建二级索引, 否则之后的查询都很慢
+        if initialLoad:
+            storage.EndBulkLoad()
+
+    if storage.wal:
+        # 大量写入之后尽量写回, 不等待读取者
+        storage.Checkpoint()
+
+    if snapshot and storage.fname != ':memory:':
+        ExportSnapshot(storage.db, SnapshotFileName(storage.fname),
+                       storage.GetVersion())
 
     if indicator:
         indicator(100, 100)
 
+    return touched
+
     #for f in tmpFiles:
         #if os.path.isfile(f):
             #storage.InsertFileEntry(f, lastRetagTime)
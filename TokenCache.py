@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+CxxTokenize() 的结果缓存
+
+* 字符串(主要是标签的 text, 即声明)按内容缓存记号列表, 重复解析同一个声明
+  的时候不需要重新分词
+* 缓冲区的语句按行缓存, 每个文件保存上一次的 {行: 记号}, 只有修改过的行需要
+  重新分词. 记号不会跨行的时候才按行处理(没有 /* */ 注释, 续行和原始字符串),
+  否则按整个字符串缓存
+
+缓存保存的是元组, 返回的是新的列表, 调用者可以修改列表, 但是不能修改记号
+'''
+
+from collections import OrderedDict
+
+# 缓存的大小, 满了之后淘汰最久没有使用的
+MAX_STRING_CACHE = 10000
+MAX_FILES = 8
+
+def SplitLines(stmt):
+    '''返回可以分别分词的行列表, 记号可能跨行的话返回 None'''
+    if '/*' in stmt or 'R"' in stmt:
+        return None
+    lines = stmt.split('\n')
+    for line in lines:
+        if line.endswith('\\'):
+            return None
+    return lines
+
+class TokenCache(object):
+    def __init__(self, tokenizer):
+        '''tokenizer 为 CppTokenizer.CxxTokenize'''
+        self.tokenizer = tokenizer
+        # {字符串: 记号元组}, 按最近使用的顺序
+        self.strings = OrderedDict()
+        # {文件: {行: 记号元组}}
+        self.files = {}
+        self.fileOrder = []
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'tokenizedLines': 0,
+            'reusedLines': 0,
+        }
+
+    def GetStats(self):
+        stats = dict(self.stats)
+        total = stats['hits'] + stats['misses']
+        stats['hitRate'] = stats['hits'] * 1.0 / total if total else 0.0
+        stats['strings'] = len(self.strings)
+        return stats
+
+    def Clear(self, file = None):
+        if file is None:
+            self.strings.clear()
+            self.files.clear()
+            del self.fileOrder[:]
+        elif file in self.files:
+            del self.files[file]
+            self.fileOrder.remove(file)
+
+    def _Tokenize(self, string):
+        tokens = self.strings.pop(string, None)
+        if tokens is None:
+            self.stats['misses'] += 1
+            tokens = tuple(self.tokenizer(string))
+            if len(self.strings) >= MAX_STRING_CACHE:
+                self.strings.popitem(last = False)
+        else:
+            self.stats['hits'] += 1
+        self.strings[string] = tokens
+        return tokens
+
+    def Tokenize(self, string):
+        '''与 CxxTokenize(string) 相同, 结果按字符串缓存'''
+        return list(self._Tokenize(string))
+
+    def TokenizeStatement(self, file, stmt):
+        '''与 CxxTokenize(stmt) 相同, stmt 为 file 中的语句, 按行缓存'''
+        lines = SplitLines(stmt)
+        if lines is None or len(lines) == 1:
+            return self.Tokenize(stmt)
+
+        old = self.files.get(file)
+        if old is None:
+            old = {}
+        else:
+            self.fileOrder.remove(file)
+        cache = {}
+        result = []
+        for line in lines:
+            tokens = cache.get(line)
+            if tokens is None:
+                tokens = old.get(line)
+                if tokens is None:
+                    tokens = tuple(self.tokenizer(line))
+                    self.stats['tokenizedLines'] += 1
+                else:
+                    self.stats['reusedLines'] += 1
+                cache[line] = tokens
+            else:
+                self.stats['reusedLines'] += 1
+            result.extend(tokens)
+
+        # 只保留这一次的行, 已经删除或者修改的行不再需要
+        self.files[file] = cache
+        self.fileOrder.append(file)
+        if len(self.fileOrder) > MAX_FILES:
+            del self.files[self.fileOrder.pop(0)]
+        return result
+
+def test():
+    global MAX_STRING_CACHE
+    calls = []
+    def Tokenizer(s):
+        calls.append(s)
+        return s.split()
+
+    cache = TokenCache(Tokenizer)
+    tokens = cache.Tokenize('const std :: string &')
+    assert tokens == ['const', 'std', '::', 'string', '&']
+    # 修改返回的列表不影响缓存
+    tokens.pop(-1)
+    assert cache.Tokenize('const std :: string &')[-1] == '&'
+    assert len(calls) == 1 and cache.stats['hits'] == 1
+
+    stmt = 'A a ;\nfor ( ; ; )\nA a ;\na .'
+    assert cache.TokenizeStatement('a.cpp', stmt) == stmt.split()
+    assert cache.stats['tokenizedLines'] == 3
+    # 只有修改过的行需要重新分词
+    stmt = 'A a ;\nfor ( ; ; )\nA a ;\na ->'
+    assert cache.TokenizeStatement('a.cpp', stmt) == stmt.split()
+    assert cache.stats['tokenizedLines'] == 4
+    assert cache.stats['reusedLines'] == 4
+    # 记号可能跨行, 整个分词
+    del calls[:]
+    stmt = 'A a ; /* x\ny */ a .'
+    assert cache.TokenizeStatement('a.cpp', stmt) == stmt.split()
+    assert calls == [stmt]
+    print cache.GetStats()
+
+    # 满了之后只淘汰最久没有使用的
+    saved, MAX_STRING_CACHE = MAX_STRING_CACHE, 2
+    try:
+        cache = TokenCache(Tokenizer)
+        cache.Tokenize('a')
+        cache.Tokenize('b')
+        cache.Tokenize('a')
+        cache.Tokenize('c')
+        assert cache.strings.keys() == ['a', 'c']
+    finally:
+        MAX_STRING_CACHE = saved
+
+def bench():
+    '''性能: 重复解析相同的声明, 用正则表达式模拟 CxxTokenize'''
+    import time
+    import re
+    token_re = re.compile(r'\s*(\w+|::|->|\S)')
+    def RegexTokenizer(s):
+        return [(m.group(1),) for m in token_re.finditer(s)]
+    decls = ['const std::vector<std::string> &v%d;' % (i % 200)
+             for i in range(20000)]
+    cache = TokenCache(RegexTokenizer)
+    t0 = time.time()
+    for decl in decls:
+        RegexTokenizer(decl)
+    t1 = time.time()
+    for decl in decls:
+        cache.Tokenize(decl)
+    t2 = time.time()
+    print 'tokenize %.1f ms, cached %.1f ms, hit rate %.3f' % (
+        (t1 - t0) * 1000, (t2 - t1) * 1000, cache.GetStats()['hitRate'])
+
+if __name__ == '__main__':
+    import sys
+    test()
+    if '-b' in sys.argv[1:]:
+        bench()
@@ -35,22 +35,99 @@ from CxxTypeParser import CxxType
 from CxxTypeParser import CxxUnitType
 from CxxTypeParser import CxxParseType
 from CxxTypeParser import CxxParseTemplateList
+from CxxTypeParser import TOKEN_CACHE
 from CxxSemanticParser import GetComplInfo
 from CxxSemanticParser import ResolveScopeStack
 from CxxSemanticParser import ResolveComplInfo
+from FuzzyMatcher import FuzzyFilter
+from FuzzyMatcher import FuzzyMatcherCache
+from ScopeStackCache import ScopeStackCache
+
+# 按文件缓存扫描状态, 只把还没结束的块交给 CppParser
+SCOPE_STACK_CACHE = ScopeStackCache(CppParser.CxxGetScopeStack)
+
+# 模糊匹配最多返回的名字的数量
+MAX_FUZZY_NAMES = 100
+
+def LoadScopeNames(key):
+    '''FUZZY_MATCHERS 的 loader, 在后台线程中使用自己的数据库连接
+    用完马上关闭, 连接归还给这个线程的连接池'''
+    dbfile, scopes = key
+    tagmgr = GetTagsMgr(dbfile)
+    if not tagmgr:
+        return []
+    try:
+        return tagmgr.GetNamesByScopes(list(scopes))
+    finally:
+        tagmgr.CloseDatabase()
+
+# 非成员补全的模糊匹配索引, 建立在搜索作用域的全部名字上
+# 键为 (数据库, 作用域元组), 在后台建立, 数据库修改之后在后台增量更新
+FUZZY_MATCHERS = FuzzyMatcherCache(LoadScopeNames)
+
+def FuzzyMatchScopeNames(tagmgr, scopes, base, icase = True):
+    '''返回 scopes 中模糊匹配 base 的名字, 按分数排序
+    索引还没有建立的话返回 None, 不等待'''
+    dbfile = tagmgr.storage.GetDatabaseFileName()
+    key = (dbfile, tuple(scopes))
+    stamp = tagmgr.GetChangeStamp()
+    if dbfile == ':memory:':
+        # 内存数据库不能在其他线程中打开, 只能在这里建立
+        names = FUZZY_MATCHERS.MatchWords(key, stamp, base, MAX_FUZZY_NAMES,
+                                          icase)
+        if names is not None:
+            return names
+        FUZZY_MATCHERS.Put(key, stamp, tagmgr.GetNamesByScopes(scopes))
+    return FUZZY_MATCHERS.MatchWords(key, stamp, base, MAX_FUZZY_NAMES, icase)
 
 def GetTagsMgr(dbfile):
     tagmgr = VimTagsManager()
     # 不一定打开成功
     if not tagmgr.OpenDatabase(dbfile):
         return None
+    # 补全的 tagmgr 会被反复使用(omnicxxd), 缓存查询结果
+    tagmgr.SetUseCache(True)
+    return tagmgr
+
+# 补全使用的 tagmgr, {数据库文件: VimTagsManager}, 跨请求复用以保留查询缓存
+# 保存文件后的后台 parse 也通过它请求, 见 RequestReindex()
+COMPL_TAGMGRS = {}
+
+def GetComplTagsMgr(dbfile):
+    '''获取已打开的补全 tagmgr, 没有的话打开之, 失败返回 None
+    NOTE: 数据库连接只能在打开它的线程中使用'''
+    if dbfile != ':memory:':
+        dbfile = os.path.realpath(dbfile)
+    tagmgr = COMPL_TAGMGRS.get(dbfile)
+    if tagmgr is None:
+        tagmgr = GetTagsMgr(dbfile)
+        if tagmgr:
+            COMPL_TAGMGRS[dbfile] = tagmgr
     return tagmgr
 
-def GetScopeStack(buff, row, col):
+def RequestReindex(dbfile, files, macrosFiles = [], delay = 0.5):
+    '''保存文件后请求在后台重新 parse files, 立即返回
+    由补全 tagmgr 的后台服务完成, 提交后补全的查询缓存自动失效'''
+    tagmgr = GetComplTagsMgr(dbfile)
+    if not tagmgr:
+        return False
+    # 使用 WAL 模式, parse 的时候补全依然可以读取, 此模式保存在数据库文件中
+    if not tagmgr.storage.IsWal():
+        tagmgr.storage.EnableWal()
+    tagmgr.RequestReindex(files, macrosFiles, delay)
+    return True
+
+def StopReindex():
+    '''停止全部后台 parse, 等待正在进行的一批写完, 以免写了一半'''
+    for tagmgr in COMPL_TAGMGRS.itervalues():
+        tagmgr.StopReindex(wait = True)
+
+def GetScopeStack(buff, row, col, file = None):
     '''
     @buff:  是字符串的列表
     @row:   行, 从1开始
     @col:   列, 从1开始
+    @file:  文件名, 非空时使用 SCOPE_STACK_CACHE 增量分析
     '''
     if isinstance(buff, str):
         # 强制转为字符串列表
@@ -58,6 +135,8 @@ def GetScopeStack(buff, row, col):
     contents = buff[: row-1]
     # NOTE: 按照vim的计算方式, 当前列不包括, 要取光标前的字符
     contents.append(buff[row-1][:col-1])
+    if file:
+        return SCOPE_STACK_CACHE.GetScopeStack(file, contents)
     return CppParser.CxxGetScopeStack(contents)
 
 def Error(msg):
@@ -78,6 +157,12 @@ def WordToVimComplItem(word, menu, kind, icase):
     result['dup']       = 0
     return result
 
+def ComplItemName(item):
+    '''补全项目对应的名字, 即去掉函数的括号'''
+    if item['kind'] in ('f', 'p'):
+        return item['word'][:-2]
+    return item['word']
+
 def ToVimComplItem(tag, filter_kinds = set()):
     if tag['kind'] in filter_kinds:
         return {}
@@ -216,6 +301,9 @@ def CodeComplete(file, buff, row, col, tagsdb = VimTagsManager(':memory:'),
 
     @pre_scopes:    强制首先搜索的 scopes, 仅在非成员补全时使用, 
                     用于支持额外的名空间信息的
+    @fuzzy:     使用模糊匹配代替前缀匹配, 例如 gtbp 匹配 GetTagsByPath,
+                结果按匹配的分数排序
+                非成员补全的索引在后台建立, 建立完成之前使用前缀匹配
 
     @return:    参考vim的complete-items的帮助信息
     '''
@@ -224,6 +312,7 @@ def CodeComplete(file, buff, row, col, tagsdb = VimTagsManager(':memory:'),
     opt = kwargs.get('opt', None)
     retmsg = kwargs.get('retmsg', {})
     pre_scopes = kwargs.get('pre_scopes', [])
+    fuzzy = kwargs.get('fuzzy', False)
 
     if isinstance(tagsdb, VimTagsManager):
         tagmgr = tagsdb
@@ -237,14 +326,14 @@ def CodeComplete(file, buff, row, col, tagsdb = VimTagsManager(':memory:'),
 # ============================================================================
 # 补全预分析
 # ============================================================================
-    scope_stack = GetScopeStack(buff, row, col)
+    scope_stack = GetScopeStack(buff, row, col, file)
     #obj = eval(repr(scope_stack))
     #print json.dumps(obj, sort_keys=True, indent=4)
 
     if not scope_stack:
         return []
 
-    tokens = CxxTokenize(scope_stack[-1].cusrstmt)
+    tokens = TOKEN_CACHE.TokenizeStatement(file, scope_stack[-1].cusrstmt)
     #print tokens
 
     this_base = ''
@@ -255,6 +344,8 @@ def CodeComplete(file, buff, row, col, tagsdb = VimTagsManager(':memory:'),
     # 需要的话, 重置 base
     if base is None:
         base = this_base
+    # 没有 base 的话没有需要匹配的
+    fuzzy = fuzzy and bool(base)
 
     # "::", "->", "." 之后的补全(无论 base 是否为空字符)定义为成员补全
     member_complete = False
@@ -283,15 +374,31 @@ def CodeComplete(file, buff, row, col, tagsdb = VimTagsManager(':memory:'),
 # ============================================================================
     tags = []
 
+    filter_kinds = set()
+    if member_complete and not scope_complete:
+        filter_kinds.add('t')
+        filter_kinds.add('s')
+        filter_kinds.add('c')
+
     if not member_complete:
     # 非成员请求, 直接在本作用域内搜索即可
         scope_info = ResolveScopeStack(scope_stack)
         #scope_info.Print()
-        search_scopes = scope_info.container + scope_info._global + scope_info.function
+        # 由近到远, 结果按这个顺序排序
+        search_scopes = scope_info.function + scope_info.container + scope_info._global
         # 添加 pre_scopes 到最前面
         search_scopes[:0] = pre_scopes
-        # 获取tags
-        tags = tagmgr.GetOrderedTagsByScopesAndName(search_scopes, base)
+        # 获取tags, 模糊匹配时先在全部名字中匹配, 再获取这些名字的 tags,
+        # 结果按匹配的分数排序
+        names = None
+        if fuzzy:
+            names = FuzzyMatchScopeNames(tagmgr, search_scopes, base, icase)
+        if names is not None:
+            tags = tagmgr.GetRankedTagsByScopesAndNames(search_scopes, names)
+        else:
+            # 模糊匹配的索引还在后台建立的话, 暂时使用前缀匹配
+            tags = tagmgr.GetRankedTagsByScopesAndName(search_scopes, base,
+                                                       icase = icase)
     else:
     # 成员补全, 相当复杂
         compl_info = GetComplInfo(tokens)
@@ -300,17 +407,29 @@ def CodeComplete(file, buff, row, col, tagsdb = VimTagsManager(':memory:'),
             retmsg['info'] = 'complete global symbols with empty base is not allowed'
             return []
         search_scopes = ResolveComplInfo(scope_stack, compl_info, tagmgr)
-        tags = tagmgr.GetOrderedTagsByScopesAndName(search_scopes, base)
-
-    if member_complete and not tags:
-        retmsg['info'] = 'tags not found'
-        return []
+        # 成员不多, 模糊匹配时获取全部成员
+        # 派生类的成员会隐藏基类的同名成员
+        # 补全项目直接由 SQL 查询生成, 过滤和排序也在 SQL 中完成
+        if fuzzy:
+            result = tagmgr.GetRankedComplItems(
+                search_scopes, '', icase = icase, excludeKinds = filter_kinds,
+                skipCtorDtor = True, shadow = True)
+            result = FuzzyFilter(base, result, key = ComplItemName,
+                                 icase = icase)
+        else:
+            result = tagmgr.GetRankedComplItems(
+                search_scopes, base, icase = icase,
+                excludeKinds = filter_kinds, skipCtorDtor = True,
+                shadow = True)
+        if not result:
+            retmsg['info'] = 'tags not found'
+        return result
 # ============================================================================
 # 这之后的是转换结果
 # ============================================================================
     result = []
     base_re = None
-    if base:
+    if base and not fuzzy:
         try:
             # 模式全部转为16进制, 那就不需要任何转义了
             patstr = ''.join(["\\x%2x" % ord(c) for c in base])
@@ -327,33 +446,21 @@ def CodeComplete(file, buff, row, col, tagsdb = VimTagsManager(':memory:'),
         visible_vars = []
         for scope in scope_stack[::-1]:
             visible_vars.extend(scope.vars.keys())
-        if base:
+        if fuzzy:
+            result += [WordToVimComplItem(var, '', 'v', icase) for var in
+                       FuzzyFilter(base, visible_vars, icase = icase)]
+        elif base:
             result += [WordToVimComplItem(var, '', 'v', icase) for var in visible_vars
                        if base_re.match(var)]
         else:
             result += [WordToVimComplItem(var, '', 'v', icase) for var in visible_vars]
 
-    filter_kinds = set()
-    if member_complete and not scope_complete:
-        filter_kinds.add('t')
-        filter_kinds.add('s')
-        filter_kinds.add('c')
-
-    # 再添加 tags
-    if base:
-        for tag in tags:
-            if not base_re.match(tag['name']):
-                continue
-            item = ToVimComplItem(tag, filter_kinds)
-            if not item:
-                continue
-            result.append(item)
-    else:
-        for tag in tags:
-            item = ToVimComplItem(tag, filter_kinds)
-            if not item:
-                continue
-            result.append(item)
+    # 再添加 tags, 名字和 kind 在获取的时候已经过滤了, 并且已经排好序
+    for tag in tags:
+        item = ToVimComplItem(tag, filter_kinds)
+        if not item:
+            continue
+        result.append(item)
 
     if tags:
         #print 'fetch tags', len(tags)
@@ -60,8 +60,9 @@ function! videm#plugin#omnicxx#Enable() "{{{2
     augroup VidemCCOmniCxx
         autocmd!
         autocmd! FileType c,cpp call omnicxx#complete#BuffInit()
-        "autocmd! BufWritePost * call <SID>AsyncParseCurrentFile()
-        "autocmd! VimLeave     * call <SID>Autocmd_Quit()
+        autocmd! BufWritePost *.c,*.cpp,*.cxx,*.cc,*.c++,*.h,*.hpp,*.hxx,*.hh
+                    \ call <SID>AsyncParseCurrentFile()
+        autocmd! VimLeave     * call <SID>Autocmd_Quit()
     augroup END
     let s:enable = 1
 endfunction
@@ -70,6 +71,7 @@ function! videm#plugin#omnicxx#Disable() "{{{2
     if !s:enable
         return
     endif
+    py OmniCxxReindexStop()
     " 删除命令
     call s:UninstallCommands()
     " 删除自动命令
@@ -115,9 +117,27 @@ function! s:InitPyIf() "{{{2
     let s:initpy = 1
 python << PYTHON_EOF
 import sys
+import vim
 import os.path
+import omnicxx
+
+# 保存文件后在后台重新 parse, 补全不需要等待
+# 通过补全的 tagmgr 请求, 与补全使用同一个数据库
+def OmniCxxReindexRequest(fname):
+    omnicxx.RequestReindex(os.path.expanduser('~/dbfile.vltags'), [fname])
+
+def OmniCxxReindexStop():
+    omnicxx.StopReindex()
 PYTHON_EOF
 endfunction
 "}}}
+function! s:AsyncParseCurrentFile() "{{{2
+    py OmniCxxReindexRequest(vim.eval('expand("<afile>:p")'))
+endfunction
+"}}}
+function! s:Autocmd_Quit() "{{{2
+    py OmniCxxReindexStop()
+endfunction
+"}}}
 
 " vim: fdm=marker fen et sw=4 sts=4 fdl=1
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+omnicxx 的常驻补全服务
+
+每次补全都启动新的解释器的话, 大部分时间都花在了导入模块和打开数据库上面,
+这里用一个常驻进程保存 VimTagsManager 实例和各种缓存, 只需要启动一次
+
+协议为按行分隔的 JSON-RPC, 每行一个请求, 每行一个响应
+    请求: {"id": 1, "method": "CodeComplete", "params": {...}}
+    响应: {"id": 1, "result": [...], "retmsg": {...}, "time": {...}}
+
+CodeComplete 的 params 与 omnicxx.CodeComplete() 的参数一致:
+    file, buff, row, col, dbfile, base, icase, opt, pre_scopes, fuzzy
+其中 buff 可省略, 省略的时候读取 file 的内容
+
+用法:
+    omnicxxd.py                 使用 stdin/stdout
+    omnicxxd.py -s {socket}     使用 unix socket
+'''
+
+import sys
+import os
+import os.path
+import time
+import json
+import getopt
+import SocketServer
+
+from omnicxx import GetTagsMgr
+from omnicxx import CodeComplete
+from omnicxx import SCOPE_STACK_CACHE
+from omnicxx import TOKEN_CACHE
+from omnicxx import FUZZY_MATCHERS
+from CxxTypeParser import GetTypeCacheStats
+
+class CompletionServer(object):
+    '''保存补全所需要的常驻状态, 与传输方式无关'''
+    def __init__(self):
+        # {数据库文件: VimTagsManager}
+        self.tagmgrs = {}
+        self.requests = 0
+        self.running = True
+        self.methods = {
+            'CodeComplete'  : self.CodeComplete,
+            'Invalidate'    : self.Invalidate,
+            'Stats'         : self.Stats,
+            'Ping'          : self.Ping,
+            'Shutdown'      : self.Shutdown,
+        }
+
+    def GetTagsMgr(self, dbfile):
+        '''获取已打开的 tagmgr, 没有的话打开之, 失败返回 None'''
+        if dbfile != ':memory:':
+            dbfile = os.path.realpath(dbfile)
+        tagmgr = self.tagmgrs.get(dbfile)
+        if tagmgr is None:
+            tagmgr = GetTagsMgr(dbfile)
+            if tagmgr:
+                self.tagmgrs[dbfile] = tagmgr
+        return tagmgr
+
+    def CodeComplete(self, params, retmsg, timing):
+        file = params.get('file', '')
+        buff = params.get('buff')
+        row = int(params.get('row', 0))
+        col = int(params.get('col', 0))
+        dbfile = params.get('dbfile', '')
+
+        if buff is None:
+            try:
+                with open(file) as f:
+                    buff = f.read().splitlines()
+            except IOError:
+                retmsg['error'] = 'Failed to read %s' % file
+                return []
+        elif isinstance(buff, unicode):
+            buff = buff.encode('utf-8')
+        elif isinstance(buff, list):
+            buff = [i.encode('utf-8') if isinstance(i, unicode) else i
+                    for i in buff]
+
+        t0 = time.time()
+        tagmgr = self.GetTagsMgr(dbfile)
+        timing['open'] = (time.time() - t0) * 1000.0
+        if not tagmgr:
+            retmsg['error'] = 'Failed to open tags database, abort'
+            return []
+
+        kwargs = {'retmsg': retmsg}
+        for key in ('base', 'icase', 'opt', 'pre_scopes', 'fuzzy'):
+            if params.has_key(key):
+                kwargs[key] = params[key]
+        if isinstance(kwargs.get('base'), unicode):
+            kwargs['base'] = kwargs['base'].encode('utf-8')
+
+        t0 = time.time()
+        result = CodeComplete(file, buff, row, col, tagmgr, **kwargs)
+        timing['complete'] = (time.time() - t0) * 1000.0
+        return result
+
+    def Invalidate(self, params, retmsg, timing):
+        '''关闭指定的(或全部的)数据库, 下次请求时重新打开'''
+        dbfile = params.get('dbfile')
+        if not dbfile:
+            self.tagmgrs.clear()
+        else:
+            if dbfile != ':memory:':
+                dbfile = os.path.realpath(dbfile)
+            self.tagmgrs.pop(dbfile, None)
+        return True
+
+    def Stats(self, params, retmsg, timing):
+        caches = {}
+        for dbfile, tagmgr in self.tagmgrs.iteritems():
+            caches[dbfile] = tagmgr.storage.GetCacheStats()
+        return {'requests': self.requests, 'dbfiles': self.tagmgrs.keys(),
+                'caches': caches,
+                'scopeStack': SCOPE_STACK_CACHE.GetStats(),
+                'tokens': TOKEN_CACHE.GetStats(),
+                'fuzzy': FUZZY_MATCHERS.GetStats(),
+                'types': GetTypeCacheStats()}
+
+    def Ping(self, params, retmsg, timing):
+        return 'pong'
+
+    def Shutdown(self, params, retmsg, timing):
+        self.running = False
+        return True
+
+    def HandleRequest(self, request):
+        '''处理一个请求(字典), 返回响应(字典)'''
+        t0 = time.time()
+        self.requests += 1
+        response = {'id': request.get('id')}
+        retmsg = {}
+        timing = {}
+
+        method = self.methods.get(request.get('method'))
+        if method is None:
+            response['error'] = 'Unknown method: %s' % request.get('method')
+        else:
+            try:
+                response['result'] = method(request.get('params') or {},
+                                            retmsg, timing)
+            except Exception, e:
+                response['error'] = '%s: %s' % (type(e).__name__, e)
+
+        response['retmsg'] = retmsg
+        timing['total'] = (time.time() - t0) * 1000.0
+        response['time'] = timing
+        return response
+
+    def HandleLine(self, line):
+        '''处理一行请求文本, 返回一行响应文本, 空行返回 None'''
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            request = json.loads(line)
+        except ValueError, e:
+            return json.dumps({'id': None, 'error': 'Invalid request: %s' % e})
+        if not isinstance(request, dict):
+            return json.dumps({'id': None, 'error': 'Invalid request'})
+        return json.dumps(self.HandleRequest(request))
+
+    def ServeStream(self, fin, fout):
+        while self.running:
+            line = fin.readline()
+            if not line:
+                break
+            output = self.HandleLine(line)
+            if output is None:
+                continue
+            fout.write(output + '\n')
+            fout.flush()
+
+class _StreamHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        self.server.compl_server.ServeStream(self.rfile, self.wfile)
+        if not self.server.compl_server.running:
+            # 处理完这个连接后退出服务循环
+            self.server.stop = True
+
+class _UnixServer(SocketServer.UnixStreamServer):
+    # 单线程串行处理请求, sqlite3 的连接不能跨线程使用
+    def __init__(self, path, compl_server):
+        SocketServer.UnixStreamServer.__init__(self, path, _StreamHandler)
+        self.compl_server = compl_server
+        self.stop = False
+
+def ServeUnixSocket(path, compl_server):
+    if os.path.exists(path):
+        os.remove(path)
+    server = _UnixServer(path, compl_server)
+    try:
+        while not server.stop:
+            server.handle_request()
+    finally:
+        server.server_close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def usage(cmd):
+    print 'Usage:\n\t%s [-s {socket}]' % cmd
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 's:h')
+    except getopt.GetoptError:
+        usage(argv[0])
+        return 1
+
+    sockpath = ''
+    for opt, val in opts:
+        if opt == '-s':
+            sockpath = val
+        elif opt == '-h':
+            usage(argv[0])
+            return 0
+
+    compl_server = CompletionServer()
+    if sockpath:
+        ServeUnixSocket(sockpath, compl_server)
+    else:
+        compl_server.ServeStream(sys.stdin, sys.stdout)
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    if ret is None:
+        ret = 0
+    sys.exit(ret)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+TagsStorage 的回归测试: 缓存和索引在其他连接提交之后不能过时,
+批量导入失败的时候不能留下半批标签
+'''
+
+import sys
+import os
+import os.path
+import tempfile
+
+__dir__ = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.append(os.path.join(os.path.dirname(__dir__), 'TagsStorage'))
+import TagsStorageSQLite
+
+from TagsStorageSQLite import TagsStorageSQLite as Storage
+from TagsStorageSQLite import TAGS_SECONDARY_INDEXES
+from TagsStorageSQLite import ParseFilesAndStore
+
+def _Line(name, fname, scope, line = 1):
+    return '%s\t%s\t/^x$/;"\tm\tline:%d\tclass:%s\taccess:public' \
+            % (name, fname, line, scope)
+
+def _Names(tags):
+    return [tag.name for tag in tags]
+
+def _TempDatabase():
+    fd, fname = tempfile.mkstemp(suffix = '.vltags')
+    os.close(fd)
+    return fname
+
+def test_cache_invalidation(dbfile):
+    '''其他连接提交之后, 缓存的查询结果要失效'''
+    compl = Storage()
+    compl.OpenDatabase(dbfile)
+    compl.SetUseCache(True)
+    compl.StoreLines([_Line('GetX', 'a.h', 'C')])
+    assert _Names(compl.GetTagsByScopeAndName('C', 'Get', True)) == ['GetX']
+    # 第二次来自缓存
+    assert _Names(compl.GetTagsByScopeAndName('C', 'Get', True)) == ['GetX']
+
+    other = Storage()
+    other.OpenDatabase(dbfile)
+    other.StoreLines([_Line('GetY', 'b.h', 'C')])
+    other.CloseDatabase()
+
+    assert sorted(_Names(compl.GetTagsByScopeAndName('C', 'Get', True))) \
+            == ['GetX', 'GetY']
+    compl.CloseDatabase()
+
+def test_change_stamp():
+    '''StoreLines() 之后变更标记要改变, 即使缓存是空的'''
+    storage = Storage()
+    storage.OpenDatabase(':memory:')
+    stamp = storage.GetChangeStamp()
+    storage.StoreLines([_Line('GetX', 'a.h', 'C')])
+    assert storage.GetChangeStamp() != stamp
+    stamp = storage.GetChangeStamp()
+    assert storage.GetChangeStamp() == stamp
+    storage.StoreLines([_Line('GetY', 'a.h', 'C', 2)])
+    assert storage.GetChangeStamp() != stamp
+
+def test_symbol_index_sync(dbfile):
+    '''其他连接的提交, 只登记了部分文件的话索引也要全部重新载入'''
+    storage = Storage()
+    storage.OpenDatabase(dbfile)
+    storage.StoreLines([_Line('GetX', 'a.h', 'D')])
+    storage.EnableSymbolIndex()
+    tags = storage.GetOrderedTagsByScopesAndName(['D'], 'get', True)
+    assert _Names(tags) == ['GetX']
+
+    other = Storage()
+    other.OpenDatabase(dbfile)
+    other.StoreLines([_Line('GetZ', 'c.h', 'D')])
+    other.StoreLines([_Line('GetW', 'e.h', 'D')])
+    other.CloseDatabase()
+    storage.GetSymbolIndex().MarkFiles(['c.h'])
+
+    tags = storage.GetOrderedTagsByScopesAndName(['D'], 'get', True)
+    assert _Names(tags) == ['GetW', 'GetX', 'GetZ']
+    storage.CloseDatabase()
+
+class _BadCtagsProcess(object):
+    '''输出几个正常的标签之后输出一个坏行(line 不是整数)'''
+    instances = []
+
+    def __init__(self, files, macrosFiles = []):
+        self.stdout = iter([_Line('Tag%d' % i, files[0], 'C', i + 1)
+                            for i in range(10)]
+                           + ['bad\t%s\t/^x$/;"\tm\tline:abc' % files[0]])
+        self.killed = False
+        _BadCtagsProcess.instances.append(self)
+
+    def Wait(self):
+        return True
+
+    def Kill(self):
+        self.killed = True
+
+def test_bulk_load_rollback():
+    '''初次导入时 FromLine() 抛出异常, 已经写入的半批要回滚,
+    二级索引要重建, ctags 进程要结束'''
+    dbfile = _TempDatabase()
+    fname = os.path.join(__dir__, 'test00.cpp')
+    origProcess = TagsStorageSQLite.CtagsProcess
+    origChunkSize = TagsStorageSQLite.BULK_CHUNK_SIZE
+    # 让异常发生之前已经执行过 executemany()
+    TagsStorageSQLite.CtagsProcess = _BadCtagsProcess
+    TagsStorageSQLite.BULK_CHUNK_SIZE = 4
+    try:
+        storage = Storage()
+        storage.OpenDatabase(dbfile)
+        try:
+            ParseFilesAndStore(storage, [fname], filterNotNeed = False)
+        except ValueError:
+            pass
+        else:
+            assert False, 'ValueError expected'
+
+        assert storage.Query("SELECT count(*) FROM TAGS").fetchone()[0] == 0
+        indexes = set(row[0] for row in storage.Query(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"))
+        for name, sql in TAGS_SECONDARY_INDEXES:
+            assert name in indexes, name
+        assert _BadCtagsProcess.instances[-1].killed
+        storage.CloseDatabase()
+    finally:
+        TagsStorageSQLite.CtagsProcess = origProcess
+        TagsStorageSQLite.BULK_CHUNK_SIZE = origChunkSize
+        os.remove(dbfile)
+
+def main(argv):
+    for func in (test_cache_invalidation, test_symbol_index_sync):
+        dbfile = _TempDatabase()
+        try:
+            func(dbfile)
+        finally:
+            os.remove(dbfile)
+    test_change_stamp()
+    test_bulk_load_rollback()
+    print 'ok'
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    if ret is None:
+        ret = 0
+    sys.exit(ret)